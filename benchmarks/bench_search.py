@@ -0,0 +1,291 @@
+#! /usr/bin/env python
+"""
+Benchmark mgsearch / mgmanysearch on synthetic FracMinHash sketches.
+
+Sketches are generated offline with a fixed random seed, so runs with the
+same parameters search identical data. Each configuration is timed
+end-to-end through mgsearch and mg_many_search, and then broken down into
+the plugin's own load, index, intersect, score and output phases of the
+_search_all code path that the commands run. Results are written as JSON
+so they can be compared across releases.
+
+Usage:
+    python benchmarks/bench_search.py [--preset small|medium|large] \
+        [--n-queries N] [--n-metags N] [--read-ahead N] \
+        [--metag-cache DIR] [-o results.json]
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import sourmash
+from sourmash import MinHash, SourmashSignature
+from sourmash.minhash import _get_max_hash_for_scaled
+
+import sourmash_plugin_containment_search as plugin
+
+
+PRESETS = {
+    'small': dict(n_queries=10, n_metags=4, genome_hashes=2_000,
+                  metag_hashes=50_000),
+    'medium': dict(n_queries=100, n_metags=8, genome_hashes=5_000,
+                   metag_hashes=500_000),
+    'large': dict(n_queries=1_000, n_metags=16, genome_hashes=5_000,
+                  metag_hashes=2_000_000),
+}
+
+
+#
+# synthetic data
+#
+
+def _random_hashes(rng, n, scaled):
+    "Draw 'n' distinct hashes below the max_hash for 'scaled'."
+    max_hash = _get_max_hash_for_scaled(scaled)
+    hashes = np.unique(rng.integers(0, max_hash, size=n, dtype=np.uint64))
+    while len(hashes) < n:
+        more = rng.integers(0, max_hash, size=n - len(hashes), dtype=np.uint64)
+        hashes = np.unique(np.concatenate([hashes, more]))
+    return hashes
+
+
+def _abundances(rng, n, distribution):
+    if distribution == 'flat':
+        return np.ones(n, dtype=np.uint64)
+    if distribution == 'geometric':
+        return rng.geometric(0.2, size=n).astype(np.uint64)
+    if distribution == 'lognormal':
+        return np.maximum(1, rng.lognormal(1.0, 1.5, size=n)).astype(np.uint64)
+    raise ValueError(f"unknown abundance distribution '{distribution}'")
+
+
+def _save(filename, sigs):
+    with sourmash.save_load.SaveSignaturesToLocation(filename) as save_sigs:
+        for ss in sigs:
+            save_sigs.add(ss)
+
+
+def make_dataset(outdir, *, n_queries, n_metags, genome_hashes,
+                 metag_hashes, ksize=31, scaled=1000, abundance='geometric',
+                 containment=0.5, seed=1):
+    """
+    Write 'n_queries' genome sketches to 'outdir/queries.sig.zip', the
+    first of them to 'outdir/query0.sig.zip', and 'n_metags'
+    abundance-weighted metagenome sketches to 'outdir/metag<i>.sig.zip'.
+    Each metagenome contains a random 'containment' fraction of the hashes
+    of a random half of the queries.
+
+    Returns (query_filename, single_query_filename, [metag_filenames]).
+    """
+    rng = np.random.default_rng(seed)
+
+    genomes = []
+    query_sigs = []
+    for i in range(n_queries):
+        hashes = _random_hashes(rng, genome_hashes, scaled)
+        genomes.append(hashes)
+        mh = MinHash(n=0, ksize=ksize, scaled=scaled)
+        mh.add_many(hashes.tolist())
+        query_sigs.append(SourmashSignature(mh, name=f'genome{i}'))
+
+    query_filename = os.path.join(outdir, 'queries.sig.zip')
+    _save(query_filename, query_sigs)
+    single_query_filename = os.path.join(outdir, 'query0.sig.zip')
+    _save(single_query_filename, query_sigs[:1])
+
+    metag_filenames = []
+    for i in range(n_metags):
+        present = rng.choice(n_queries, size=max(1, n_queries // 2),
+                             replace=False)
+        parts = [_random_hashes(rng, metag_hashes, scaled)]
+        for j in present:
+            keep = rng.random(len(genomes[j])) < containment
+            parts.append(genomes[j][keep])
+        hashes = np.unique(np.concatenate(parts))
+        abunds = _abundances(rng, len(hashes), abundance)
+
+        mh = MinHash(n=0, ksize=ksize, scaled=scaled, track_abundance=True)
+        mh.set_abundances(dict(zip(hashes.tolist(), abunds.tolist())))
+
+        metag_filename = os.path.join(outdir, f'metag{i}.sig.zip')
+        _save(metag_filename, [SourmashSignature(mh, name=f'metag{i}')])
+        metag_filenames.append(metag_filename)
+
+    return query_filename, single_query_filename, metag_filenames
+
+
+#
+# timing
+#
+
+def _quietly(func, *args, **kwargs):
+    "Run 'func' with stdout and stderr discarded; return (result, seconds)."
+    sink = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+        result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_end_to_end(query_filename, single_query_filename, metag_filenames,
+                     *, ksize, scaled, outdir, cores=1):
+    results = {}
+    _, results['mgsearch'] = _quietly(plugin.mgsearch, single_query_filename,
+                                      metag_filenames, ksize=ksize,
+                                      scaled=scaled, cores=cores,
+                                      output=os.path.join(outdir, 'one.csv'))
+    _, results['mg_many_search'] = _quietly(plugin.mg_many_search,
+                                            [query_filename],
+                                            metag_filenames, ksize=ksize,
+                                            scaled=scaled, cores=cores,
+                                            output=os.path.join(outdir,
+                                                                'many.csv'))
+    return results
+
+
+def bench_phases(query_filename, metag_filenames, *, ksize, scaled, outdir,
+                 cores=1, read_ahead=1, metag_cache=None):
+    """
+    Time a search one phase at a time, with the same _Timings phases that
+    --timings reports: load queries and metagenomes, index the queries,
+    intersect, score and output.
+
+    The search goes through _search_all rather than calling _search_metag
+    directly, because _search_all is what mgsearch and mgmanysearch run:
+    it adds the metagenome prefetch thread (or the 'read_ahead' loaders)
+    in a serial run, and runs _search_metag in each worker when 'cores' >
+    1. Loads in the background threads overlap with scoring, so the phase
+    times may add up to more than the elapsed time.
+    """
+    timings = plugin._Timings()
+
+    with timings.phase('load_queries'):
+        with contextlib.redirect_stderr(io.StringIO()):
+            queries = plugin._load_queries(query_filename, ksize=ksize,
+                                           moltype='DNA', scaled=scaled)
+
+    with open(os.path.join(outdir, 'phases.csv'), 'w', newline='') as fp:
+        w = csv.DictWriter(fp, fieldnames=plugin.COLUMNS)
+        w.writeheader()
+
+        results = plugin._search_all(queries, metag_filenames, cores=cores,
+                                     ksize=ksize, scaled=scaled,
+                                     read_ahead=read_ahead,
+                                     cache_dir=metag_cache, timings=timings)
+        for _, rows in results:
+            with timings.phase('output'):
+                for _, results_d in rows:
+                    del results_d['display_name']
+                    w.writerow(results_d)
+
+    n_hashes = sum(d['n_hashes'] for d in timings.metagenomes)
+    phases = timings.as_dict()['phases']
+    total = sum(d['wall'] for d in phases.values())
+    return dict(phases=phases,
+                metag_hashes=n_hashes,
+                metag_hashes_per_sec=n_hashes / total if total else None)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    p.add_argument('--n-queries', type=int)
+    p.add_argument('--n-metags', type=int)
+    p.add_argument('--genome-hashes', type=int)
+    p.add_argument('--metag-hashes', type=int)
+    p.add_argument('--abundance', default='geometric',
+                   choices=['flat', 'geometric', 'lognormal'])
+    p.add_argument('-k', '--ksize', type=int, default=31)
+    p.add_argument('--scaled', type=int, default=1000)
+    p.add_argument('-c', '--cores', type=int, default=1)
+    p.add_argument('--read-ahead', type=int, default=1,
+                   help='metagenome files to load concurrently (default: 1)')
+    p.add_argument('--metag-cache',
+                   help='save/load prepared metagenomes in this directory')
+    p.add_argument('--repeat', type=int, default=3,
+                   help='number of timed repetitions (default: 3)')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--data-dir', help='keep generated sketches here')
+    p.add_argument('-o', '--output', help='write JSON results here')
+    args = p.parse_args(argv)
+
+    params = dict(PRESETS[args.preset])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    params.update(abundance=args.abundance, ksize=args.ksize,
+                  scaled=args.scaled, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir = args.data_dir or tmpdir
+        os.makedirs(data_dir, exist_ok=True)
+
+        start = time.perf_counter()
+        query_filename, single_query_filename, metag_filenames = \
+            make_dataset(data_dir, **params)
+        generate_time = time.perf_counter() - start
+        print(f"generated {params['n_queries']} queries and "
+              f"{params['n_metags']} metagenomes in {generate_time:.1f}s",
+              file=sys.stderr)
+
+        runs = []
+        for i in range(args.repeat):
+            run = dict(end_to_end=bench_end_to_end(query_filename,
+                                                   single_query_filename,
+                                                   metag_filenames,
+                                                   ksize=args.ksize,
+                                                   scaled=args.scaled,
+                                                   outdir=tmpdir,
+                                                   cores=args.cores))
+            run.update(bench_phases(query_filename, metag_filenames,
+                                    ksize=args.ksize, scaled=args.scaled,
+                                    outdir=tmpdir, cores=args.cores,
+                                    read_ahead=args.read_ahead,
+                                    metag_cache=args.metag_cache))
+            runs.append(run)
+
+            e2e = run['end_to_end']
+            print(f"run {i + 1}: mgsearch {e2e['mgsearch']:.2f}s, "
+                  f"mg_many_search {e2e['mg_many_search']:.2f}s", file=sys.stderr)
+            for name, d in run['phases'].items():
+                print(f"    {name:<16} {d['wall']:8.3f}s wall "
+                      f"{d['cpu']:8.3f}s cpu {d['calls']:6d} calls",
+                      file=sys.stderr)
+
+    results = dict(plugin_version=_plugin_version(),
+                   sourmash_version=sourmash.VERSION,
+                   numpy_version=np.__version__,
+                   python_version=platform.python_version(),
+                   platform=platform.platform(),
+                   cores=args.cores,
+                   params=params,
+                   runs=runs)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    return 0
+
+
+def _plugin_version():
+    try:
+        from importlib.metadata import version
+        return version('sourmash_plugin_containment_search')
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,6 +10,14 @@ usage="""
    sourmash scripts mgsearch <genome> <metagenome> [ <metagenomes> ... ]
 """
 
+prepare_usage="""
+   sourmash scripts mgprepare <metagenome> [ <metagenomes> ... ] --output-dir <dir>
+"""
+
+dbsearch_usage="""
+   sourmash scripts mgdbsearch <metagenome> <database> [ <databases> ... ]
+"""
+
 epilog="""
 See https://github.com/xyz for more examples.
 
@@ -17,15 +25,36 @@ Need help? Have questions? Ask at http://github.com/sourmash/issues!
 """
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
 import sourmash
 import numpy as np
 import shutil
 import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
 
 from sourmash import sourmash_args
-from sourmash.search import PrefetchResult
+from sourmash.minhash import _get_max_hash_for_scaled, MINHASH_DEFAULT_SEED
+from sourmash.distance_utils import containment_to_distance, set_size_exact_prob
 from sourmash.cli.utils import (add_ksize_arg, add_moltype_args,
-                                add_scaled_arg)
+                                add_scaled_arg, check_scaled_bounds)
 from sourmash.plugins import CommandLinePlugin
 from sourmash.logging import notify, error
 
@@ -38,6 +67,132 @@ def _get_screen_width():
     return col
 
 
+def _add_output_args(subparser):
+    subparser.add_argument('-o', '--output', default=None,
+                           help='output CSV')
+    subparser.add_argument('--require-abundance', action="store_true",
+                           help='require that metagenomes be sketched with abundance')
+    subparser.add_argument('--detection', action="store_true",
+                           default=True, help="output fraction of query detected, instead of ANI; see --ani. Default.")
+    subparser.add_argument('--ani', dest='detection',
+                           action="store_false",
+                           help="output estimated ANI, instead of fraction of query detected; see --detection")
+    subparser.add_argument('--columns', default=None,
+                           help="comma-separated list of CSV columns to output, or a profile: 'all' (default) or 'detection' (all but the ANI columns)")
+
+
+def _add_filter_args(subparser):
+    subparser.add_argument('--threshold-bp', type=float, default=0,
+                           help='only report matches with an estimated overlap of at least this many bp (default: 0, report all)')
+    subparser.add_argument('--min-containment', type=float, default=0.0,
+                           help='only report matches where at least this fraction of the query is found (default: 0)')
+    subparser.add_argument('--top-k', type=int, default=None,
+                           help='only report the N best matches for each query, ranked by containment')
+
+
+def _check_filter_args(args):
+    "Report and return True if the filter arguments are invalid."
+    if args.top_k is not None and args.top_k < 1:
+        error("ERROR: --top-k must be at least 1")
+        return True
+    if not 0 <= args.min_containment <= 1:
+        error("ERROR: --min-containment must be between 0 and 1")
+        return True
+    return False
+
+
+def _ksize_list(arg):
+    "Parse a comma-separated list of ksizes."
+    try:
+        return [ int(ksize) for ksize in arg.split(',') ]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid ksize list '{arg}'")
+
+
+def _scaled_list(arg):
+    "Parse a comma-separated list of scaled values."
+    return [ int(check_scaled_bounds(scaled)) for scaled in arg.split(',') ]
+
+
+def _add_ksize_scaled_args(subparser):
+    subparser.add_argument('-k', '--ksize', metavar='K', type=_ksize_list,
+                           default=[31],
+                           help='k-mer size(s) to select, comma-separated; default=31')
+    subparser.add_argument('--scaled', metavar='FLOAT', type=_scaled_list,
+                           default=None,
+                           help='downsample to this scaled, or to each of a comma-separated list of scaled values; values should be between 100 and 1e6')
+
+
+def _add_display_args(subparser, *, progress=True):
+    subparser.add_argument('--show-results', action='store_true',
+                           help='display each result on stdout even when writing them to -o/--output')
+    if progress:
+        subparser.add_argument('--progress', action='store_true',
+                               help='report search progress on stderr even when it is not a terminal')
+
+
+def _add_loading_args(subparser):
+    subparser.add_argument('-c', '--cores', type=int, default=1,
+                           help='number of processes to use for searching metagenomes (default: 1)')
+    subparser.add_argument('--prefetch', type=int, default=2,
+                           help='number of metagenome sketches to load ahead of searching; 0 to disable (default: 2)')
+    subparser.add_argument('--prefetch-mb', type=float, default=None,
+                           help='maximum memory (MB) used by metagenome sketches loaded ahead of searching')
+    subparser.add_argument('--read-ahead', type=int, default=1,
+                           help='number of metagenome files to load concurrently ahead of searching, e.g. on network filesystems (default: 1)')
+    subparser.add_argument('--emit-skipped', action='store_true',
+                           help='output rows for metagenomes skipped by a mgprepare --bloom prefilter')
+
+
+def _add_instrumentation_args(subparser):
+    subparser.add_argument('--timings', action='store_true',
+                           help='print a summary of time spent in each phase of the search to stderr')
+    subparser.add_argument('--timings-json', default=None,
+                           help='write per-phase and per-metagenome timings to this JSON file')
+    subparser.add_argument('--profile', default=None,
+                           help='write cProfile statistics for the run to this file')
+
+
+def _add_cache_args(subparser):
+    subparser.add_argument('--results-cache', default=None,
+                           help='SQLite file in which to cache the results for each (query, metagenome) pair between runs')
+    subparser.add_argument('--metag-cache', default=None,
+                           help='directory in which to cache flattened & downsampled metagenome sketches between runs')
+
+
+def _run_instrumented(args, func, *fargs, **fkwargs):
+    """
+    Run 'func', collecting per-phase timings and/or a cProfile dump as
+    requested by the --timings, --timings-json and --profile arguments.
+    """
+    timings = None
+    if args.timings or args.timings_json:
+        timings = _Timings()
+        fkwargs['timings'] = timings
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        return func(*fargs, **fkwargs)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            notify(f"wrote cProfile statistics to '{args.profile}'; view them with 'python -m pstats {args.profile}'")
+        if timings:
+            timings.total = time.perf_counter() - start
+            if args.timings:
+                timings.report()
+            if args.timings_json:
+                with open(args.timings_json, 'w') as fp:
+                    json.dump(timings.as_dict(), fp, indent=2)
+                notify(f"wrote timings to '{args.timings_json}'")
+
+
 class MismatchScaled(ValueError):
     pass
 
@@ -58,18 +213,15 @@ class Command_ContainmentSearch(CommandLinePlugin):
                                help='sketch to look for')
         subparser.add_argument('metagenomes', nargs='+',
                                help='metagenomes to search')
-        subparser.add_argument('-o', '--output', default=None,
-                               help='output CSV')
-        subparser.add_argument('--require-abundance', action="store_true",
-                               help='require that metagenomes be sketched with abundance')
-        subparser.add_argument('--detection', action="store_true",
-                               default=True)
-        subparser.add_argument('--ani', dest='detection',
-                               action="store_false")
-
-        add_ksize_arg(subparser, default=31)
+        _add_output_args(subparser)
+        _add_loading_args(subparser)
+        _add_filter_args(subparser)
+        _add_display_args(subparser)
+        _add_instrumentation_args(subparser)
+        _add_cache_args(subparser)
+
+        _add_ksize_scaled_args(subparser)
         add_moltype_args(subparser)
-        add_scaled_arg(subparser, default=1000)
 
     def main(self, args):
         super().main(args)
@@ -77,13 +229,31 @@ class Command_ContainmentSearch(CommandLinePlugin):
         moltype = sourmash_args.calculate_moltype(args)
         if moltype is None: moltype = 'DNA'
 
-        return mgsearch(args.query_genome, args.metagenomes,
+        if _check_filter_args(args):
+            return -1
+
+        return _run_instrumented(args, mgsearch,
+                        args.query_genome, args.metagenomes,
                         ksize=args.ksize,
                         moltype=moltype,
                         scaled=args.scaled,
                         output=args.output,
                         require_abundance=args.require_abundance,
-                        output_ani=not args.detection)
+                        output_ani=not args.detection,
+                        cores=args.cores,
+                        prefetch=args.prefetch,
+                        prefetch_mb=args.prefetch_mb,
+                        read_ahead=args.read_ahead,
+                        emit_skipped=args.emit_skipped,
+                        columns=args.columns,
+                        threshold_bp=args.threshold_bp,
+                        min_containment=args.min_containment,
+                        top_k=args.top_k,
+                        results_cache=args.results_cache,
+                        metag_cache=args.metag_cache,
+                        quiet=args.quiet,
+                        show_results=args.show_results,
+                        progress=args.progress or None)
 
 
 #
@@ -103,19 +273,24 @@ class Command_ContainmentManySearch(CommandLinePlugin):
                                help='sketches to look for in metagenomes', required=True)
         subparser.add_argument('--against', '--db', '--metagenomes', nargs='+',
                                help='metagenomes to search with queries', required=True)
-        subparser.add_argument('-o', '--output', default=None,
-                               help='output CSV')
-        subparser.add_argument('--require-abundance', action="store_true",
-                               help='require that metagenomes be sketched with abundance')
-        subparser.add_argument('--detection', action="store_true",
-                               default=True, help="output fraction of query detected, instead of ANI; see --ani. Default.")
-        subparser.add_argument('--ani', dest='detection',
-                               action="store_false",
-                               help="output estimated ANI, instead of fraction of query detected; see --detection")
-
-        add_ksize_arg(subparser, default=31)
+        _add_output_args(subparser)
+        _add_loading_args(subparser)
+        _add_filter_args(subparser)
+        _add_display_args(subparser)
+        _add_instrumentation_args(subparser)
+        subparser.add_argument('--top-k-by', choices=['query', 'metagenome'],
+                               default='query',
+                               help="with --top-k, keep the N best metagenomes per query ('query', default) or the N best queries per metagenome ('metagenome')")
+        subparser.add_argument('--checkpoint', default=None,
+                               help='record completed metagenomes in this file, and resume from it if it exists; requires CSV output')
+        subparser.add_argument('--previous', default=None,
+                               help='results from an earlier search; only score (query, metagenome) pairs not found there, and output the merged results')
+        subparser.add_argument('--query-cache', default=None,
+                               help='directory in which to cache prepared query sketches between runs')
+        _add_cache_args(subparser)
+
+        _add_ksize_scaled_args(subparser)
         add_moltype_args(subparser)
-        add_scaled_arg(subparser, default=1000)
 
     def main(self, args):
         super().main(args)
@@ -123,13 +298,127 @@ class Command_ContainmentManySearch(CommandLinePlugin):
         moltype = sourmash_args.calculate_moltype(args)
         if moltype is None: moltype = 'DNA'
 
-        return mg_many_search(args.queries, args.against,
+        if _check_filter_args(args):
+            return -1
+
+        return _run_instrumented(args, mg_many_search,
+                              args.queries, args.against,
                               ksize=args.ksize,
                               moltype=moltype,
                               scaled=args.scaled,
                               output=args.output,
                               require_abundance=args.require_abundance,
-                              output_ani=not args.detection)
+                              output_ani=not args.detection,
+                              cores=args.cores,
+                              query_cache=args.query_cache,
+                              prefetch=args.prefetch,
+                              prefetch_mb=args.prefetch_mb,
+                              read_ahead=args.read_ahead,
+                              emit_skipped=args.emit_skipped,
+                              columns=args.columns,
+                              threshold_bp=args.threshold_bp,
+                              min_containment=args.min_containment,
+                              top_k=args.top_k,
+                              top_k_by=args.top_k_by,
+                              checkpoint=args.checkpoint,
+                              previous=args.previous,
+                              results_cache=args.results_cache,
+                              metag_cache=args.metag_cache,
+                              quiet=args.quiet,
+                              show_results=args.show_results,
+                              progress=args.progress or None)
+
+
+#
+# CLI plugin - supports 'sourmash scripts mgprepare'
+#
+
+class Command_ContainmentPrepare(CommandLinePlugin):
+    command = 'mgprepare'             # 'scripts <command>'
+    description = "Convert metagenome sketches into memory-mappable .mgsketch files"       # output with -h
+    usage = prepare_usage       # output with no args/bad args as well as -h
+    epilog = epilog             # output with -h
+    formatter_class = argparse.RawTextHelpFormatter # do not reformat multiline
+
+    def __init__(self, subparser):
+        super().__init__(subparser)
+        subparser.add_argument('metagenomes', nargs='+',
+                               help='metagenome sketches to convert')
+        subparser.add_argument('--output-dir', '--outdir', required=True,
+                               help='directory in which to write .mgsketch files')
+        subparser.add_argument('--bloom', action='store_true',
+                               help='also write a Bloom filter sidecar, used to skip metagenomes that share no hashes with the queries')
+
+        add_ksize_arg(subparser, default=31)
+        add_moltype_args(subparser)
+        add_scaled_arg(subparser)
+
+    def main(self, args):
+        super().main(args)
+
+        moltype = sourmash_args.calculate_moltype(args)
+        if moltype is None: moltype = 'DNA'
+
+        return mgprepare(args.metagenomes,
+                         output_dir=args.output_dir,
+                         bloom=args.bloom,
+                         ksize=args.ksize,
+                         moltype=moltype,
+                         scaled=args.scaled)
+
+
+#
+# CLI plugin - supports 'sourmash scripts mgdbsearch'
+#
+
+class Command_ContainmentDbSearch(CommandLinePlugin):
+    command = 'mgdbsearch'             # 'scripts <command>'
+    description = "Search for the genomes in a database that are in a metagenome"       # output with -h
+    usage = dbsearch_usage      # output with no args/bad args as well as -h
+    epilog = epilog             # output with -h
+    formatter_class = argparse.RawTextHelpFormatter # do not reformat multiline
+
+    def __init__(self, subparser):
+        super().__init__(subparser)
+        subparser.add_argument('metagenome',
+                               help='metagenome sketch to search')
+        subparser.add_argument('databases', nargs='+',
+                               help='genome databases to search for (zip, SBT, LCA, ...)')
+        _add_output_args(subparser)
+        subparser.add_argument('--batch-size', type=int, default=10000,
+                               help='number of candidate genomes to score at a time (default: 10000)')
+        _add_filter_args(subparser)
+        _add_display_args(subparser, progress=False)
+        _add_instrumentation_args(subparser)
+
+        add_ksize_arg(subparser, default=31)
+        add_moltype_args(subparser)
+        add_scaled_arg(subparser)
+
+    def main(self, args):
+        super().main(args)
+
+        moltype = sourmash_args.calculate_moltype(args)
+        if moltype is None: moltype = 'DNA'
+
+        if _check_filter_args(args):
+            return -1
+
+        return _run_instrumented(args, mg_db_search,
+                        args.metagenome, args.databases,
+                        ksize=args.ksize,
+                        moltype=moltype,
+                        scaled=int(args.scaled) if args.scaled else None,
+                        output=args.output,
+                        require_abundance=args.require_abundance,
+                        output_ani=not args.detection,
+                        batch_size=args.batch_size,
+                        columns=args.columns,
+                        threshold_bp=args.threshold_bp,
+                        min_containment=args.min_containment,
+                        top_k=args.top_k,
+                        quiet=args.quiet,
+                        show_results=args.show_results)
 
 
 ## Implementation!
@@ -162,29 +451,534 @@ COLUMNS = ['intersect_bp',
            'potential_false_negative'
            ]
 
+# columns that require ANI estimation, which is comparatively expensive.
+ANI_COLUMNS = ['genome_containment_ani',
+               'match_containment_ani',
+               'average_containment_ani',
+               'max_containment_ani',
+               'potential_false_negative']
 
-def mgsearch(query_filename, against_list, *,
-             ksize=31, moltype='DNA', scaled=1000, output=None,
-             require_abundance=False, output_ani=False):
+# named column selections for --columns.
+COLUMN_PROFILES = {
+    'all': COLUMNS,
+    'detection': [ c for c in COLUMNS if c not in ANI_COLUMNS ],
+}
+
+
+def _select_columns(spec):
     """
-    Search for a single genome in many metagenomes.
+    Parse a --columns value: None, the name of a profile in
+    COLUMN_PROFILES, or a comma-separated list of column names. Returns
+    the list of columns; raises ValueError on unknown column names.
     """
-    screen_width = _get_screen_width()
+    if spec is None:
+        return list(COLUMNS)
+    if spec in COLUMN_PROFILES:
+        return list(COLUMN_PROFILES[spec])
+
+    columns = []
+    for name in spec.split(','):
+        name = name.strip()
+        if name and name not in columns:
+            columns.append(name)
+
+    unknown = [ name for name in columns if name not in COLUMNS ]
+    if unknown:
+        raise ValueError(f"unknown column(s) {', '.join(unknown)}; choose from profiles {', '.join(COLUMN_PROFILES)} or columns {', '.join(COLUMNS)}")
+    if not columns:
+        raise ValueError("no columns selected")
+    return columns
+
+
+# Arrow types of each column, for Parquet and Arrow output.
+COLUMN_TYPES = dict(intersect_bp='int64',
+                    match_filename='string',
+                    match_name='string',
+                    match_md5='string',
+                    query_filename='string',
+                    query_name='string',
+                    query_md5='string',
+                    ksize='int64',
+                    moltype='string',
+                    scaled='int64',
+                    f_query='float64',
+                    f_match='float64',
+                    f_match_weighted='float64',
+                    sum_weighted_found='int64',
+                    average_abund='float64',
+                    median_abund='float64',
+                    std_abund='float64',
+                    query_n_hashes='int64',
+                    match_n_hashes='int64',
+                    match_n_weighted_hashes='int64',
+                    jaccard='float64',
+                    genome_containment_ani='float64',
+                    match_containment_ani='float64',
+                    average_containment_ani='float64',
+                    max_containment_ani='float64',
+                    potential_false_negative='bool_')
+
+
+# gzip.open defaults to level 9, which costs much more CPU than level 6
+# for a slightly smaller file.
+GZIP_COMPRESSLEVEL = 6
+
+def _open_output(filename, columns, *, append_at=None):
+    """
+    Open 'filename' for writing results with the given columns, choosing
+    the format by extension: '.parquet', '.arrow'/'.feather' (Arrow IPC
+    file), '.csv.gz', or CSV otherwise. Returns None if 'filename' is
+    None. Raises ValueError if the format needs pyarrow and it is not
+    installed.
+
+    If 'append_at' is given, an existing CSV file is truncated to that
+    many bytes and appended to, without writing a header.
+    """
+    if not filename:
+        return None
+    if append_at is not None:
+        fp = open(filename, 'r+', newline='')
+        fp.truncate(append_at)
+        fp.seek(append_at)
+        return _CSVOutput(fp, columns, header=False)
+    if filename.endswith('.parquet'):
+        return _ArrowOutput(filename, columns, fmt='parquet')
+    if filename.endswith(('.arrow', '.feather')):
+        return _ArrowOutput(filename, columns, fmt='arrow')
+    if filename.endswith('.gz'):
+        fp = gzip.open(filename, 'wt', newline='',
+                       compresslevel=GZIP_COMPRESSLEVEL)
+    else:
+        fp = open(filename, 'w', newline='', buffering=1024*1024)
+    return _CSVOutput(fp, columns)
+
+
+class _CSVOutput:
+    "Write result rows as CSV."
+    def __init__(self, fp, columns, *, header=True):
+        self.fp = fp
+        self.w = csv.DictWriter(fp, fieldnames=columns, extrasaction='ignore')
+        if header:
+            self.w.writeheader()
+
+    def writerow(self, row):
+        self.w.writerow(row)
+
+    def sync(self):
+        "Flush all rows to disk; return the size of the output so far."
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        return self.fp.tell()
+
+    def close(self):
+        self.fp.close()
+
+
+class _ArrowOutput:
+    """
+    Write result rows to a Parquet or Arrow IPC file with pyarrow. Rows
+    are accumulated into typed columns, and written out as a record batch
+    every 'batch_size' rows.
+    """
+    def __init__(self, filename, columns, *, fmt, batch_size=65536):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ValueError(f"writing '{filename}' requires pyarrow; please install it")
+
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([ (c, getattr(pyarrow, COLUMN_TYPES[c])())
+                                       for c in columns ])
+        self.columns = { c: [] for c in columns }
+        self.n_rows = 0
+        self.batch_size = batch_size
+
+        if fmt == 'parquet':
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(filename, self.schema)
+
+    def writerow(self, row):
+        for name, values in self.columns.items():
+            value = row.get(name)
+            if isinstance(value, str) and value == "" and \
+               COLUMN_TYPES[name] != 'string':
+                value = None          # missing abundance information
+            values.append(value)
+        self.n_rows += 1
+
+        if self.n_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.n_rows:
+            return
+        arrays = [ self.pa.array(values, type=field.type)
+                   for values, field in zip(self.columns.values(),
+                                            self.schema) ]
+        batch = self.pa.record_batch(arrays, schema=self.schema)
+        self.writer.write_batch(batch)
+
+        for values in self.columns.values():
+            values.clear()
+        self.n_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def _read_results(filename, *, parse=True):
+    """
+    Read the rows of a results file written by mgsearch or mgmanysearch,
+    in any of the output formats, with values converted to their column
+    types; if 'parse' is False, CSV values are left as they were written.
+    Raises ValueError if the format needs pyarrow and it is not installed.
+    """
+    if filename.endswith(('.parquet', '.arrow', '.feather')):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError(f"reading '{filename}' requires pyarrow; please install it")
+
+        if filename.endswith('.parquet'):
+            table = pyarrow.parquet.read_table(filename)
+        else:
+            table = pyarrow.ipc.open_file(filename).read_all()
+        return table.to_pylist()
+
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', newline='') as fp:
+        rows = list(csv.DictReader(fp))
+    if parse:
+        rows = [ _parse_row(row) for row in rows ]
+    return rows
+
+
+def _parse_row(row):
+    """
+    Convert the values in a CSV results row to their column types; values
+    that are not strings are left as they are.
+    """
+    for name, value in row.items():
+        type_name = COLUMN_TYPES.get(name, 'string')
+        if not isinstance(value, str) or value == '' or type_name == 'string':
+            continue
+        if type_name == 'bool_':
+            row[name] = value == 'True'
+        elif type_name == 'int64':
+            try:
+                row[name] = int(value)
+            except ValueError:
+                row[name] = int(float(value))
+        else:
+            row[name] = float(value)
+    return row
+
+
+class _PreviousResults:
+    """
+    Results from an earlier search, for mgmanysearch --previous: the rows,
+    with values as read, and 'covered', the md5s of the queries searched
+    in each metagenome (by md5).
+
+    Filtered and zero-overlap pairs leave no rows, so the queries searched
+    are taken from the manifest written next to the results (see
+    _write_searched) if the earlier search used the same filter
+    'settings'. Otherwise only pairs with rows count as searched, and
+    'from_manifest' is False.
+    """
+    def __init__(self, rows, *, manifest=None, settings=None):
+        self.rows = rows
+        covered = collections.defaultdict(set)
+        for row in rows:
+            try:
+                covered[row['match_md5']].add(row['query_md5'])
+            except KeyError:
+                raise ValueError("results must have 'query_md5' and 'match_md5' columns")
+
+        self.from_manifest = manifest is not None and \
+            manifest['settings'] == _normalize(settings)
+        if self.from_manifest:
+            for match_md5, query_md5s in manifest['searched'].items():
+                covered[match_md5].update(query_md5s)
+        self.covered = dict(covered)
+
+    @classmethod
+    def load(cls, filename, *, settings):
+        "Load results and their manifest, if any, from 'filename'."
+        return cls(_read_results(filename, parse=False),
+                   manifest=_read_searched(filename + SEARCHED_EXT),
+                   settings=settings)
+
+    def complete_matches(self, queries):
+        "Return the md5s of metagenomes already searched with all 'queries'."
+        query_md5s = { query.md5 for query in queries }
+        return { match_md5 for match_md5, done in self.covered.items()
+                 if query_md5s <= done }
+
+    def merged_searched(self, searched):
+        """
+        Return the queries searched in each metagenome in 'searched',
+        including those searched in the earlier search.
+        """
+        return { md5: self.covered.get(md5, set()) | query_md5s
+                 for md5, query_md5s in searched.items() }
+
+
+#
+# manifest of the (query, metagenome) pairs searched by mgmanysearch,
+# written to '<output>.searched' as JSON: the filter settings, and the
+# md5s of the queries searched in each metagenome md5.
+#
+
+SEARCHED_EXT = '.searched'
+SEARCHED_VERSION = 1
+
+def _normalize(value):
+    "Normalize types as a JSON round trip would."
+    return json.loads(json.dumps(value))
+
+
+def _read_searched(filename):
+    "Read a manifest written by _write_searched; None if there is none."
+    try:
+        with open(filename) as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        raise ValueError(f"cannot read '{filename}'")
+    if manifest.get('version') != SEARCHED_VERSION:
+        return None
+    return manifest
+
+
+def _write_searched(filename, *, settings, searched):
+    manifest = dict(version=SEARCHED_VERSION, settings=settings,
+                    searched={ md5: sorted(query_md5s)
+                               for md5, query_md5s in searched.items() })
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_filename, filename)
+
+
+class _ResultsCache:
+    """
+    A SQLite file of scored (query, metagenome) pairs, for --results-cache,
+    keyed by query_md5, match_md5, ksize, moltype and scaled. Each entry
+    holds the comparison columns calculated by _batch_score for one pair,
+    and whether they include the ANI columns.
+
+    The database connection is opened on first use in each process, so
+    the cache can be passed to worker processes, whether they are forked
+    or receive a pickled copy.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+        self._pid = None
+        # check that the cache is usable, without keeping a connection
+        # open for forked worker processes to inherit.
+        self._open().close()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_conn'] = None
+        return state
+
+    def _open(self):
+        conn = sqlite3.connect(self.filename, timeout=60)
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS results
+                            (match_md5 TEXT, ksize INTEGER, moltype TEXT,
+                             scaled INTEGER, query_md5 TEXT, ani INTEGER,
+                             results TEXT,
+                             PRIMARY KEY (match_md5, ksize, moltype,
+                                          scaled, query_md5))""")
+        return conn
+
+    def _connect(self):
+        "Return this process's connection, opening it if need be."
+        if self._conn is None or self._pid != os.getpid():
+            # a connection inherited across fork must not be used.
+            self._conn = self._open()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, queries, metag, *, ani=True):
+        """
+        Return {query_idx: results_d} for the 'queries' already scored
+        against 'metag'; if 'ani' is True, only entries with ANI count.
+        """
+        cursor = self._connect().execute(
+            """SELECT query_md5, ani, results FROM results
+               WHERE match_md5=? AND ksize=? AND moltype=? AND scaled=?""",
+            (metag.md5, metag.ksize, metag.moltype, metag.scaled))
+        found = { query_md5: results for query_md5, has_ani, results in cursor
+                  if has_ani or not ani }
+
+        cached = {}
+        for query_idx, query in enumerate(queries):
+            results = found.get(query.md5)
+            if results is None:
+                continue
+            results_d = json.loads(results)
+            if not ani:
+                for name in ANI_COLUMNS:
+                    results_d.pop(name, None)
+            results_d.update(query_filename=query.filename,
+                             query_name=query.name)
+            cached[query_idx] = results_d
+        return cached
+
+    def put(self, queries, metag, scores, *, ani=True):
+        "Store the (query_idx, results_d) pairs in 'scores' for 'metag'."
+        entries = []
+        for query_idx, results_d in scores:
+            results = { name: value for name, value in results_d.items()
+                        if name not in ('query_filename', 'query_name') }
+            entries.append((metag.md5, metag.ksize, metag.moltype,
+                            metag.scaled, queries[query_idx].md5, int(ani),
+                            json.dumps(results)))
+        conn = self._connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", entries)
+
+
+def _open_results_cache(filename):
+    """
+    Open a _ResultsCache in 'filename'; returns None if 'filename' is None.
+    Raises ValueError if it cannot be used.
+    """
+    if not filename:
+        return None
+    try:
+        return _ResultsCache(filename)
+    except sqlite3.Error as exc:
+        raise ValueError(f"cannot use results cache '{filename}': {exc}")
+
+
+CHECKPOINT_VERSION = 1
+
+class _Checkpoint:
+    """
+    Progress record for a resumable mgmanysearch run, kept as JSON lines:
+    a header with the output file and search settings, and then one line
+    for each completed metagenome file, with its metagenome md5s and the
+    size of the CSV output once its rows were written.
+
+    On restart, the output is truncated to the last recorded size, so
+    rows from a partly searched file are neither duplicated nor lost, and
+    the files in 'done' are skipped.
+    """
+    def __init__(self, filename, *, output, settings):
+        self.filename = filename
+        self.done = set()
+        self.offset = None
+
+        header = dict(version=CHECKPOINT_VERSION,
+                      output=os.path.abspath(output),
+                      settings=settings)
+        header = json.loads(json.dumps(header))     # normalize types
+        if os.path.exists(filename):
+            self._load(header)
+
+        if self.offset is None:
+            with open(filename, 'w') as fp:
+                fp.write(json.dumps(header) + '\n')
+        self.fp = open(filename, 'a')
+        self._md5s = {}
+
+    def _load(self, header):
+        with open(self.filename, 'rb') as fp:
+            lines = fp.readlines()
+        if not lines:
+            return
+
+        if json.loads(lines[0]) != header:
+            raise ValueError(f"checkpoint '{self.filename}' was written by a different search; remove it to start over")
+
+        valid_size = len(lines[0])
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break                   # interrupted while writing
+            self.done.add(record['filename'])
+            self.offset = record['offset']
+            valid_size += len(line)
+
+        # drop any partly written record.
+        if self.offset is not None:
+            with open(self.filename, 'r+b') as fp:
+                fp.truncate(valid_size)
+
+        output = header['output']
+        if self.offset is not None and \
+           (not os.path.exists(output) or os.path.getsize(output) < self.offset):
+            raise ValueError(f"output '{output}' is missing or shorter than recorded in checkpoint '{self.filename}'; cannot resume")
+
+    def update(self, rows):
+        "Record results for the current metagenome file."
+        for _, results_d in rows:
+            self._md5s[results_d['match_md5']] = True
 
+    def complete(self, metag_filename, out_w):
+        """
+        Record that 'metag_filename' is complete, once all its rows have
+        been written to 'out_w' - even if it had none.
+        """
+        record = dict(filename=metag_filename, md5s=list(self._md5s),
+                      offset=out_w.sync())
+        self.fp.write(json.dumps(record) + '\n')
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+        self.done.add(metag_filename)
+        self._md5s = {}
+
+    def finish(self):
+        self.fp.close()
+
+
+def _needs_ani(columns, *, output, output_ani):
+    "Are any ANI values displayed or written to the CSV?"
+    if output_ani:
+        return True
+    return bool(output) and any(c in ANI_COLUMNS for c in columns)
+
+
+def _as_list(value):
+    "Return a ksize or scaled argument as a list of values."
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _format_list(value):
+    return ','.join(str(x) for x in _as_list(value))
+
+
+def _load_query(query_filename, *, ksize, moltype, scaled):
+    """
+    Load the single query sketch in 'query_filename' at ksize/moltype,
+    flattened and downsampled to 'scaled'. Raises ValueError if there is
+    not exactly one such sketch, or if it cannot be downsampled.
+    """
     query_ss = sourmash.load_file_as_index(query_filename)
     query_ss = query_ss.select(ksize=ksize, moltype=moltype, scaled=scaled)
     if not query_ss:
-        error(f"ERROR: cannot find query sketch at ksize={ksize}/moltype={moltype}")
-        return -1
+        raise ValueError(f"cannot find query sketch at ksize={ksize}/moltype={moltype}")
 
     query_ss = list(query_ss.signatures())
     if len(query_ss) > 1:
-        error(f"ERROR: can only have one query; {len(query_ss)} found.")
-        return -1
+        raise ValueError(f"can only have one query; {len(query_ss)} found.")
 
     query_ss = query_ss[0]
-    print(f"Loaded query signature: {query_ss._display_name(screen_width - 25)}")
-
     query_mh = query_ss.minhash
     if query_mh.track_abundance:
         notify(f"WARNING: query sketch '{query_ss.name}' has abundance; ignoring.")
@@ -196,84 +990,198 @@ def mgsearch(query_filename, against_list, *,
         try:
             query_mh = query_mh.downsample(scaled=scaled)
         except ValueError:
-            notify(f"ERROR: cannot downsample query '{query_ss.name}' to {scaled}")
-            return -1
+            raise ValueError(f"cannot downsample query '{query_ss.name}' to {scaled}")
         query_ss = query_ss.to_mutable()
         query_ss.minhash = query_mh
 
-    if output:
-        out_fp = open(output, 'w', newline='')
-        out_w = csv.DictWriter(out_fp, fieldnames=COLUMNS)
-        out_w.writeheader()
-    else:
-        out_fp = None
-        out_w = None
+    return query_ss
+
+
+def _display_results(output, *, quiet, show_results):
+    "Are results displayed on stdout, as well as written to 'output'?"
+    if quiet:
+        return False
+    return show_results or not output
+
+
+def _show_progress(progress, *, quiet, display):
+    """
+    Is progress reported? Yes if 'progress' is True; by default, only when
+    results aren't displayed and stderr is a terminal.
+    """
+    if progress is not None:
+        return progress
+    return not quiet and not display and sys.stderr.isatty()
+
+
+def mgsearch(query_filename, against_list, *,
+             ksize=31, moltype='DNA', scaled=1000, output=None,
+             require_abundance=False, output_ani=False, cores=1,
+             prefetch=2, prefetch_mb=None, read_ahead=1,
+             emit_skipped=False, timings=None, columns=None, threshold_bp=0,
+             min_containment=0.0, top_k=None, results_cache=None,
+             metag_cache=None, quiet=False, show_results=False,
+             progress=None):
+    """
+    Search for a single genome in many metagenomes.
+
+    'ksize' and 'scaled' may each be a list, to search at every
+    combination of them while reading each metagenome file once.
+
+    If 'cores' > 1, metagenomes are searched in parallel processes; output
+    is identical to a serial run. Otherwise, up to 'prefetch' metagenome
+    sketches (and at most 'prefetch_mb' MB) are loaded ahead of searching,
+    from up to 'read_ahead' files at once.
+    Metagenomes ruled out by a Bloom filter sidecar are not reported unless
+    'emit_skipped' is True. If 'timings' is a _Timings object, time spent
+    in each phase of the search is recorded there.
+
+    'columns' selects the CSV columns (see _select_columns); ANI is only
+    estimated if it is displayed or written out.
+
+    Only metagenomes with an overlap of at least 'threshold_bp' and a
+    containment of at least 'min_containment' are reported; if 'top_k' is
+    set, only the 'top_k' best of those are reported.
+
+    If 'results_cache' is a filename, results are cached there in a SQLite
+    database (see _ResultsCache), and pairs found there are not scored
+    again. If 'metag_cache' is a directory, flattened & downsampled
+    metagenome sketches are cached there for use by later runs.
+
+    Results are displayed on stdout unless 'quiet' is True or they are
+    written to 'output', in which case 'show_results' displays them
+    anyway. See _Progress for 'progress'.
+    """
+    screen_width = _get_screen_width()
+    timings = timings or _NO_TIMINGS
+
+    try:
+        columns = _select_columns(columns)
+    except ValueError as exc:
+        error(f"ERROR: {exc}")
+        return -1
+    ani = _needs_ani(columns, output=output, output_ani=output_ani)
+
+    # load the query once for each ksize/scaled combination.
+    query_groups = []
+    with timings.phase('load_queries'):
+        for group_ksize, group_scaled in itertools.product(_as_list(ksize),
+                                                           _as_list(scaled)):
+            try:
+                query_ss = _load_query(query_filename, ksize=group_ksize,
+                                       moltype=moltype, scaled=group_scaled)
+            except ValueError as exc:
+                error(f"ERROR: {exc}")
+                return -1
+
+            if not query_groups and not quiet:
+                print(f"Loaded query signature: {query_ss._display_name(screen_width - 25)}")
+            query_groups.append((group_ksize, group_scaled,
+                                 [_PreparedQuery.from_signature(query_ss)]))
+
+    with timings.phase('index_queries'):
+        query_groups = _QueryGroups(query_groups)
+
+    try:
+        results_cache = _open_results_cache(results_cache)
+        out_w = _open_output(output, columns)
+    except ValueError as exc:
+        error(f"ERROR: {exc}")
+        return -1
 
     # go through metagenomes one by one
 
     # display stuff
     first = True
+    display = _display_results(output, quiet=quiet,
+                               show_results=show_results)
+    progress = _Progress(len(against_list), 1,
+                         enabled=_show_progress(progress, quiet=quiet,
+                                                display=display))
 
     # missing abundances?
     missed_abundance = False
     
-    for metag_filename in against_list:
-        try:
-            results_d = _search_metag(query_ss, metag_filename,
-                                      ksize=ksize, scaled=scaled,
-                                      require_abundance=require_abundance,
-                                      screen_width=screen_width,
-                                      field_width=41)
-            results_d = list(results_d)[0]
-        except MismatchScaled:
-            error(f"Unable to run comparison for '{query_ss.name}'; maybe set --scaled?")
-            return -1
+    searcher = ContainmentSearcher(against_list,
+                                   require_abundance=require_abundance,
+                                   preload=False, cache_dir=metag_cache)
+    try:
+        search_results = searcher._search_rows(query_groups,
+                                               first_only=True,
+                                               threshold_bp=threshold_bp,
+                                               min_containment=min_containment,
+                                               top_k=top_k,
+                                               results_cache=results_cache,
+                                               cores=cores,
+                                               emit_skipped=emit_skipped,
+                                               prefetch=prefetch,
+                                               prefetch_mb=prefetch_mb,
+                                               read_ahead=read_ahead,
+                                               timings=timings,
+                                               ani=ani,
+                                               screen_width=screen_width,
+                                               field_width=41)
 
-        name = results_d['display_name']
-        del results_d['display_name']
+        for metag_filename, rows in search_results:
+            progress.update(metag_filename)
 
-        has_abundance = results_d['average_abund'] != ''
+            # only the first sketch in each metagenome file (at each
+            # ksize) is reported
+            for _, results_d in rows:
+                with timings.phase('output'):
+                    name = results_d['display_name']
+                    del results_d['display_name']
 
-        # write out CSV
-        if out_w:
-            out_w.writerow(results_d)
-
-        # displaying first result?
-        if first:
-            print("")
-            if output_ani:
-                print("  ANI    avg_abund   p_metag   metagenome name")
-                print("-------- ---------   -------   ---------------")
-            else:
-                print("p_genome avg_abund   p_metag   metagenome name")
-                print("-------- ---------   -------   ---------------")
-            first = False
+                    # write out CSV
+                    if out_w:
+                        out_w.writerow(results_d)
 
-        if output_ani:
-            ani = results_d['genome_containment_ani']
-            display_ani = f"{ani*100:.1f}"
-        else:
-            f_genome_found = results_d['f_query']
-            pct_genome = f"{f_genome_found*100:.1f}"
+                    if not display:
+                        continue
 
-        if has_abundance:
-            f_metag_weighted = results_d['f_match_weighted']
-            pct_metag = f"{f_metag_weighted*100:.1f}%"
+                    has_abundance = results_d['average_abund'] != ''
 
-            avg_abund = results_d['average_abund']
-            avg_abund = f"{avg_abund:.1f}"
-        else:
-            avg_abund = "N/A"
-            pct_metag = "N/A"
+                    # displaying first result?
+                    if first:
+                        print("")
+                        if output_ani:
+                            print("  ANI    avg_abund   p_metag   metagenome name")
+                            print("-------- ---------   -------   ---------------")
+                        else:
+                            print("p_genome avg_abund   p_metag   metagenome name")
+                            print("-------- ---------   -------   ---------------")
+                        first = False
 
-        if output_ani:
-            print(f'{display_ani:>6}%  {avg_abund:>6}     {pct_metag:>6}     {name}')
-        else:
-            print(f'{pct_genome:>6}%  {avg_abund:>6}     {pct_metag:>6}     {name}')
+                    if output_ani:
+                        ani = results_d['genome_containment_ani']
+                        display_ani = f"{ani*100:.1f}"
+                    else:
+                        f_genome_found = results_d['f_query']
+                        pct_genome = f"{f_genome_found*100:.1f}"
+
+                    if has_abundance:
+                        f_metag_weighted = results_d['f_match_weighted']
+                        pct_metag = f"{f_metag_weighted*100:.1f}%"
+
+                        avg_abund = results_d['average_abund']
+                        avg_abund = f"{avg_abund:.1f}"
+                    else:
+                        avg_abund = "N/A"
+                        pct_metag = "N/A"
+
+                    if output_ani:
+                        print(f'{display_ani:>6}%  {avg_abund:>6}     {pct_metag:>6}     {name}')
+                    else:
+                        print(f'{pct_genome:>6}%  {avg_abund:>6}     {pct_metag:>6}     {name}')
+    except MismatchScaled as exc:
+        progress.finish()
+        error(f"Unable to run comparison for '{exc}'; maybe set --scaled?")
+        return -1
+    progress.finish()
 
-    # close CSV file
-    if out_fp:
-        out_fp.close()
+    # close output file
+    if out_w:
+        out_w.close()
 
     # notify user that there were columns that were not filled in
     if missed_abundance:
@@ -283,85 +1191,237 @@ def mgsearch(query_filename, against_list, *,
 
 def mg_many_search(query_filenames, against_list, *,
                    ksize=31, moltype='DNA', scaled=1000, output=None,
-                   require_abundance=False, output_ani=False):
+                   require_abundance=False, output_ani=False, cores=1,
+                   query_cache=None, prefetch=2, prefetch_mb=None,
+                   read_ahead=1, emit_skipped=False, timings=None, columns=None,
+                   threshold_bp=0, min_containment=0.0, top_k=None,
+                   top_k_by='query', checkpoint=None, previous=None,
+                   results_cache=None, metag_cache=None, quiet=False,
+                   show_results=False, progress=None):
     """
     Search multiple genomes in many metagenomes, loading each metagenome
     once.
+
+    'ksize' and 'scaled' may each be a list, to search at every
+    combination of them while reading each metagenome file once.
+
+    If 'cores' > 1, metagenomes are searched in parallel processes; output
+    is identical to a serial run. Otherwise, up to 'prefetch' metagenome
+    sketches (and at most 'prefetch_mb' MB) are loaded ahead of searching,
+    from up to 'read_ahead' files at once.
+    If 'query_cache' is a directory, prepared query sketches are cached
+    there for use by later runs. Metagenomes ruled out by a Bloom filter
+    sidecar are not reported unless 'emit_skipped' is True. If 'timings'
+    is a _Timings object, time spent in each phase of the search is
+    recorded there.
+
+    'columns' selects the CSV columns (see _select_columns); ANI is only
+    estimated if it is displayed or written out.
+
+    Only (query, metagenome) pairs with an overlap of at least
+    'threshold_bp' and a containment of at least 'min_containment' are
+    reported. If 'top_k' is set, only the 'top_k' best metagenomes for
+    each query ('top_k_by="query"') or the 'top_k' best queries for each
+    metagenome ('top_k_by="metagenome"') are reported. Per-query top-k
+    results are output after all metagenomes have been searched.
+
+    If 'checkpoint' is set, completed metagenome files are recorded there
+    (see _Checkpoint), and a search that was interrupted is resumed:
+    completed files are skipped, and new results are appended to the
+    CSV output.
+
+    If 'output' is set, the (query, metagenome) pairs searched are recorded
+    in '<output>.searched' (see _write_searched), unless the search was
+    resumed from a checkpoint. If 'previous' is a
+    results file from an earlier search, only the pairs it did not search
+    are scored; the new results are written to the output, followed by
+    the earlier rows for the metagenomes that were searched again, as
+    they were read.
+
+    If 'results_cache' is a filename, results are cached there in a SQLite
+    database (see _ResultsCache), and pairs found there are not scored
+    again. If 'metag_cache' is a directory, flattened & downsampled
+    metagenome sketches are cached there for use by later runs.
+
+    Results are displayed on stdout unless 'quiet' is True or they are
+    written to 'output', in which case 'show_results' displays them
+    anyway. See _Progress for 'progress'.
     """
     screen_width = _get_screen_width()
+    timings = timings or _NO_TIMINGS
 
-    query_sigs = []
-    for query_filename in query_filenames:
-        query_ss = sourmash.load_file_as_index(query_filename)
-        query_ss = query_ss.select(ksize=ksize, moltype=moltype)
-        query_sigs.extend(query_ss.signatures())
-
-    if not query_sigs:
-        error(f"ERROR: cannot find any query sketches at ksize={ksize}/moltype={moltype}")
+    try:
+        columns = _select_columns(columns)
+    except ValueError as exc:
+        error(f"ERROR: {exc}")
         return -1
+    ani = _needs_ani(columns, output=output, output_ani=output_ani)
 
-    print(f"Loaded {len(query_sigs)} query signatures.")
+    if checkpoint:
+        if previous:
+            error("ERROR: --checkpoint cannot be used with --previous")
+            return -1
+        if not output or output.endswith(('.gz', '.parquet', '.arrow', '.feather')):
+            error("ERROR: --checkpoint requires CSV output (-o/--output)")
+            return -1
+        if top_k and top_k_by == 'query':
+            error("ERROR: --checkpoint cannot be used with --top-k per query")
+            return -1
 
-    # flatten and downsample each query sig if necessary.
-    new_query_sigs = []
-    for query_ss in query_sigs:
-        query_mh = query_ss.minhash
+    # load, flatten and downsample each query sig if necessary, once for
+    # each ksize/scaled combination.
+    query_groups = []
+    try:
+        with timings.phase('load_queries'):
+            for group_ksize, group_scaled in itertools.product(_as_list(ksize),
+                                                               _as_list(scaled)):
+                group = []
+                for query_filename in query_filenames:
+                    group.extend(_load_queries(query_filename,
+                                               ksize=group_ksize,
+                                               moltype=moltype,
+                                               scaled=group_scaled,
+                                               cache_dir=query_cache))
+                if group:
+                    query_groups.append((group_ksize, group_scaled, group))
+    except ValueError as exc:
+        notify(f"ERROR: {exc}")
+        return -1
 
-        # replace with flattened query
-        if query_mh.track_abundance:
-            query_ss = query_ss.to_mutable()
-            notify(f"WARNING: query sketch '{query_ss.name}' has abundance; ignoring.")
-            query_mh = query_mh.flatten()
-            query_ss.minhash = query_mh
+    if not query_groups:
+        error(f"ERROR: cannot find any query sketches at ksize={_format_list(ksize)}/moltype={moltype}")
+        return -1
 
-        # replace with downsampled query
-        if scaled is not None and scaled != query_mh.scaled:
-            try:
-                query_mh = query_mh.downsample(scaled=scaled)
-            except ValueError:
-                notify(f"ERROR: cannot downsample query '{query_ss.name}' to {scaled}")
-                return -1
-            query_ss = query_ss.to_mutable()
-            query_ss.minhash = query_mh
+    with timings.phase('index_queries'):
+        query_groups = _QueryGroups(query_groups)
+    queries = query_groups.queries
+
+    if not quiet:
+        print(f"Loaded {len(queries)} query signatures.")
+
+    # load earlier results, and find the metagenomes they fully cover.
+    settings = _normalize(dict(threshold_bp=threshold_bp,
+                               min_containment=min_containment,
+                               top_k=top_k,
+                               top_k_by=top_k_by if top_k else None))
+    previous_results = None
+    skip_md5s = None
+    if previous:
+        try:
+            previous_results = _PreviousResults.load(previous,
+                                                     settings=settings)
+        except (OSError, ValueError) as exc:
+            error(f"ERROR: cannot read previous results from '{previous}': {exc}")
+            return -1
+        if not previous_results.from_manifest:
+            notify(f"WARNING: no '{SEARCHED_EXT}' manifest with the same filters for '{previous}'; pairs without results there will be searched again.")
+        skip_md5s = previous_results.complete_matches(queries)
+        notify(f"loaded {len(previous_results.rows)} previous results from '{previous}'; {len(skip_md5s)} metagenomes are already fully searched.")
+    searched = {} if output else None
+
+    try:
+        results_cache = _open_results_cache(results_cache)
+    except ValueError as exc:
+        error(f"ERROR: {exc}")
+        return -1
 
-        new_query_sigs.append(query_ss)
+    # resume from a checkpoint?
+    checkpoint_state = None
+    append_at = None
+    if checkpoint:
+        checkpoint_settings = dict(queries=[ query.md5 for query in queries ],
+                                   columns=columns, ksize=ksize,
+                                   moltype=moltype, scaled=scaled,
+                                   threshold_bp=threshold_bp,
+                                   min_containment=min_containment,
+                                   top_k=top_k, emit_skipped=emit_skipped)
+        try:
+            checkpoint_state = _Checkpoint(checkpoint, output=output,
+                                           settings=checkpoint_settings)
+        except ValueError as exc:
+            error(f"ERROR: {exc}")
+            return -1
 
-    query_sigs = new_query_sigs
+        append_at = checkpoint_state.offset
+        if checkpoint_state.done:
+            # the pairs searched before the interruption are not known,
+            # so no manifest is written; remove any stale one.
+            searched = None
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(output + SEARCHED_EXT)
+            n_metags = len(against_list)
+            against_list = [ metag_filename for metag_filename in against_list
+                             if metag_filename not in checkpoint_state.done ]
+            notify(f"resuming from checkpoint '{checkpoint}': skipping {n_metags - len(against_list)} completed metagenome files.")
 
     # prepare output
-    if output:
-        out_fp = open(output, 'w', newline='')
-        out_w = csv.DictWriter(out_fp, fieldnames=COLUMNS)
-        out_w.writeheader()
-    else:
-        out_fp = None
-        out_w = None
+    try:
+        out_w = _open_output(output, columns, append_at=append_at)
+    except ValueError as exc:
+        error(f"ERROR: {exc}")
+        return -1
 
     # display stuff
     first = True
+    display = _display_results(output, quiet=quiet,
+                               show_results=show_results)
+    if display:
+        query_names = [ query._display_name(17) for query in queries ]
+    progress = _Progress(len(against_list), len(queries),
+                         enabled=_show_progress(progress, quiet=quiet,
+                                                display=display))
 
     # came across missing abundances?
     missed_abundance = False
 
     ### go through metagenomes one by one
-    for metag_filename in against_list:
-        # for each metagenome, iterate over query sigs
-        for query_ss in query_sigs:
-            try:
-                for results_d in _search_metag(query_ss, metag_filename,
-                                               ksize=ksize, scaled=scaled,
-                                               require_abundance=require_abundance,
+    searcher = ContainmentSearcher(against_list,
+                                   require_abundance=require_abundance,
+                                   preload=False, cache_dir=metag_cache)
+    try:
+        search_results = searcher._search_rows(query_groups,
+                                               threshold_bp=threshold_bp,
+                                               min_containment=min_containment,
+                                               top_k=top_k,
+                                               top_k_by=top_k_by,
+                                               skip_md5s=skip_md5s,
+                                               covered=previous_results.covered if previous_results else None,
+                                               searched=searched,
+                                               results_cache=results_cache,
+                                               cores=cores,
+                                               emit_skipped=emit_skipped,
+                                               prefetch=prefetch,
+                                               prefetch_mb=prefetch_mb,
+                                               read_ahead=read_ahead,
+                                               file_ends=checkpoint_state is not None,
+                                               timings=timings,
+                                               ani=ani,
                                                screen_width=screen_width,
-                                               field_width=21):
+                                               field_width=21)
+
+        for metag_filename, rows in search_results:
+            if rows is None:            # all rows for the file are written
+                checkpoint_state.complete(metag_filename, out_w)
+                continue
+            progress.update(metag_filename)
+            if checkpoint_state:
+                checkpoint_state.update(rows)
+
+            # each metagenome is loaded once; iterate over query results
+            for query_idx, results_d in rows:
+                with timings.phase('output'):
                     name = results_d['display_name']
                     del results_d['display_name']
 
-                    has_abundance = results_d['average_abund'] != ''
-
                     # write out CSV
                     if out_w:
                         out_w.writerow(results_d)
 
+                    if not display:
+                        continue
+
+                    has_abundance = results_d['average_abund'] != ''
+
                     #
                     # display!
                     #
@@ -394,21 +1454,40 @@ def mg_many_search(query_filenames, against_list, *,
                         avg_abund = "N/A"
                         pct_metag = "N/A"
 
-                    query_name = query_ss._display_name(17)
+                    query_name = query_names[query_idx]
                     if output_ani:
                         print(f'{query_name:<17} {display_ani:>6}%  {avg_abund:>6}     {pct_metag:>6}     {name}')
                     else:
                         print(f'{query_name:<17} {pct_genome:>6}%  {avg_abund:>6}     {pct_metag:>6}     {name}')
-
-            except MismatchScaled:
-                error(f"Unable to run comparison for '{query_ss.name}'; maybe set --scaled?")
-                return -1
             # end each query genome
         # end each subject metagenome
 
-    # close CSV file
-    if out_fp:
-        out_fp.close()
+        if checkpoint_state:
+            checkpoint_state.finish()
+    except MismatchScaled as exc:
+        progress.finish()
+        error(f"Unable to run comparison for '{exc}'; maybe set --scaled?")
+        return -1
+    progress.finish()
+
+    # merged output ends with the earlier rows for metagenomes that are
+    # still in the input, copied as they were read.
+    if previous_results and searched is not None:
+        searched = previous_results.merged_searched(searched)
+        if out_w:
+            with timings.phase('output'):
+                for row in previous_results.rows:
+                    if row['match_md5'] in searched:
+                        if isinstance(out_w, _ArrowOutput):
+                            row = _parse_row(dict(row))
+                        out_w.writerow(row)
+
+    # close output file
+    if out_w:
+        out_w.close()
+    if searched is not None:
+        _write_searched(output + SEARCHED_EXT, settings=settings,
+                        searched=searched)
 
     # notify user that there were columns that were not filled in
     if missed_abundance:
@@ -416,65 +1495,2366 @@ def mg_many_search(query_filenames, against_list, *,
         notify("** Note: N/A in column values indicate metagenomes w/o abundance tracking.")
 
 
-def _search_metag(query_ss, metag_filename, *, ksize=None, scaled=None,
-                  require_abundance=None,
-                  screen_width=80, field_width=41):
+def mgprepare(metag_filenames, *, output_dir, ksize=31, moltype='DNA',
+              scaled=None, bloom=False):
     """
-    Do the actual search &c for query in a metagenome.
+    Convert metagenome sketches into .mgsketch files, which mgsearch and
+    mgmanysearch memory-map instead of parsing.
+
+    Each input file is written to '<output_dir>/<basename>.mgsketch',
+    containing all of its sketches at the given ksize/moltype, downsampled
+    to 'scaled' if given. If 'bloom' is True, a Bloom filter sidecar is
+    written to '<output_dir>/<basename>.mgsketch.bloom'. Input files with
+    the same basename are an error, as they would overwrite each other.
     """
-    query_mh = query_ss.minhash
+    out_filenames = {}
+    for metag_filename in metag_filenames:
+        out_filename = os.path.join(output_dir,
+                                    os.path.basename(metag_filename) + MGSKETCH_EXT)
+        if out_filename in out_filenames:
+            error(f"ERROR: '{out_filenames[out_filename]}' and '{metag_filename}' would both be written to '{out_filename}'; please rename one of them.")
+            return -1
+        out_filenames[out_filename] = metag_filename
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    n_written = 0
+    for out_filename, metag_filename in out_filenames.items():
+        idx = sourmash.load_file_as_index(metag_filename)
+        idx = idx.select(ksize=ksize, moltype=moltype)
+
+        metags = []
+        for metag in idx.signatures():
+            if scaled and metag.minhash.scaled != scaled:
+                try:
+                    metag_mh = metag.minhash.downsample(scaled=scaled)
+                except ValueError:
+                    error(f"ERROR: cannot downsample '{metag.name}' to {scaled}")
+                    return -1
+                metag = metag.to_mutable()
+                metag.minhash = metag_mh
+            metags.append(_PreparedMetagenome.from_signature(metag))
+
+        if not metags:
+            notify(f"WARNING: no sketches at ksize={ksize}/moltype={moltype} in '{metag_filename}'; skipping.")
+            continue
+
+        _write_mgsketch(out_filename, metags)
+        if bloom:
+            all_hashes = np.concatenate([ metag.hashes for metag in metags ])
+            _write_bloom(out_filename + BLOOM_EXT,
+                         _BloomFilter.build(np.unique(all_hashes)))
+        notify(f"wrote {len(metags)} sketches from '{metag_filename}' to '{out_filename}'")
+        n_written += 1
+
+    if not n_written:
+        error("ERROR: no metagenome sketches found.")
+        return -1
 
-    metags = sourmash.load_file_as_signatures(metag_filename, ksize=ksize)
-    for metag in metags:
-        # check to make sure if metag needs & has abundance info
-        if require_abundance:
-            if not metag.minhash.track_abundance:
-                raise ValueError(f"sketch in '{metag_filename}' must have abundance information")
-
-        has_abundance = False
-        if metag.minhash.track_abundance:
-            has_abundance = True
+
+def mg_db_search(metag_filename, db_filenames, *, ksize=31, moltype='DNA',
+                 scaled=None, output=None, require_abundance=False,
+                 output_ani=False, batch_size=10000, columns=None,
+                 threshold_bp=0, min_containment=0.0, top_k=None,
+                 quiet=False, show_results=False, timings=None):
+    """
+    Search for the genomes in large databases that are in one metagenome:
+    the reverse of mgsearch.
+
+    Each database is searched with the flattened metagenome sketch using
+    the database's own prefetch, so SBT and LCA databases use their
+    indices, and only genomes sharing at least 'threshold_bp' (and at
+    least one hash) are candidates. Candidates are scored against the
+    metagenome 'batch_size' at a time, producing the usual columns, with
+    each genome as the query and the metagenome as the match.
+
+    Genomes are compared at 'scaled' if given, or else at the scaled of the
+    metagenome sketch; genomes with a coarser scaled are compared at their
+    own scaled, against the metagenome downsampled to match. Only genomes with a containment of at least
+    'min_containment' are reported; if 'top_k' is set, only the 'top_k'
+    best of those are reported, after all databases are searched.
+    """
+    screen_width = _get_screen_width()
+    timings = timings or _NO_TIMINGS
+
+    try:
+        columns = _select_columns(columns)
+    except ValueError as exc:
+        error(f"ERROR: {exc}")
+        return -1
+    ani = _needs_ani(columns, output=output, output_ani=output_ani)
+    display = _display_results(output, quiet=quiet,
+                               show_results=show_results)
+
+    try:
+        with timings.phase('load_metagenome'):
+            metags = list(_load_metagenomes(metag_filename, ksize=ksize,
+                                            scaled=scaled))
+    except ValueError as exc:
+        error(f"ERROR: cannot load metagenome '{metag_filename}': {exc}")
+        return -1
+    if not metags:
+        error(f"ERROR: cannot find metagenome sketch at ksize={ksize}/moltype={moltype}")
+        return -1
+    if len(metags) > 1:
+        error(f"ERROR: can only have one metagenome; {len(metags)} found.")
+        return -1
+    metag, = metags
+    if require_abundance and not metag.track_abundance:
+        error(f"ERROR: sketch in '{metag_filename}' must have abundance information")
+        return -1
+    if not quiet:
+        print(f"Loaded metagenome signature: {metag._display_name(screen_width - 29)}")
+
+    try:
+        out_w = _open_output(output, columns)
+    except ValueError as exc:
+        error(f"ERROR: {exc}")
+        return -1
+
+    first = True
+    n_candidates = 0
+    try:
+        candidates = _db_candidates(db_filenames, metag, ksize=ksize,
+                                    moltype=moltype, threshold_bp=threshold_bp)
+        batches = _db_score_batches(candidates, metag_filename, metag,
+                                    batch_size=batch_size, ani=ani,
+                                    threshold_bp=threshold_bp,
+                                    min_containment=min_containment,
+                                    screen_width=screen_width,
+                                    timings=timings)
+        if top_k:
+            batches = [ heapq.nlargest(top_k,
+                                       (row for rows in batches for row in rows),
+                                       key=lambda row: _rank_key(row[1])) ]
+            batches[0].sort(key=lambda row: row[0])
+
+        for rows in batches:
+            for _, results_d in rows:
+                n_candidates += 1
+                with timings.phase('output'):
+                    del results_d['display_name']
+                    if out_w:
+                        out_w.writerow(results_d)
+
+                    if not display:
+                        continue
+
+                    if first:
+                        print("")
+                        if output_ani:
+                            print("  ANI    avg_abund   p_metag   genome name")
+                        else:
+                            print("p_genome avg_abund   p_metag   genome name")
+                        print("-------- ---------   -------   -----------")
+                        first = False
+
+                    if output_ani:
+                        value = results_d['genome_containment_ani']
+                        value = "N/A" if value is None else f"{value*100:.1f}"
+                    else:
+                        value = f"{results_d['f_query']*100:.1f}"
+
+                    if results_d['average_abund'] != '':
+                        avg_abund = f"{results_d['average_abund']:.1f}"
+                        pct_metag = f"{results_d['f_match_weighted']*100:.1f}%"
+                    else:
+                        avg_abund = pct_metag = "N/A"
+
+                    name = _display_name(results_d['query_name'],
+                                         results_d['query_filename'],
+                                         results_d['query_md5'],
+                                         screen_width - 41)
+                    print(f'{value:>6}%  {avg_abund:>6}     {pct_metag:>6}     {name}')
+    except MismatchScaled as exc:
+        error(f"Unable to run comparison for '{exc}'; maybe set --scaled?")
+        return -1
+    except ValueError as exc:
+        error(f"ERROR: {exc}")
+        return -1
+
+    if out_w:
+        out_w.close()
+
+    notify(f"found {n_candidates} matching genomes in {len(db_filenames)} databases.")
+
+
+def _db_candidates(db_filenames, metag, *, ksize, moltype, threshold_bp=0):
+    """
+    Yield the signatures in the databases 'db_filenames' that share at
+    least 'threshold_bp' (and at least one hash) with the _PreparedMetagenome
+    'metag', using each database's prefetch.
+    """
+    prefetch_query = sourmash.SourmashSignature(_flat_minhash(metag),
+                                                name=metag.name)
+    for db_filename in db_filenames:
+        db = sourmash.load_file_as_index(db_filename)
+        db = db.select(ksize=ksize, moltype=moltype)
+        if not db:
+            notify(f"WARNING: no sketches at ksize={ksize}/moltype={moltype} in '{db_filename}'; skipping.")
+            continue
+
+        for result in db.prefetch(prefetch_query, threshold_bp):
+            yield result.signature
+
+
+def _flat_minhash(metag):
+    "Return a flat MinHash with the hashes in a _PreparedMetagenome."
+    mh = sourmash.MinHash(n=0, ksize=metag.ksize, scaled=metag.scaled,
+                          seed=metag.seed,
+                          is_protein=metag.moltype == 'protein',
+                          dayhoff=metag.moltype == 'dayhoff',
+                          hp=metag.moltype == 'hp')
+    mh.add_many(metag.hashes.tolist())
+    return mh
+
+
+def _db_score_batches(candidates, metag_filename, metag, *, batch_size=10000,
+                      timings=None, **kwargs):
+    """
+    Score the candidate genome signatures against 'metag', 'batch_size' at
+    a time. Yields a list of (candidate_idx, results_d) for each batch,
+    where 'candidate_idx' counts candidates across all batches; see
+    _score_metag for 'kwargs'.
+
+    Candidates with a coarser scaled than 'metag' are scored against the
+    metagenome downsampled to their scaled, as _score_groups does.
+    """
+    timings = timings or _NO_TIMINGS
+    downsampled = { metag.scaled: metag }
+    n_scored = 0
+    while 1:
+        with timings.phase('load_queries'):
+            batch = []
+            for query_ss in itertools.islice(candidates, batch_size):
+                query_mh = query_ss.minhash
+                if query_mh.track_abundance:
+                    query_mh = query_mh.flatten()
+                if query_mh.scaled < metag.scaled:
+                    query_mh = query_mh.downsample(scaled=metag.scaled)
+                if query_mh is not query_ss.minhash:
+                    query_ss = query_ss.to_mutable()
+                    query_ss.minhash = query_mh
+                batch.append(_PreparedQuery.from_signature(query_ss))
+        if not batch:
+            break
+
+        # score the candidates at each scaled as a group.
+        by_scaled = collections.defaultdict(list)
+        for candidate_idx, query in enumerate(batch, n_scored):
+            by_scaled[query.scaled].append((candidate_idx, query))
+
+        rows = []
+        for query_scaled, group in by_scaled.items():
+            if query_scaled not in downsampled:
+                downsampled[query_scaled] = metag.downsample(query_scaled)
+            with timings.phase('index_queries'):
+                query_index = _QueryIndex([ query for _, query in group ])
+            for query_idx, results_d in _score_metag(query_index,
+                                                     metag_filename,
+                                                     downsampled[query_scaled],
+                                                     ksize=metag.ksize,
+                                                     timings=timings,
+                                                     **kwargs):
+                rows.append((group[query_idx][0], results_d))
+        rows.sort(key=lambda row: row[0])
+        yield rows
+        n_scored += len(batch)
+
+
+#
+# Python API
+#
+
+ContainmentResult = collections.namedtuple('ContainmentResult', COLUMNS)
+ContainmentResult.__doc__ = """\
+The result of searching for one query in one metagenome, with the fields
+described in COLUMNS. Missing values - abundance columns for metagenomes
+without abundances, and ANI columns that were not estimated - are None.
+"""
+
+
+def _result_dtype():
+    "NumPy structured array dtype for ContainmentSearcher.search_array."
+    dtypes = dict(string=object, int64=np.int64, float64=np.float64,
+                  bool_=np.bool_)
+    return np.dtype([ (name, dtypes[COLUMN_TYPES[name]]) for name in COLUMNS ])
+
+
+class ContainmentSearcher:
+    """
+    Search for genomes in a set of metagenomes that are loaded and
+    prepared once, and then kept in memory for any number of searches.
+
+    'metagenomes' is a list of metagenome sketch files (any file sourmash
+    can load, pathlists, or .mgsketch files from 'mgprepare'), or of
+    SourmashSignature/MinHash objects. Sketches are selected by 'ksize',
+    and downsampled to 'scaled' if given. If 'require_abundance' is True,
+    searching raises ValueError for metagenomes without abundances.
+
+    Example:
+
+        searcher = ContainmentSearcher(['SRR606249.sig.zip'], ksize=31)
+        for result in searcher.search(genome_sig.minhash, threshold_bp=3000):
+            print(result.match_name, result.f_query, result.average_abund)
+
+    If 'preload' is False, metagenome files are instead loaded for each
+    search, one at a time; this is how the 'mgsearch' and 'mgmanysearch'
+    commands search. Give a MetagenomeCache as 'cache' to keep recently
+    searched files in memory, within a memory budget, and a directory as
+    'cache_dir' to save the prepared sketches there for use by later
+    processes (see _load_metagenomes).
+    """
+    def __init__(self, metagenomes=(), *, ksize=31, scaled=None,
+                 require_abundance=False, preload=True, cache=None,
+                 cache_dir=None):
+        self.ksize = ksize
+        self.scaled = scaled
+        self.require_abundance = require_abundance
+        self.preload = preload
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.filenames = []
+        self._metagenomes = []          # (metag_filename, _PreparedMetagenome)
+        for metagenome in metagenomes:
+            self.add(metagenome)
+
+    def __len__(self):
+        "Number of metagenome sketches held in memory."
+        return len(self._metagenomes)
+
+    def add(self, metagenome, *, filename=None):
+        """
+        Add a metagenome sketch file, or a SourmashSignature or MinHash;
+        'filename' overrides the match_filename reported for a signature.
+        Raises ValueError if a sketch has the wrong ksize or cannot be
+        downsampled to 'scaled'.
+        """
+        if isinstance(metagenome, str):
+            self.filenames.append(metagenome)
+            if self.preload:
+                for metag in _load_metagenomes(metagenome, ksize=self.ksize,
+                                               scaled=self.scaled,
+                                               cache=self.cache,
+                                               cache_dir=self.cache_dir):
+                    self._metagenomes.append((metagenome, metag))
+            return
+
+        if not self.preload:
+            raise ValueError("only metagenome files can be added when preload is False")
+
+        metag_ss = _as_signature(metagenome)
+        metag_mh = metag_ss.minhash
+        if metag_mh.ksize != self.ksize:
+            raise ValueError(f"metagenome '{metag_ss.name}' has ksize={metag_mh.ksize}, not {self.ksize}")
+        if self.scaled and metag_mh.scaled != self.scaled:
+            metag_ss = metag_ss.to_mutable()
+            metag_ss.minhash = metag_mh.downsample(scaled=self.scaled)
+
+        if filename is None:
+            filename = metag_ss.filename or ''
+        self._metagenomes.append((filename,
+                                  _PreparedMetagenome.from_signature(metag_ss)))
+
+    def prepare_queries(self, queries):
+        """
+        Flatten and downsample 'queries' - a SourmashSignature or MinHash,
+        or a list of them - for searching, and return a list of
+        _PreparedQuery. Raises ValueError if a query has the wrong ksize or
+        cannot be downsampled to 'scaled'.
+        """
+        if not isinstance(queries, (list, tuple)):
+            queries = [queries]
+
+        prepared = []
+        for query in queries:
+            if isinstance(query, _PreparedQuery):
+                prepared.append(query)
+                continue
+
+            query_ss = _as_signature(query)
+            query_mh = query_ss.minhash
+            if query_mh.ksize != self.ksize:
+                raise ValueError(f"query '{query_ss.name}' has ksize={query_mh.ksize}, not {self.ksize}")
+            if query_mh.track_abundance:
+                query_mh = query_mh.flatten()
+            if self.scaled and query_mh.scaled != self.scaled:
+                try:
+                    query_mh = query_mh.downsample(scaled=self.scaled)
+                except ValueError:
+                    raise ValueError(f"cannot downsample query '{query_ss.name}' to {self.scaled}")
+            if query_mh is not query_ss.minhash:
+                query_ss = query_ss.to_mutable()
+                query_ss.minhash = query_mh
+            prepared.append(_PreparedQuery.from_signature(query_ss))
+        return prepared
+
+    def search(self, queries, *, threshold_bp=0, min_containment=0.0,
+               top_k=None, ani=True):
+        """
+        Search for 'queries' (see prepare_queries) in the metagenomes, and
+        return a list of ContainmentResult, ordered by metagenome and then
+        by query.
+
+        Only pairs with an overlap of at least 'threshold_bp' and a
+        containment of at least 'min_containment' are returned; if 'top_k'
+        is set, only the 'top_k' best metagenomes for each query are
+        returned. ANI is only estimated if 'ani' is True.
+        """
+        results = []
+        for _, rows in self._search_rows(queries, threshold_bp=threshold_bp,
+                                         min_containment=min_containment,
+                                         top_k=top_k, ani=ani):
+            for _, results_d in rows:
+                results.append(ContainmentResult(**{
+                    name: None if results_d.get(name, '') == '' else results_d[name]
+                    for name in COLUMNS }))
+        return results
+
+    def search_array(self, queries, **kwargs):
+        """
+        As search, but return the results as a NumPy structured array with
+        one field per column. Missing values are NaN in float fields, -1 in
+        integer fields and False in 'potential_false_negative'.
+        """
+        missing = dict(string=None, int64=-1, float64=np.nan, bool_=False)
+        results = self.search(queries, **kwargs)
+
+        array = np.empty(len(results), dtype=_result_dtype())
+        for name in COLUMNS:
+            default = missing[COLUMN_TYPES[name]]
+            array[name] = [ default if value is None else value
+                            for value in (getattr(r, name) for r in results) ]
+        return array
+
+    def _search_rows(self, queries, *, first_only=False, threshold_bp=0,
+                     min_containment=0.0, top_k=None, top_k_by='query',
+                     skip_md5s=None, cores=1, emit_skipped=False, prefetch=2,
+                     prefetch_mb=None, read_ahead=1, timings=None, **kwargs):
+        """
+        Search for 'queries' in the metagenomes, yielding (metag_filename,
+        rows) as _search_all does. If 'top_k' is set, only the 'top_k' best
+        metagenomes per query ('top_k_by="query"') or queries per
+        metagenome ('top_k_by="metagenome"') are kept. Other keyword
+        arguments are passed on to _score_metag.
+
+        'queries' may also be a _QueryGroups, to search at several ksizes
+        and scaled values at once.
+
+        If 'preload' is False, metagenome files are streamed through
+        _search_all, with 'cores', 'emit_skipped', 'prefetch',
+        'prefetch_mb' and 'read_ahead'.
+        """
+        if not isinstance(queries, _QueryGroups):
+            queries = self.prepare_queries(queries)
+        kwargs.update(threshold_bp=threshold_bp,
+                      min_containment=min_containment,
+                      top_k=top_k if top_k_by == 'metagenome' else None,
+                      require_abundance=self.require_abundance)
+
+        if self.preload:
+            search_results = self._search_preloaded(queries,
+                                                    first_only=first_only,
+                                                    skip_md5s=skip_md5s,
+                                                    timings=timings, **kwargs)
         else:
-            missed_abundance = True
+            search_results = _search_all(queries, self.filenames,
+                                         cores=cores, ksize=self.ksize,
+                                         scaled=self.scaled,
+                                         first_only=first_only,
+                                         emit_skipped=emit_skipped,
+                                         skip_md5s=skip_md5s,
+                                         prefetch=prefetch,
+                                         prefetch_mb=prefetch_mb,
+                                         read_ahead=read_ahead,
+                                         cache=self.cache,
+                                         cache_dir=self.cache_dir,
+                                         timings=timings, **kwargs)
+
+        if top_k and top_k_by == 'query':
+            search_results = _top_k_per_query(search_results, top_k)
+        return search_results
+
+    def _search_preloaded(self, queries, *, first_only=False, skip_md5s=None,
+                          timings=None, **kwargs):
+        timings = timings or _NO_TIMINGS
+        with timings.phase('index_queries'):
+            if isinstance(queries, _QueryGroups):
+                query_groups = queries
+            else:
+                query_groups = _QueryGroups([(self.ksize, self.scaled,
+                                              queries)])
+
+        last_filename = None
+        for metag_filename, metag in self._metagenomes:
+            if first_only and metag_filename == last_filename:
+                continue
+            last_filename = metag_filename
+
+            rows = list(_score_groups(query_groups, metag_filename, metag,
+                                      skip_md5s=skip_md5s, timings=timings,
+                                      **kwargs))
+            yield metag_filename, rows
+
+
+def _as_signature(sketch):
+    "Wrap a MinHash in a SourmashSignature; return signatures as is."
+    if isinstance(sketch, sourmash.MinHash):
+        return sourmash.SourmashSignature(sketch)
+    return sketch
+
+
+def _search_all(queries, against_list, *, cores=1, ksize=None, scaled=None,
+                first_only=False, emit_skipped=False, skip_md5s=None,
+                prefetch=2, prefetch_mb=None, read_ahead=1, cache=None,
+                cache_dir=None, searched=None, file_ends=False, timings=None,
+                **kwargs):
+    """
+    Search all metagenomes in 'against_list' with the _PreparedQuery
+    objects in 'queries', at 'ksize' and 'scaled'; or, if 'queries' is a
+    _QueryGroups, with each group of queries at its own ksize and scaled,
+    reading each metagenome file once.
+
+    Yields (metag_filename, rows) in the order of 'against_list', where
+    'rows' is a list of (query_idx, results_d). If 'first_only' is True,
+    only the first sketch (at each ksize) in each metagenome file is
+    searched. If 'file_ends' is True, (metag_filename, None) is also
+    yielded once all the rows for each file have been, including files
+    with no sketches to search.
+
+    .mgsketch files whose Bloom filter sidecar rules out any overlap with
+    the queries are skipped, unless 'emit_skipped' is True. Metagenome
+    sketches whose md5 is in 'skip_md5s' are skipped. If 'searched' is a
+    dictionary, the md5s of all metagenome sketches searched or skipped,
+    and the md5s of the queries searched in each, are added to it (see
+    _score_groups).
+
+    In a serial run, metagenome sketches are streamed one at a time: a
+    background thread loads up to 'prefetch' sketches (using at most
+    'prefetch_mb' megabytes) ahead of scoring, reading up to 'read_ahead'
+    files concurrently, and each 'rows' holds the results for one sketch,
+    taken from 'cache' (a MetagenomeCache) if given. With 'read_ahead',
+    the loading threads keep to the same limits, but buffer at least one
+    sketch per file. Prepared sketches are
+    saved in or loaded from 'cache_dir' if given (see _load_metagenomes).
+    If 'cores' > 1, metagenome files are distributed across a process
+    pool, and each 'rows' holds the results for one file.
+
+    If 'timings' is a _Timings object, time spent in each phase is recorded
+    there; in a parallel run, worker timings are merged into it.
+    """
+    timings = timings or _NO_TIMINGS
+
+    # build the hash -> query indices once, for all metagenomes.
+    with timings.phase('index_queries'):
+        if isinstance(queries, _QueryGroups):
+            query_groups = queries
+        else:
+            query_groups = _QueryGroups([(ksize, scaled, queries)])
+    load_kwargs = query_groups.load_kwargs(skip_md5s)
+    load_kwargs.update(first_only=first_only, emit_skipped=emit_skipped,
+                       cache_dir=cache_dir)
+    kwargs['skip_md5s'] = skip_md5s
+
+    if cores > 1 and len(against_list) > 1:
+        cores = min(cores, len(against_list))
+        timed = timings is not _NO_TIMINGS
+        # workers attach to the query arrays in shared memory, rather
+        # than each receiving a pickled copy.
+        shm, handle = query_groups.share()
+        try:
+            with multiprocessing.Pool(cores, initializer=_init_search_worker,
+                                      initargs=(handle, load_kwargs, kwargs,
+                                                timed,
+                                                searched is not None)) as pool:
+                # imap preserves input order, so output is deterministic.
+                results = pool.imap(_search_metag_worker, against_list)
+                for metag_filename, (rows, worker_searched,
+                                     worker_timings) in zip(against_list,
+                                                            results):
+                    if worker_searched:
+                        for md5, query_md5s in worker_searched.items():
+                            searched.setdefault(md5, set()).update(query_md5s)
+                    if worker_timings:
+                        timings.merge(worker_timings)
+                    yield metag_filename, rows
+                    if file_ends:
+                        yield metag_filename, None
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        max_bytes = None
+        if prefetch_mb:
+            max_bytes = int(prefetch_mb * 1024 * 1024)
+
+        if read_ahead and read_ahead > 1 and len(against_list) > 1:
+            # the read-ahead threads buffer sketches within the same
+            # limits, with room for one sketch from each file.
+            metags = _iter_metagenomes(against_list,
+                                       query_hashes=query_groups.hashes,
+                                       read_ahead=read_ahead,
+                                       max_items=max(prefetch or 0,
+                                                     read_ahead),
+                                       max_bytes=max_bytes, cache=cache,
+                                       searched=searched,
+                                       file_ends=file_ends, timings=timings,
+                                       **load_kwargs)
+        else:
+            metags = _iter_metagenomes(against_list,
+                                       query_hashes=query_groups.hashes,
+                                       cache=cache, searched=searched,
+                                       file_ends=file_ends, timings=timings,
+                                       **load_kwargs)
+            metags = _prefetch(metags, max_items=prefetch,
+                               max_bytes=max_bytes, sizeof=_item_nbytes)
+        for metag_filename, metag in metags:
+            if metag is None:
+                yield metag_filename, None
+                continue
+            rows = list(_score_groups(query_groups, metag_filename, metag,
+                                      searched=searched, timings=timings,
+                                      **kwargs))
+            yield metag_filename, rows
+
+
+# per-process state for _search_metag_worker, set by _init_search_worker.
+_worker_state = {}
+
+def _init_search_worker(handle, load_kwargs, kwargs, timed=False,
+                        record_searched=False):
+    # keep the shared memory block open for the life of the worker.
+    _worker_state['shm'], _worker_state['query_groups'] = \
+        _QueryGroups.attach(handle)
+    _worker_state['load_kwargs'] = load_kwargs
+    _worker_state['kwargs'] = kwargs
+    _worker_state['timed'] = timed
+    _worker_state['record_searched'] = record_searched
+
+
+def _search_metag_worker(metag_filename):
+    """
+    Search one metagenome in a worker process; return all rows, the
+    searched sketches and queries (see _score_groups; None if not
+    recorded), and the timings for this file as a dictionary (None if not
+    timed).
+    """
+    timings = _Timings() if _worker_state['timed'] else None
+    searched = {} if _worker_state['record_searched'] else None
+    rows = list(_search_metag(_worker_state['query_groups'], metag_filename,
+                              searched=searched, timings=timings,
+                              **_worker_state['load_kwargs'],
+                              **_worker_state['kwargs']))
+    return rows, searched, timings.as_dict() if timings else None
+
+
+def _search_metag(query_groups, metag_filename, *, ksize=None, scaled=None,
+                  ksizes=None, first_only=False, emit_skipped=False,
+                  load_skip_md5s=None, cache_dir=None, searched=None,
+                  timings=None, **kwargs):
+    """
+    Do the actual search &c for queries in a metagenome file.
+
+    Each metagenome sketch in 'metag_filename' is loaded, downsampled and
+    converted into hash/abundance arrays exactly once, and then scored
+    against every query in 'query_groups'. Yields (query_idx, results_d)
+    tuples.
+    """
+    metags = _iter_metagenomes([metag_filename], ksize=ksize, scaled=scaled,
+                               ksizes=ksizes, first_only=first_only,
+                               query_hashes=query_groups.hashes,
+                               emit_skipped=emit_skipped,
+                               load_skip_md5s=load_skip_md5s,
+                               cache_dir=cache_dir, searched=searched,
+                               timings=timings)
+    for _, metag in metags:
+        yield from _score_groups(query_groups, metag_filename, metag,
+                                 searched=searched, timings=timings,
+                                 **kwargs)
+
+
+def _score_groups(query_groups, metag_filename, metag, *, skip_md5s=None,
+                  searched=None, **kwargs):
+    """
+    Score a _PreparedMetagenome against each group in 'query_groups' with
+    the same ksize, downsampling it to the group's scaled as needed.
+    Sketches whose (downsampled) md5 is in 'skip_md5s' are not scored.
+    Yields (query_idx, results_d) tuples; see _score_metag for 'kwargs'.
+
+    If 'searched' is a dictionary, the md5s of the queries searched in
+    each (downsampled) sketch are added to 'searched[md5]', whether or not
+    they pass the filters; skipped sketches are added with no queries.
+    """
+    for ksize, scaled, query_index, offset in query_groups.groups:
+        if ksize is not None and metag.ksize != ksize:
+            continue
+        group_metag = metag
+        if scaled and metag.scaled != scaled:
+            group_metag = metag.downsample(scaled)
+            group_metag.no_overlap = metag.no_overlap
+        if searched is not None:
+            group_searched = searched.setdefault(group_metag.md5, set())
+        if skip_md5s and group_metag.md5 in skip_md5s:
+            continue
+        if searched is not None:
+            group_searched.update(query.md5 for query in query_index.queries)
+
+        for query_idx, results_d in _score_metag(query_index, metag_filename,
+                                                 group_metag, ksize=ksize,
+                                                 **kwargs):
+            yield offset + query_idx, results_d
+
+
+class _QueryGroups:
+    """
+    The queries to search for at each (ksize, scaled) combination, each
+    group with its own _QueryIndex; 'groups' is a list of (ksize, scaled,
+    _QueryIndex, offset). Query indices are positions in 'queries', all
+    the groups' queries in order.
+    """
+    def __init__(self, groups):
+        "'groups' is a list of (ksize, scaled, [ _PreparedQuery, ... ])."
+        self.queries = []
+        self.groups = []
+        for ksize, scaled, queries in groups:
+            self.groups.append((ksize, scaled, _QueryIndex(queries),
+                                len(self.queries)))
+            self.queries.extend(queries)
+
+        indices = [ query_index for _, _, query_index, _ in self.groups ]
+        if len(indices) == 1:
+            self.hashes = indices[0].hashes
+        else:
+            self.hashes = np.unique(np.concatenate([ query_index.hashes
+                                                     for query_index in indices ]))
+
+    def __len__(self):
+        return len(self.queries)
+
+    def load_kwargs(self, skip_md5s=None):
+        """
+        Return the _iter_metagenomes arguments to load every sketch needed
+        by the groups exactly once: the ksizes are selected at load time,
+        and a single scaled is downsampled to at load time, with several
+        left to _score_groups. Only sketches loaded at their search scaled
+        are filtered by 'skip_md5s' at load time.
+        """
+        ksizes = { ksize for ksize, _, _, _ in self.groups }
+        scaleds = { scaled for _, scaled, _, _ in self.groups }
+
+        load_kwargs = dict(ksize=None, scaled=None, ksizes=None,
+                           load_skip_md5s=None)
+        if len(ksizes) == 1:
+            load_kwargs['ksize'], = ksizes
+        elif None not in ksizes:
+            load_kwargs['ksize'] = tuple(sorted(ksizes))
+            load_kwargs['ksizes'] = sorted(ksizes)
+        if len(scaleds) == 1:
+            load_kwargs['scaled'], = scaleds
+            load_kwargs['load_skip_md5s'] = skip_md5s
+        return load_kwargs
+
+    def share(self):
+        """
+        Pack all of the query hashes - one contiguous uint64 array plus a
+        table of offsets - and the query indices into a single
+        multiprocessing.shared_memory block, for worker processes to
+        attach to with _QueryGroups.attach.
+
+        Returns (shm, handle): the caller must close and unlink 'shm' once
+        the workers are done, and 'handle' is a small picklable
+        description of the block and the query info.
+        """
+        lengths = [ len(query) for query in self.queries ]
+        query_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=query_offsets[1:])
+        arrays = [ np.concatenate([ query.hashes for query in self.queries ] +
+                                  [ np.empty(0, dtype=np.uint64) ]),
+                   query_offsets ]
+        for _, _, query_index, _ in self.groups:
+            arrays.extend([ query_index.hashes, query_index.query_ids,
+                            query_index.indptr ])
+        if len(self.groups) > 1:
+            arrays.append(self.hashes)
+
+        layout = []
+        size = 0
+        for array in arrays:
+            layout.append((array.dtype.str, array.shape, size))
+            size += -(-array.nbytes // 8) * 8      # keep arrays 8-byte aligned
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for array, (dtype, shape, offset) in zip(arrays, layout):
+            np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)[...] = array
+
+        handle = dict(name=shm.name, layout=layout,
+                      queries=[ (query.scaled, query.name, query.filename,
+                                 query.md5) for query in self.queries ],
+                      groups=[ (ksize, scaled, offset)
+                               for ksize, scaled, _, offset in self.groups ])
+        return shm, handle
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Rebuild the _QueryGroups described by 'handle' (see share), with
+        all arrays as zero-copy views of the shared memory block. Returns
+        (shm, query_groups); 'shm' must stay open while they are in use.
+        """
+        # worker processes share the creating process's resource tracker,
+        # so attaching does not change who unlinks the block.
+        shm = shared_memory.SharedMemory(name=handle['name'])
+        arrays = [ np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+                   for dtype, shape, offset in handle['layout'] ]
+        all_hashes, query_offsets = arrays[:2]
+
+        self = cls.__new__(cls)
+        self.queries = [ _PreparedQuery(all_hashes[query_offsets[i]:query_offsets[i + 1]],
+                                        scaled=scaled, name=name,
+                                        filename=filename, md5=md5)
+                         for i, (scaled, name, filename, md5)
+                         in enumerate(handle['queries']) ]
+
+        self.groups = []
+        group_offsets = [ offset for _, _, offset in handle['groups'] ]
+        group_offsets.append(len(self.queries))
+        for i, (ksize, scaled, offset) in enumerate(handle['groups']):
+            hashes, query_ids, indptr = arrays[2 + 3 * i:5 + 3 * i]
+            queries = self.queries[offset:group_offsets[i + 1]]
+            query_index = _QueryIndex.from_arrays(queries, hashes=hashes,
+                                                  query_ids=query_ids,
+                                                  indptr=indptr)
+            self.groups.append((ksize, scaled, query_index, offset))
+
+        if len(self.groups) > 1:
+            self.hashes = arrays[-1]
+        else:
+            self.hashes = self.groups[0][2].hashes
+        return shm, self
+
+
+def _score_metag(query_index, metag_filename, metag, *, ksize=None,
+                 require_abundance=None,
+                 screen_width=80, field_width=41, ani=True, threshold_bp=0,
+                 min_containment=0.0, top_k=None, covered=None,
+                 results_cache=None, timings=None):
+    """
+    Score a _PreparedMetagenome against every query in 'query_index'.
+    Yields (query_idx, results_d) tuples; ANI columns are only included if
+    'ani' is True.
+
+    Only queries that pass 'threshold_bp' and 'min_containment' are
+    reported; if 'top_k' is set, only the 'top_k' best of those (see
+    _rank_key) are reported, in query order. Queries whose md5 is in
+    'covered[metag.md5]' are not scored.
+
+    If 'results_cache' is a _ResultsCache, pairs found there are not
+    scored again, and newly scored pairs are added to it.
+    """
+    # check to make sure if metag needs & has abundance info
+    if require_abundance:
+        if not metag.track_abundance:
+            raise ValueError(f"sketch in '{metag_filename}' must have abundance information")
+
+    # other info, shared by all queries!
+    results_template = dict(match_md5=metag.md5,
+                            match_name=metag.name,
+                            match_filename=metag_filename,
+                            ksize=ksize,
+                            moltype=metag.moltype,
+                            scaled=metag.scaled)
+    display_name = metag._display_name(screen_width - field_width)
+
+    # skip queries already scored against this metagenome
+    skip_queries = None
+    if covered and metag.md5 in covered:
+        done = covered[metag.md5]
+        skip_queries = { query_idx
+                         for query_idx, query in enumerate(query_index.queries)
+                         if query.md5 in done }
+
+    timings = timings or _NO_TIMINGS
+    if results_cache is not None:
+        # score and cache every pair not found in the cache, and then
+        # apply the filters to cached and new results alike.
+        with timings.phase('results_cache'):
+            cached = results_cache.get(query_index.queries, metag, ani=ani)
+        if skip_queries:
+            cached = { query_idx: results_d
+                       for query_idx, results_d in cached.items()
+                       if query_idx not in skip_queries }
+        skip_queries = set(skip_queries or ()) | cached.keys()
+
+    with timings.phase('score'):
+        if results_cache is not None:
+            scores = list(_batch_score(query_index, metag, ani=ani,
+                                       skip_queries=skip_queries,
+                                       timings=timings))
+            with timings.phase('results_cache'):
+                results_cache.put(query_index.queries, metag, scores,
+                                  ani=ani)
+            scores.extend(cached.items())
+            scores.sort(key=lambda item: item[0])
+            scores = [ (query_idx, results_d)
+                       for query_idx, results_d in scores
+                       if results_d['intersect_bp'] >= threshold_bp and
+                       results_d['f_query'] >= min_containment ]
+        else:
+            scores = _batch_score(query_index, metag, ani=ani,
+                                  threshold_bp=threshold_bp,
+                                  min_containment=min_containment,
+                                  skip_queries=skip_queries,
+                                  timings=timings)
+        if top_k:
+            scores = heapq.nlargest(top_k, scores,
+                                    key=lambda item: _rank_key(item[1]))
+            scores.sort(key=lambda item: item[0])
+        else:
+            scores = list(scores)
+
+    for query_idx, results_d in scores:
+        results_d.update(results_template)
+        results_d['display_name'] = display_name
+        yield query_idx, results_d
+
+
+def _rank_key(results_d):
+    "Sort key for --top-k: containment of the query, then overlap."
+    return results_d['f_query'], results_d['intersect_bp']
+
+
+def _top_k_per_query(search_results, k):
+    """
+    Keep only the 'k' best rows for each query across all metagenomes,
+    ranked by _rank_key; ties go to the earlier metagenome.
+
+    Consumes all of 'search_results', as yielded by _search_all, and then
+    yields the rows that were kept in the same form and in their original
+    order.
+    """
+    heaps = collections.defaultdict(list)
+    filenames = []
+    seq = 0
+    for batch_idx, (metag_filename, rows) in enumerate(search_results):
+        filenames.append(metag_filename)
+        for query_idx, results_d in rows:
+            item = (_rank_key(results_d), -seq, batch_idx, query_idx,
+                    results_d)
+            seq += 1
+
+            heap = heaps[query_idx]
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+
+    kept = sorted((item for heap in heaps.values() for item in heap),
+                  key=lambda item: -item[1])
+    for batch_idx, items in itertools.groupby(kept, key=lambda item: item[2]):
+        rows = [ (query_idx, results_d)
+                 for _, _, _, query_idx, results_d in items ]
+        yield filenames[batch_idx], rows
+
+
+def _iter_metagenomes(against_list, *, ksize=None, scaled=None,
+                      ksizes=None, first_only=False, query_hashes=None,
+                      emit_skipped=False, load_skip_md5s=None, cache=None,
+                      cache_dir=None, read_ahead=1, max_items=None,
+                      max_bytes=None, searched=None, file_ends=False,
+                      timings=None):
+    """
+    Lazily load the metagenome sketches in each file in 'against_list',
+    yielding (metag_filename, _PreparedMetagenome) one sketch at a time.
+    If 'ksizes' is given, only sketches with one of those ksizes are
+    yielded; with 'first_only', only the first one at each ksize. See
+    _load_metagenomes for 'query_hashes', 'emit_skipped', 'cache' and
+    'cache_dir'. If 'file_ends' is True, (metag_filename, None) is yielded
+    after the sketches in each file.
+
+    Sketches whose md5 is in 'load_skip_md5s' are not yielded; if
+    'searched' is a dictionary, their md5s are added to it as keys (see
+    _score_groups).
+
+    If 'read_ahead' > 1, up to that many files are loaded concurrently by
+    a thread pool (see _read_ahead), with each file in a pathlist loaded
+    separately, and at most 'max_items' sketches and 'max_bytes' bytes
+    are loaded ahead.
+    """
+    if read_ahead and read_ahead > 1 and len(against_list) > 1:
+        load = functools.partial(_iter_metagenomes, ksize=ksize,
+                                 scaled=scaled, ksizes=ksizes,
+                                 first_only=first_only,
+                                 query_hashes=query_hashes,
+                                 emit_skipped=emit_skipped,
+                                 load_skip_md5s=load_skip_md5s, cache=cache,
+                                 cache_dir=cache_dir, searched=searched,
+                                 timings=timings)
+
+        # (metag_filename, file to load) for each file; 'first_only' reads
+        # one sketch from each pathlist, so those are not expanded.
+        units = []
+        for metag_filename in against_list:
+            filenames = [metag_filename]
+            if not first_only:
+                filenames = _expand_pathlists(filenames)
+            units.extend((metag_filename, filename, False)
+                         for filename in filenames)
+            units[-1] = (metag_filename, filenames[-1], True)
+
+        def load_unit(unit):
+            metag_filename, filename, is_last = unit
+            for _, metag in load([filename]):
+                yield metag_filename, metag
+            if file_ends and is_last:
+                yield metag_filename, None
+
+        yield from _read_ahead(units, load_unit, max_files=read_ahead,
+                               max_items=max_items, max_bytes=max_bytes,
+                               sizeof=_item_nbytes)
+        return
+
+    timings = timings or _NO_TIMINGS
+    n_ksizes = len(ksizes) if ksizes else 1
+    for metag_filename in against_list:
+        metags = _load_metagenomes(metag_filename, ksize=ksize,
+                                   scaled=scaled,
+                                   query_hashes=query_hashes,
+                                   emit_skipped=emit_skipped, cache=cache,
+                                   cache_dir=cache_dir)
+        seen_ksizes = set()
+        while 1:
+            with timings.phase('load_metagenome') as record:
+                metag = next(metags, None)
+                if metag is None:
+                    record['calls'] = 0
+                else:
+                    record['n_hashes'] = len(metag)
+            if metag is None:
+                break
+            if ksizes and metag.ksize not in ksizes:
+                continue
+            if load_skip_md5s and metag.md5 in load_skip_md5s:
+                if searched is not None:
+                    searched.setdefault(metag.md5, set())
+                continue
+            if first_only:
+                if metag.ksize in seen_ksizes:
+                    continue
+                seen_ksizes.add(metag.ksize)
+
+            timings.add_metagenome(metag_filename, metag, record)
+            yield metag_filename, metag
+            if first_only and len(seen_ksizes) == n_ksizes:
+                break
+        metags.close()                  # e.g. to finish a cache entry
+        if file_ends:
+            yield metag_filename, None
+
+
+def _item_nbytes(item):
+    "Size of a (metag_filename, metag) item; file end markers take none."
+    metag = item[1]
+    return metag.nbytes if metag is not None else 0
+
+
+def _read_ahead(filenames, load, *, max_files=2, max_items=None,
+                max_bytes=None, sizeof=None):
+    """
+    Yield the items in 'load(filename)', an iterable, for each of
+    'filenames' in order, while a thread pool loads up to 'max_files'
+    files concurrently. This hides per-file latency, e.g. on network
+    filesystems; exceptions are re-raised when their file is reached.
+
+    At most 'max_items' items - and, if 'sizeof' is given, at most
+    'max_bytes' of them - are buffered ahead of the consumer, across all
+    files, including files that are still being loaded. The file being
+    consumed can always buffer one item, so that loading makes progress.
+    """
+    cond = threading.Condition()
+    state = dict(n_items=0, n_bytes=0, head=None, stop=False)
+
+    def _is_full(slot, size):
+        if slot is state['head'] and not slot['items']:
+            return False
+        if max_items and state['n_items'] >= max_items:
+            return True
+        return max_bytes is not None and state['n_bytes'] + size > max_bytes
+
+    def _loader(slot, filename):
+        try:
+            for item in load(filename):
+                size = sizeof(item) if sizeof else 0
+                with cond:
+                    while not state['stop'] and _is_full(slot, size):
+                        cond.wait()
+                    if state['stop']:
+                        return
+                    slot['items'].append((item, size))
+                    state['n_items'] += 1
+                    state['n_bytes'] += size
+                    cond.notify_all()
+        except BaseException as exc:
+            with cond:
+                slot['exc'] = exc
+        finally:
+            with cond:
+                slot['done'] = True
+                cond.notify_all()
+
+    filenames = iter(filenames)
+    pending = collections.deque()
+    executor = concurrent.futures.ThreadPoolExecutor(max_files)
+
+    def _submit(n):
+        for filename in itertools.islice(filenames, n):
+            slot = dict(items=collections.deque(), done=False, exc=None)
+            pending.append(slot)
+            executor.submit(_loader, slot, filename)
+
+    try:
+        _submit(max_files)
+        while pending:
+            slot = pending[0]
+            with cond:
+                state['head'] = slot
+                cond.notify_all()
+            while 1:
+                with cond:
+                    while not slot['items'] and not slot['done']:
+                        cond.wait()
+                    if slot['items']:
+                        item, size = slot['items'].popleft()
+                        state['n_items'] -= 1
+                        state['n_bytes'] -= size
+                        cond.notify_all()
+                    elif slot['exc'] is not None:
+                        raise slot['exc']
+                    else:
+                        break
+                yield item
+            pending.popleft()
+            _submit(1)
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+        executor.shutdown(wait=False)
+
+
+def _prefetch(items, *, max_items=2, max_bytes=None, sizeof=None):
+    """
+    Iterate over 'items' in a background thread, buffering at most
+    'max_items' items - and, if 'sizeof' is given, at most 'max_bytes' of
+    them - ahead of the consumer. At least one item is always buffered, so
+    that loading can make progress. Yields items in order, and re-raises
+    any exception from the background thread.
+    """
+    if not max_items or max_items < 1:
+        yield from items
+        return
+
+    cond = threading.Condition()
+    buffered = collections.deque()
+    state = dict(n_bytes=0, done=False, exc=None, stop=False)
+
+    def _is_full(size):
+        if not buffered:
+            return False
+        if len(buffered) >= max_items:
+            return True
+        return max_bytes is not None and state['n_bytes'] + size > max_bytes
+
+    def _producer():
+        try:
+            for item in items:
+                size = sizeof(item) if sizeof else 0
+                with cond:
+                    while not state['stop'] and _is_full(size):
+                        cond.wait()
+                    if state['stop']:
+                        return
+                    buffered.append((item, size))
+                    state['n_bytes'] += size
+                    cond.notify_all()
+        except BaseException as exc:
+            with cond:
+                state['exc'] = exc
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    thread = threading.Thread(target=_producer, daemon=True)
+    thread.start()
+    try:
+        while 1:
+            with cond:
+                while not buffered and not state['done']:
+                    cond.wait()
+                if buffered:
+                    item, size = buffered.popleft()
+                    state['n_bytes'] -= size
+                    cond.notify_all()
+                elif state['exc'] is not None:
+                    raise state['exc']
+                else:
+                    return
+            yield item
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+
+
+class _Progress:
+    """
+    Report the number of metagenome files searched, metagenomes and
+    (query, metagenome) pairs searched per second, and the estimated time
+    remaining, on stderr; at most once every 'interval' seconds, and only
+    if 'enabled'.
+    """
+    def __init__(self, n_files, n_queries, *, enabled=True, interval=1.0):
+        self.n_files = n_files
+        self.n_queries = n_queries
+        self.enabled = enabled
+        self.interval = interval
+        self.files_done = 0
+        self.n_metags = 0
+        self._filename = None
+        self._start = self._last = time.monotonic()
+
+    def update(self, metag_filename):
+        "Record that a metagenome sketch in 'metag_filename' was searched."
+        if not self.enabled:
+            return
+        if metag_filename != self._filename:
+            if self._filename is not None:
+                self.files_done += 1
+            self._filename = metag_filename
+        self.n_metags += 1
+
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self._report(now, end='')
+
+    def finish(self):
+        "Report the final counts."
+        if not self.enabled:
+            return
+        if self._filename is not None:
+            self.files_done += 1
+            self._filename = None
+        self._report(time.monotonic(), end='\n')
+
+    def _report(self, now, *, end):
+        elapsed = max(now - self._start, 1e-9)
+        metags_per_sec = self.n_metags / elapsed
+        pairs_per_sec = self.n_metags * self.n_queries / elapsed
+        if self.files_done and self.files_done < self.n_files:
+            eta = elapsed / self.files_done * (self.n_files - self.files_done)
+            eta = f"ETA {_format_seconds(eta)}"
+        else:
+            eta = f"elapsed {_format_seconds(elapsed)}"
+        print(f"\r\033[Ksearched {self.files_done} of {self.n_files} files; "
+              f"{metags_per_sec:.1f} metagenomes/s, "
+              f"{pairs_per_sec:.1f} pairs/s; {eta}",
+              end=end, file=sys.stderr, flush=True)
+
+
+def _format_seconds(seconds):
+    "Format 'seconds' as H:MM:SS."
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class _Timings:
+    """
+    Cumulative wall-clock time, CPU time, call counts and hashes processed
+    for each named phase of a search, plus the load time of each
+    metagenome sketch.
+
+    Time spent in a nested phase is not counted in the enclosing phase.
+    CPU time is measured per thread, so loads in the prefetch thread are
+    attributed correctly; note that they overlap with the other phases.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.metagenomes = []
+        self.total = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as phase 'name'. Yields a dictionary in
+        which the caller may set 'n_hashes' (hashes processed) and 'calls'
+        (default 1); 'wall' is set on exit.
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        nested = [0.0, 0.0]             # wall, cpu of nested phases
+        stack.append(nested)
+        record = {}
+
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.thread_time() - start_cpu
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+
+            record['wall'] = wall
+            self.add(name, wall=wall - nested[0], cpu=cpu - nested[1],
+                     calls=record.get('calls', 1),
+                     n_hashes=record.get('n_hashes', 0))
+
+    def add(self, name, *, wall, cpu, calls=1, n_hashes=0):
+        with self._lock:
+            d = self.phases.setdefault(name, dict(wall=0.0, cpu=0.0,
+                                                  calls=0, n_hashes=0))
+            d['wall'] += wall
+            d['cpu'] += cpu
+            d['calls'] += calls
+            d['n_hashes'] += n_hashes
+
+    def add_metagenome(self, metag_filename, metag, record):
+        with self._lock:
+            self.metagenomes.append(dict(filename=metag_filename,
+                                         name=metag.name,
+                                         load_wall=record['wall'],
+                                         n_hashes=len(metag)))
+
+    def merge(self, d):
+        "Merge timings from another _Timings, as returned by as_dict()."
+        for name, phase_d in d['phases'].items():
+            self.add(name, wall=phase_d['wall'], cpu=phase_d['cpu'],
+                     calls=phase_d['calls'], n_hashes=phase_d['n_hashes'])
+        with self._lock:
+            self.metagenomes.extend(d['metagenomes'])
+
+    def as_dict(self):
+        with self._lock:
+            phases = { name: dict(d) for name, d in self.phases.items() }
+            metagenomes = list(self.metagenomes)
+
+        for d in phases.values():
+            d['hashes_per_sec'] = None
+            if d['n_hashes'] and d['wall']:
+                d['hashes_per_sec'] = d['n_hashes'] / d['wall']
+
+        return dict(total_wall=self.total, phases=phases,
+                    metagenomes=metagenomes)
+
+    def report(self, n_slowest=5):
+        "Print a summary table to stderr."
+        d = self.as_dict()
+
+        notify("")
+        notify(f"{'phase':<16} {'wall (s)':>10} {'cpu (s)':>10} {'calls':>8} {'hashes/s':>12}")
+        notify(f"{'-' * 16} {'-' * 10} {'-' * 10} {'-' * 8} {'-' * 12}")
+        for name, phase_d in d['phases'].items():
+            rate = phase_d['hashes_per_sec']
+            rate = f"{rate:12.4g}" if rate else f"{'':>12}"
+            notify(f"{name:<16} {phase_d['wall']:10.3f} {phase_d['cpu']:10.3f} {phase_d['calls']:8d} {rate}")
+        if d['total_wall'] is not None:
+            notify(f"{'total':<16} {d['total_wall']:10.3f}")
 
+        slowest = sorted(d['metagenomes'], key=lambda m: -m['load_wall'])
+        if slowest:
+            notify("")
+            notify("slowest metagenome loads:")
+            for m in slowest[:n_slowest]:
+                notify(f"{m['load_wall']:10.3f}s  {m['n_hashes']:>10} hashes  {m['name'] or m['filename']}")
+
+
+class _NoTimings:
+    "Stand-in for _Timings when timings are not being collected."
+    def phase(self, name):
+        return contextlib.nullcontext({})
+
+    def add_metagenome(self, metag_filename, metag, record):
+        pass
+
+_NO_TIMINGS = _NoTimings()
+
+
+def _load_metagenomes(metag_filename, *, ksize=None, scaled=None,
+                      query_hashes=None, emit_skipped=False, cache=None,
+                      cache_dir=None):
+    """
+    Load the metagenome sketches in 'metag_filename', downsampled to
+    'scaled' if given, and yield them as _PreparedMetagenome objects.
+    'ksize' selects one ksize, or several if it is a tuple; sketches with
+    other ksizes are skipped before they are converted.
+
+    .mgsketch files written by 'mgprepare' are memory-mapped; files in
+    a pathlist are loaded one at a time, in order; anything else is loaded
+    with sourmash.
+
+    If 'query_hashes' is given and a .mgsketch file has a Bloom filter
+    sidecar showing that it contains none of them, the file is skipped -
+    or, if 'emit_skipped' is True, its sketches are yielded with
+    'no_overlap' set, without reading their hashes.
+
+    If 'cache' is a MetagenomeCache, the prepared sketches in each file
+    are taken from it, or loaded and added to it.
+
+    If 'cache_dir' is set, files loaded with sourmash are flattened and
+    downsampled once, and saved there in .mgsketch format; later loads at
+    the same ksize and scaled memory-map the saved sketches instead.
+    (.mgsketch files are not cached, as downsampling a memory-mapped
+    sketch only reads the hashes that are kept.)
+    """
+    if metag_filename.endswith(MGSKETCH_EXT):
+        no_overlap = False
+        if query_hashes is not None:
+            bloom = _read_bloom(metag_filename + BLOOM_EXT)
+            if bloom is not None and not bloom.might_contain_any(query_hashes):
+                if not emit_skipped:
+                    return
+                no_overlap = True
+
+        metags = _cached_load(cache, metag_filename, _load_mgsketch,
+                              ksize=ksize, scaled=scaled)
+        for metag in metags:
+            metag.no_overlap = no_overlap
+            yield metag
+        return
+
+    pathlist = _read_pathlist(metag_filename)
+    if pathlist is not None:
+        for filename in pathlist:
+            yield from _load_metagenomes(filename, ksize=ksize, scaled=scaled,
+                                         query_hashes=query_hashes,
+                                         emit_skipped=emit_skipped,
+                                         cache=cache, cache_dir=cache_dir)
+    else:
+        load = _load_sourmash_metagenomes
+        if cache_dir:
+            load = functools.partial(_load_metag_cache, cache_dir=cache_dir)
+        yield from _cached_load(cache, metag_filename, load,
+                                ksize=ksize, scaled=scaled)
+
+
+def _is_ksize(ksize, sketch_ksize):
+    "Is 'sketch_ksize' selected by 'ksize': None, a ksize or a tuple of them?"
+    if ksize is None:
+        return True
+    if isinstance(ksize, tuple):
+        return sketch_ksize in ksize
+    return sketch_ksize == ksize
+
+
+def _load_mgsketch(metag_filename, *, ksize=None, scaled=None):
+    "Yield the sketches in a .mgsketch file; see _load_metagenomes."
+    for metag in _read_mgsketch(metag_filename, ksize=ksize):
+        if scaled and metag.scaled != scaled:
+            metag = metag.downsample(scaled)
+        yield metag
+
+
+def _load_sourmash_metagenomes(metag_filename, *, ksize=None, scaled=None):
+    "Yield the sketches in a file loaded by sourmash; see _load_metagenomes."
+    select_ksize = ksize if not isinstance(ksize, tuple) else None
+    metags = sourmash.load_file_as_signatures(metag_filename,
+                                              ksize=select_ksize)
+    for metag in metags:
+        if not _is_ksize(ksize, metag.minhash.ksize):
+            continue
         if scaled and metag.minhash.scaled != scaled:
             metag = metag.to_mutable()
             metag.minhash = metag.minhash.downsample(scaled=scaled)
+        yield _PreparedMetagenome.from_signature(metag)
+
+
+def _load_metag_cache(metag_filename, *, ksize=None, scaled=None,
+                      cache_dir):
+    """
+    Yield the sketches in a file loaded by sourmash from their .mgsketch
+    copy in 'cache_dir'; see _load_metagenomes. If there is no copy yet,
+    the sketches are loaded with sourmash and yielded one at a time as
+    they are written to the copy, which is completed even if the caller
+    stops early.
+    """
+    cache_path = _metag_cache_path(cache_dir, metag_filename, ksize=ksize,
+                                   scaled=scaled)
+    if os.path.exists(cache_path):
+        yield from _load_mgsketch(cache_path)
+        return
 
-        # calculate stuff!
-        result = PrefetchResult(query_ss, metag, threshold_bp=0,
-                                 estimate_ani_ci=False)
+    os.makedirs(cache_dir, exist_ok=True)
+    metags = _load_sourmash_metagenomes(metag_filename, ksize=ksize,
+                                        scaled=scaled)
+    yield from _iter_write_mgsketch(cache_path, metags)
 
-        # calculate total weighted hashes for use in denominator:
-        total_sum_abunds = metag.minhash.sum_abundances
 
-        # get a flattened copy for use in intersections...
-        flat_metag = metag.minhash.flatten()
+METAG_CACHE_VERSION = 1
 
-        # other info!
-        results_template = dict(match_md5=metag.md5sum(),
-                                match_name=metag.name,
-                                match_filename=metag_filename,
-                                ksize=ksize,
-                                moltype=metag.minhash.moltype,
-                                scaled=metag.minhash.scaled)
+def _metag_cache_path(cache_dir, metag_filename, *, ksize, scaled):
+    "Cache location for 'metag_filename', keyed on path/mtime/size + params."
+    path = os.path.abspath(metag_filename)
+    stat = os.stat(path)
+    key = json.dumps([METAG_CACHE_VERSION, path, stat.st_mtime_ns,
+                      stat.st_size, ksize, scaled])
+    key_md5 = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{key_md5}{MGSKETCH_EXT}")
 
-        # this is where we depart from PrefetchResult :)
-        if has_abundance:
-            # now, get weighted containment for query genome
+
+def _cached_load(cache, metag_filename, load, *, ksize, scaled):
+    """
+    Yield the sketches from 'load(metag_filename, ...)', going through
+    'cache' if it is not None.
+    """
+    if cache is None:
+        yield from load(metag_filename, ksize=ksize, scaled=scaled)
+        return
+
+    yield from cache.get(metag_filename, ksize=ksize, scaled=scaled,
+                         load=lambda: list(load(metag_filename, ksize=ksize,
+                                                scaled=scaled)))
+
+
+class MetagenomeCache:
+    """
+    An in-memory LRU cache of prepared metagenome sketches, for processes
+    that search the same metagenomes repeatedly.
+
+    Entries hold all of the sketches in one file, keyed by the file's path,
+    modification time and size, plus ksize and scaled, so a changed file
+    is loaded again. Once the hash and abundance arrays in the cache take
+    up more than 'max_mb' megabytes, the least recently used entries are
+    evicted; files larger than that are not cached. Files listed in a
+    pathlist are cached individually.
+
+    'hits', 'misses' and 'evictions' count cache lookups and evictions;
+    see also stats().
+    """
+    def __init__(self, max_mb=1024):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # key => (metags, n_bytes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, metag_filename, *, ksize, scaled, load):
+        """
+        Return the list of prepared sketches for 'metag_filename' at
+        'ksize'/'scaled', calling 'load()' to load them on a cache miss.
+        """
+        key = self._key(metag_filename, ksize=ksize, scaled=scaled)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        metags = load()
+        n_bytes = sum(metag.nbytes for metag in metags)
+        with self._lock:
+            if n_bytes <= self.max_bytes and key not in self._entries:
+                self._entries[key] = (metags, n_bytes)
+                self.n_bytes += n_bytes
+                while self.n_bytes > self.max_bytes:
+                    _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                    self.n_bytes -= evicted_bytes
+                    self.evictions += 1
+        return metags
+
+    def clear(self):
+        "Remove all entries; the counters are kept."
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        "Return the counters, number of entries and bytes used as a dict."
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, n_entries=len(self._entries),
+                        n_bytes=self.n_bytes, max_bytes=self.max_bytes)
+
+    @staticmethod
+    def _key(metag_filename, *, ksize, scaled):
+        st = os.stat(metag_filename)
+        return (os.path.abspath(metag_filename), st.st_mtime_ns, st.st_size,
+                ksize, scaled)
+
+
+def _expand_pathlists(filenames):
+    "Replace each pathlist in 'filenames' by the files it lists, in order."
+    expanded = []
+    for filename in filenames:
+        pathlist = _read_pathlist(filename)
+        if pathlist is None:
+            expanded.append(filename)
+        else:
+            expanded.extend(_expand_pathlists(pathlist))
+    return expanded
+
+
+def _read_pathlist(filename):
+    """
+    Return the paths listed in 'filename' if it is a text file of
+    existing sketch files, one per line; otherwise return None.
+
+    (sourmash loads all of the files in a pathlist up front, so we expand
+    pathlists ourselves, to keep memory usage bounded.)
+    """
+    if not os.path.isfile(filename) or zipfile.is_zipfile(filename):
+        return None
+
+    try:
+        with open(filename) as fp:
+            # quickly reject big one-line JSON signature files
+            first_line = fp.readline(4096).rstrip('\r\n')
+            if not first_line or not os.path.exists(first_line):
+                return None
+            paths = [first_line] + [ line.rstrip('\r\n') for line in fp ]
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+    paths = [ path for path in paths if path ]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    return paths
+
+
+def _display_name(name, filename, md5, max_length=0):
+    "Same as SourmashSignature._display_name."
+    if name:
+        if max_length and len(name) > max_length:
+            name = name[: max_length - 3] + "..."
+    elif filename:
+        name = filename
+        if max_length and len(name) > max_length:
+            name = "..." + name[-max_length + 3 :]
+    else:
+        name = md5[:8]
+    return name
+
+
+# ASCII digits of 0-9999, zero-padded to 4 characters, one uint32 each.
+_DIGITS = np.frombuffer(''.join(f'{i:04d}' for i in range(10000)).encode('ascii'),
+                        dtype=np.uint32)
+
+def _hashes_md5(hashes, *, ksize, moltype, chunksize=1 << 20):
+    """
+    Calculate the sourmash md5sum of a sketch from its sorted hashes: the
+    md5 of the ksize and the decimal hash values, concatenated.
+
+    The decimal digits are built with numpy, 'chunksize' hashes at a time.
+    As the hashes are sorted, each run of hashes with the same number of
+    digits is a contiguous block that is hashed in one update.
+    """
+    if moltype != 'DNA':
+        ksize = ksize * 3               # internal ksize for protein &c
+    md5 = hashlib.md5(str(ksize).encode('utf-8'))
+    for start in range(0, len(hashes), chunksize):
+        values = np.asarray(hashes[start:start + chunksize], dtype=np.uint64)
+
+        # 24 zero-padded digits per hash, as six groups of four.
+        groups = np.empty((len(values), 6), dtype=np.uint32)
+        for i, part in enumerate((values // np.uint64(10**16),
+                                  values // np.uint64(10**8) % np.uint64(10**8),
+                                  values % np.uint64(10**8))):
+            part = part.astype(np.uint32)
+            groups[:, 2 * i] = part // 10000
+            groups[:, 2 * i + 1] = part % 10000
+        digits = _DIGITS.take(groups).view(np.uint8)
+
+        # drop the leading zeros of each block of same-length hashes.
+        ends = np.searchsorted(values, [ np.uint64(10**k) for k in range(1, 20) ])
+        lo = 0
+        for n_digits, hi in enumerate(ends.tolist() + [len(values)], 1):
+            if hi > lo:
+                md5.update(digits[lo:hi, 24 - n_digits:].tobytes())
+            lo = hi
+    return md5.hexdigest()
+
+
+class _PreparedMetagenome:
+    """
+    A flattened metagenome sketch, as a sorted uint64 hash array plus a
+    parallel uint64 abundance array (None if no abundances), along with
+    the metagenome info needed for output.
+
+    Values derived from the sketch - md5, sum of abundances, and hashes
+    downsampled to a coarser scaled - are calculated at most once, and
+    then shared by all of the queries scored against it.
+    """
+    def __init__(self, hashes, abunds, *, name, filename, md5, ksize,
+                 moltype, scaled, seed=MINHASH_DEFAULT_SEED,
+                 sum_abundances=None):
+        self.hashes = hashes
+        self.abunds = abunds
+        self.name = name
+        self.filename = filename
+        self.ksize = ksize
+        self.moltype = moltype
+        self.scaled = scaled
+        self.seed = seed
+        self._md5 = md5
+        self._sum_abundances = sum_abundances
+        self._downsampled = {}
+
+        # set when a prefilter shows that no query hashes are present
+        self.no_overlap = False
+
+    @classmethod
+    def from_signature(cls, metag):
+        metag_mh = metag.minhash
+        hashes, abunds = _minhash_to_arrays(metag_mh)
+        return cls(hashes, abunds, name=metag.name, filename=metag.filename,
+                   md5=metag.md5sum(), ksize=metag_mh.ksize,
+                   moltype=metag_mh.moltype, scaled=metag_mh.scaled,
+                   seed=metag_mh.seed)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @property
+    def md5(self):
+        if self._md5 is None:
+            self._md5 = _hashes_md5(self.hashes, ksize=self.ksize,
+                                    moltype=self.moltype)
+        return self._md5
+
+    @property
+    def track_abundance(self):
+        return self.abunds is not None
+
+    @property
+    def nbytes(self):
+        nbytes = self.hashes.nbytes
+        if self.abunds is not None:
+            nbytes += self.abunds.nbytes
+        return nbytes
+
+    @property
+    def sum_abundances(self):
+        if self.abunds is None:
+            return None
+        if self._sum_abundances is None:
+            self._sum_abundances = int(self.abunds.sum())
+        return self._sum_abundances
+
+    def downsample(self, scaled):
+        "Return a new _PreparedMetagenome downsampled to 'scaled'."
+        scaled = int(scaled)
+        if scaled < self.scaled:
+            raise ValueError(f"new scaled {scaled} is lower than current sample scaled {self.scaled}")
+
+        hashes = _downsample_hashes(self.hashes, scaled)
+        abunds = None
+        if self.abunds is not None:
+            abunds = self.abunds[:len(hashes)]
+        # the md5 does not depend on scaled, only on the hashes.
+        md5 = self._md5 if len(hashes) == len(self.hashes) else None
+        return _PreparedMetagenome(hashes, abunds, name=self.name,
+                                   filename=self.filename, md5=md5,
+                                   ksize=self.ksize, moltype=self.moltype,
+                                   scaled=scaled, seed=self.seed)
+
+    def downsampled_hashes(self, scaled):
+        "Return the hash array downsampled to 'scaled', memoized."
+        if scaled == self.scaled:
+            return self.hashes
+        if scaled not in self._downsampled:
+            self._downsampled[scaled] = _downsample_hashes(self.hashes, scaled)
+        return self._downsampled[scaled]
+
+    def _display_name(self, max_length=0):
+        return _display_name(self.name, self.filename, self.md5, max_length)
+
+
+#
+# .mgsketch format, written by 'mgprepare': an 8 byte magic string, a
+# little-endian uint64 header length, a JSON header describing each
+# sketch, padded to 8 bytes; and then, for each sketch, a sorted
+# little-endian uint64 hash array followed by a parallel uint64
+# abundance array (if the sketch has abundances). Array offsets in the
+# header are relative to the end of the header.
+#
+
+MGSKETCH_EXT = '.mgsketch'
+MGSKETCH_MAGIC = b'MGSKETCH'
+MGSKETCH_VERSION = 1
+
+def _write_mgsketch(filename, metags):
+    "Write the sketches in 'metags' to a .mgsketch file."
+    for _ in _iter_write_mgsketch(filename, metags):
+        pass
+
+
+def _iter_write_mgsketch(filename, metags):
+    """
+    Write the sketches in 'metags' to a .mgsketch file, yielding each one
+    once its arrays are written, so only one sketch is held at a time.
+    If the caller stops early, the rest are written without being yielded.
+
+    The arrays go to a temporary data file until the header is known;
+    'filename' only appears once all the sketches have been written.
+    """
+    # write to temporary files & rename, so partial files are never seen.
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    data_filename = tmp_filename + '.data'
+    try:
+        sketches = []
+        offset = 0
+        stopped = False
+        with open(data_filename, 'wb') as data_fp:
+            for metag in metags:
+                info = dict(name=metag.name, filename=metag.filename,
+                            md5=metag.md5, ksize=metag.ksize,
+                            moltype=metag.moltype, scaled=metag.scaled,
+                            seed=metag.seed,
+                            track_abundance=metag.track_abundance,
+                            sum_abundances=metag.sum_abundances,
+                            n_hashes=len(metag),
+                            hashes_offset=offset)
+                data_fp.write(np.ascontiguousarray(metag.hashes, dtype='<u8').tobytes())
+                offset += 8 * len(metag)
+                if metag.track_abundance:
+                    info['abunds_offset'] = offset
+                    data_fp.write(np.ascontiguousarray(metag.abunds, dtype='<u8').tobytes())
+                    offset += 8 * len(metag)
+                sketches.append(info)
+                if not stopped:
+                    try:
+                        yield metag
+                    except GeneratorExit:
+                        stopped = True  # e.g. mgsearch only uses the first
+
+        header = json.dumps(dict(version=MGSKETCH_VERSION,
+                                 sketches=sketches)).encode('utf-8')
+        header += b' ' * (-len(header) % 8)
+
+        with open(tmp_filename, 'wb') as fp:
+            fp.write(MGSKETCH_MAGIC)
+            fp.write(struct.pack('<Q', len(header)))
+            fp.write(header)
+            with open(data_filename, 'rb') as data_fp:
+                shutil.copyfileobj(data_fp, fp)
+        os.replace(tmp_filename, filename)
+    finally:
+        for name in (data_filename, tmp_filename):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(name)
+
+
+def _read_mgsketch_header(filename):
+    "Read the header of a .mgsketch file; return (header, data_offset)."
+    with open(filename, 'rb') as fp:
+        magic = fp.read(len(MGSKETCH_MAGIC))
+        if magic != MGSKETCH_MAGIC:
+            raise ValueError(f"'{filename}' is not a .mgsketch file")
+        (header_len,) = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_len))
+
+    if header['version'] != MGSKETCH_VERSION:
+        raise ValueError(f"unsupported .mgsketch version in '{filename}'")
+
+    return header, len(MGSKETCH_MAGIC) + 8 + header_len
+
+
+def _read_mgsketch(filename, *, ksize=None):
+    "Yield memory-mapped _PreparedMetagenome objects from a .mgsketch file."
+    header, data_offset = _read_mgsketch_header(filename)
+
+    def _map_array(offset, n):
+        if not n:
+            return np.empty(0, dtype=np.uint64)
+        return np.memmap(filename, dtype='<u8', mode='r',
+                         offset=data_offset + offset, shape=(n,))
+
+    for info in header['sketches']:
+        if not _is_ksize(ksize, info['ksize']):
+            continue
+
+        n_hashes = info['n_hashes']
+        hashes = _map_array(info['hashes_offset'], n_hashes)
+        abunds = None
+        if info['track_abundance']:
+            abunds = _map_array(info['abunds_offset'], n_hashes)
+
+        yield _PreparedMetagenome(hashes, abunds, name=info['name'],
+                                  filename=info['filename'], md5=info['md5'],
+                                  ksize=info['ksize'],
+                                  moltype=info['moltype'],
+                                  scaled=info['scaled'],
+                                  seed=info.get('seed', MINHASH_DEFAULT_SEED),
+                                  sum_abundances=info['sum_abundances'])
+
+
+#
+# Bloom filter sidecar for .mgsketch files, written by 'mgprepare --bloom'
+# to '<file>.mgsketch.bloom': an 8 byte magic string, a little-endian
+# uint64 header length, a JSON header, padded to 8 bytes, and then the
+# filter bits as little-endian uint64 words. The filter holds every hash
+# in every sketch in the .mgsketch file, so it can rule out overlap with
+# a set of query hashes without loading any sketch.
+#
+
+BLOOM_EXT = '.bloom'
+BLOOM_MAGIC = b'MGBLOOM\0'
+BLOOM_VERSION = 1
+
+def _mix64(values):
+    "splitmix64 finalizer, applied to a uint64 array."
+    z = values ^ (values >> np.uint64(30))
+    z = z * np.uint64(0xbf58476d1ce4e5b9)
+    z = z ^ (z >> np.uint64(27))
+    z = z * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+
+class _BloomFilter:
+    """
+    A Bloom filter over uint64 hash values, using double hashing to pick
+    'n_funcs' bit positions for each hash.
+    """
+    def __init__(self, words, *, n_bits, n_funcs):
+        self.words = words
+        self.n_bits = n_bits
+        self.n_funcs = n_funcs
+
+    @classmethod
+    def build(cls, hashes, *, bits_per_hash=10, n_funcs=7):
+        n_bits = max(64, len(hashes) * bits_per_hash)
+        n_bits += -n_bits % 64
+        bloom = cls(np.zeros(n_bits // 64, dtype=np.uint64), n_bits=n_bits,
+                    n_funcs=n_funcs)
+        for positions in bloom._positions(hashes):
+            np.bitwise_or.at(bloom.words, positions >> np.uint64(6),
+                             np.uint64(1) << (positions & np.uint64(63)))
+        return bloom
+
+    def _positions(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        h1 = _mix64(hashes)
+        h2 = _mix64(h1) | np.uint64(1)
+        n_bits = np.uint64(self.n_bits)
+        for i in range(self.n_funcs):
+            yield (h1 + np.uint64(i) * h2) % n_bits
+
+    def might_contain_any(self, hashes, *, chunksize=1 << 20):
+        "Return False only if none of 'hashes' can be in the filter."
+        for start in range(0, len(hashes), chunksize):
+            chunk = hashes[start:start + chunksize]
+            present = np.ones(len(chunk), dtype=bool)
+            for positions in self._positions(chunk):
+                bits = self.words[positions >> np.uint64(6)] >> (positions & np.uint64(63))
+                present &= (bits & np.uint64(1)).astype(bool)
+                if not present.any():
+                    break
+            if present.any():
+                return True
+        return False
+
+
+def _write_bloom(filename, bloom):
+    header = json.dumps(dict(version=BLOOM_VERSION, n_bits=bloom.n_bits,
+                             n_funcs=bloom.n_funcs)).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fp:
+        fp.write(BLOOM_MAGIC)
+        fp.write(struct.pack('<Q', len(header)))
+        fp.write(header)
+        fp.write(np.ascontiguousarray(bloom.words, dtype='<u8').tobytes())
+    os.replace(tmp_filename, filename)
+
+
+def _read_bloom(filename):
+    "Read a Bloom filter sidecar; return None if it does not exist."
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, 'rb') as fp:
+        magic = fp.read(len(BLOOM_MAGIC))
+        if magic != BLOOM_MAGIC:
+            raise ValueError(f"'{filename}' is not a Bloom filter sidecar")
+        (header_len,) = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_len))
+        if header['version'] != BLOOM_VERSION:
+            raise ValueError(f"unsupported Bloom filter version in '{filename}'")
+        words = np.fromfile(fp, dtype='<u8')
+
+    return _BloomFilter(words, n_bits=header['n_bits'],
+                        n_funcs=header['n_funcs'])
+
+
+class _PreparedQuery:
+    """
+    A flattened & downsampled query sketch, as a sorted uint64 hash array,
+    along with the query info needed for output.
+    """
+    def __init__(self, hashes, *, scaled, name, filename, md5):
+        self.hashes = hashes
+        self.scaled = scaled
+        self.name = name
+        self.filename = filename
+        self.md5 = md5
+        self._downsampled = {}
+
+    @classmethod
+    def from_signature(cls, query_ss):
+        query_mh = query_ss.minhash
+        hashes, _ = _minhash_to_arrays(query_mh)
+        return cls(hashes, scaled=query_mh.scaled, name=query_ss.name,
+                   filename=query_ss.filename, md5=query_ss.md5sum())
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def downsampled_hashes(self, scaled):
+        "Return the hash array downsampled to 'scaled', memoized."
+        if scaled == self.scaled:
+            return self.hashes
+        if scaled not in self._downsampled:
+            self._downsampled[scaled] = _downsample_hashes(self.hashes, scaled)
+        return self._downsampled[scaled]
+
+    def _display_name(self, max_length=0):
+        return _display_name(self.name, self.filename, self.md5, max_length)
+
+
+def _load_queries(query_filename, *, ksize, moltype, scaled, cache_dir=None):
+    """
+    Load, flatten and downsample the query sketches in 'query_filename'.
+
+    Returns a list of _PreparedQuery. If 'cache_dir' is set, prepared
+    queries are read from there when available, and saved there otherwise.
+    Raises ValueError if a query cannot be downsampled to 'scaled'.
+    """
+    cache_path = None
+    if cache_dir:
+        cache_path = _query_cache_path(cache_dir, query_filename,
+                                       ksize=ksize, moltype=moltype,
+                                       scaled=scaled)
+        if os.path.exists(cache_path):
+            return _read_query_cache(cache_path)
+
+    query_idx = sourmash.load_file_as_index(query_filename)
+    query_idx = query_idx.select(ksize=ksize, moltype=moltype)
+
+    queries = []
+    for query_ss in query_idx.signatures():
+        query_mh = query_ss.minhash
+
+        # replace with flattened query
+        if query_mh.track_abundance:
+            query_ss = query_ss.to_mutable()
+            notify(f"WARNING: query sketch '{query_ss.name}' has abundance; ignoring.")
+            query_mh = query_mh.flatten()
+            query_ss.minhash = query_mh
+
+        # replace with downsampled query
+        if scaled is not None and scaled != query_mh.scaled:
             try:
-                intersect_mh = query_mh.intersection(flat_metag) # CTB: redundant?
+                query_mh = query_mh.downsample(scaled=scaled)
             except ValueError:
-                raise MismatchScaled
+                raise ValueError(f"cannot downsample query '{query_ss.name}' to {scaled}")
+            query_ss = query_ss.to_mutable()
+            query_ss.minhash = query_mh
+
+        queries.append(_PreparedQuery.from_signature(query_ss))
+
+    if cache_path:
+        _write_query_cache(cache_path, queries)
+
+    return queries
+
+
+#
+# on-disk cache of prepared queries: one directory per (source file,
+# ksize, moltype, scaled), containing the concatenated query hashes and
+# their offsets as .npy files (loaded memory-mapped), plus a JSON file
+# with the query info.
+#
+
+QUERY_CACHE_VERSION = 2
+
+def _file_md5(filename, chunk_size=1 << 20):
+    "md5 of the contents of 'filename'."
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
-            if len(intersect_mh):
-                w_intersect_mh = intersect_mh.inflate(metag.minhash)
 
-                abunds = list(w_intersect_mh.hashes.values())
+def _query_cache_path(cache_dir, query_filename, *, ksize, moltype, scaled):
+    """
+    Cache location for 'query_filename', keyed on its path and the md5 of
+    its contents + params. Hashing the contents (rather than trusting
+    mtime/size) means a query file rewritten in place is never served a
+    stale entry; the path is kept in the key because the cached queries
+    record their source filename.
+    """
+    path = os.path.abspath(query_filename)
+    key = json.dumps([QUERY_CACHE_VERSION, path, _file_md5(path),
+                      ksize, moltype, scaled])
+    key_md5 = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{key_md5}.queries")
+
+
+def _read_query_cache(cache_path):
+    with open(os.path.join(cache_path, 'info.json')) as fp:
+        info = json.load(fp)
+    hashes = np.load(os.path.join(cache_path, 'hashes.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(cache_path, 'offsets.npy'))
+
+    queries = []
+    for i, query_info in enumerate(info['queries']):
+        query_hashes = hashes[offsets[i]:offsets[i + 1]]
+        queries.append(_PreparedQuery(query_hashes, **query_info))
+    return queries
+
+
+def _write_query_cache(cache_path, queries):
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    lengths = [ len(q) for q in queries ]
+    offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    hashes = np.concatenate([ q.hashes for q in queries ] +
+                            [ np.empty(0, dtype=np.uint64) ])
+    info = dict(version=QUERY_CACHE_VERSION,
+                queries=[ dict(scaled=q.scaled, name=q.name,
+                               filename=q.filename, md5=q.md5)
+                          for q in queries ])
+
+    # write to a temporary directory & rename, so readers never see a
+    # partially written cache entry.
+    tmpdir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    np.save(os.path.join(tmpdir, 'hashes.npy'), hashes)
+    np.save(os.path.join(tmpdir, 'offsets.npy'), offsets)
+    with open(os.path.join(tmpdir, 'info.json'), 'w') as fp:
+        json.dump(info, fp)
+    try:
+        os.rename(tmpdir, cache_path)
+    except OSError:
+        # another process got there first.
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class _QueryIndex:
+    """
+    Inverted index from hash to query, stored CSR-style: the query indices
+    for 'hashes[i]' are 'query_ids[indptr[i]:indptr[i+1]]'.
+    """
+    def __init__(self, queries):
+        self.queries = queries
+        n_queries = len(queries)
+
+        lengths = [ len(q) for q in queries ]
+        all_hashes = np.concatenate([ q.hashes for q in queries ] +
+                                    [ np.empty(0, dtype=np.uint64) ])
+        all_ids = np.repeat(np.arange(n_queries, dtype=np.uint32), lengths)
+
+        # stable sort keeps query ids in increasing order within each hash
+        order = np.argsort(all_hashes, kind='stable')
+        self.hashes, counts = np.unique(all_hashes[order], return_counts=True)
+        self.query_ids = all_ids[order]
+
+        self.indptr = np.zeros(len(self.hashes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self._scaled = None
+
+    @classmethod
+    def from_arrays(cls, queries, *, hashes, query_ids, indptr):
+        "Wrap existing index arrays, e.g. views of shared memory."
+        self = cls.__new__(cls)
+        self.queries = queries
+        self.hashes = hashes
+        self.query_ids = query_ids
+        self.indptr = indptr
+        self._scaled = None
+        return self
+
+    def __len__(self):
+        return len(self.queries)
+
+    def other_scaled(self, scaled):
+        "Return the indices of the queries whose scaled is not 'scaled'."
+        if self._scaled is None:
+            self._scaled = np.array([ q.scaled for q in self.queries ],
+                                    dtype=np.int64)
+        return np.flatnonzero(self._scaled != scaled)
+
+    def intersect(self, metag_hashes, metag_abunds=None):
+        """
+        Stream a sorted metagenome hash array through the index.
+
+        Returns (counts, abunds, offsets): 'counts' is the number of shared
+        hashes for each query. If 'metag_abunds' is given, the abundances
+        of the shared hashes for query 'i' are
+        'abunds[offsets[i]:offsets[i+1]]', in hash order; otherwise
+        'abunds' and 'offsets' are None.
+        """
+        n_queries = len(self.queries)
+
+        if len(self.hashes) and len(metag_hashes):
+            pos = np.searchsorted(self.hashes, metag_hashes)
+            pos[pos == len(self.hashes)] = 0
+            found = self.hashes[pos] == metag_hashes
+            matched = pos[found]
+        else:
+            found = np.zeros(len(metag_hashes), dtype=bool)
+            matched = np.empty(0, dtype=np.int64)
+
+        # expand each matched hash into its (hash, query) pairs
+        starts = self.indptr[matched]
+        n_pairs = self.indptr[matched + 1] - starts
+        run_starts = np.cumsum(n_pairs) - n_pairs
+        pair_pos = np.arange(int(n_pairs.sum())) - np.repeat(run_starts - starts, n_pairs)
+        pair_ids = self.query_ids[pair_pos]
+
+        counts = np.bincount(pair_ids, minlength=n_queries)
+        if metag_abunds is None:
+            return counts, None, None
+
+        # group abundances by query; pairs are generated in hash order,
+        # and a stable sort preserves that within each query.
+        pair_abunds = np.repeat(metag_abunds[found], n_pairs)
+        abunds = pair_abunds[np.argsort(pair_ids, kind='stable')]
+        offsets = np.zeros(n_queries + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        return counts, abunds, offsets
+
+
+def _minhash_to_arrays(mh):
+    """
+    Convert a MinHash into a sorted uint64 array of hashes, and a parallel
+    uint64 array of abundances (None if 'mh' does not track abundance).
+    """
+    hashes_d = mh.hashes
+    hashes = np.fromiter(hashes_d.keys(), dtype=np.uint64, count=len(hashes_d))
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+
+    abunds = None
+    if mh.track_abundance:
+        abunds = np.fromiter(hashes_d.values(), dtype=np.uint64,
+                             count=len(hashes_d))
+        abunds = abunds[order]
+
+    return hashes, abunds
+
+
+def _downsample_hashes(hashes, scaled):
+    "Downsample a sorted hash array to 'scaled'."
+    max_hash = _get_max_hash_for_scaled(scaled)
+    return hashes[:np.searchsorted(hashes, np.uint64(max_hash), side='right')]
+
+
+def _batch_score(query_index, metag, *, ani=True, threshold_bp=0,
+                 min_containment=0.0, skip_queries=None, timings=None):
+    """
+    Score all queries in 'query_index' against one _PreparedMetagenome.
+
+    If 'metag.no_overlap' is True, the metagenome is known to share no
+    hashes with any query, and the intersection is skipped. If 'ani' is
+    False, the ANI columns are not calculated.
+
+    Yields (query_idx, results_d) for each query with an intersection of
+    at least 'threshold_bp' and a containment (f_query) of at least
+    'min_containment'; values are identical to those calculated by
+    sourmash.search.PrefetchResult and MinHash intersection/inflation.
+    Queries whose index is in 'skip_queries' are not scored. With a
+    threshold or minimum containment, queries at the metagenome's scaled
+    that share too few hashes are skipped without any per-query work.
+    """
+    metag_hashes = metag.hashes
+    metag_abunds = metag.abunds
+    ksize = metag.ksize
+    scaled = metag.scaled
+
+    # calculate total weighted hashes for use in denominator:
+    has_abundance = metag.track_abundance
+    total_sum_abunds = metag.sum_abundances
+    match_n_hashes = len(metag)
+
+    # intersect all queries at once, unless there is nothing to score.
+    if metag.no_overlap or \
+       (skip_queries and len(skip_queries) >= len(query_index)):
+        counts = np.zeros(len(query_index), dtype=np.int64)
+        shared_abunds = offsets = None
+    else:
+        timings = timings or _NO_TIMINGS
+        with timings.phase('intersect') as record:
+            record['n_hashes'] = match_n_hashes
+            counts, shared_abunds, offsets = query_index.intersect(metag_hashes,
+                                                                   metag_abunds)
+
+    query_indices = range(len(query_index))
+    if threshold_bp or min_containment:
+        # queries at another scaled are compared on their own, below.
+        passing = counts * scaled >= threshold_bp
+        if min_containment:
+            passing &= counts > 0
+        query_indices = np.union1d(np.flatnonzero(passing),
+                                   query_index.other_scaled(scaled)).tolist()
+
+    queries = query_index.queries
+    for query_idx in query_indices:
+        if skip_queries and query_idx in skip_queries:
+            continue
+        query = queries[query_idx]
+
+        if query.scaled == scaled:
+            n_common = int(counts[query_idx])
+            query_n, match_n, cmp_scaled = len(query), match_n_hashes, scaled
+        else:
+            # compare at the larger of the two scaled values, as
+            # PrefetchResult does; weighted results require matching scaled.
+            if has_abundance:
+                raise MismatchScaled(query.name)
+
+            cmp_scaled = max(query.scaled, scaled)
+            query_hashes = query.downsampled_hashes(cmp_scaled)
+            cmp_metag_hashes = metag.downsampled_hashes(cmp_scaled)
+            n_common = len(np.intersect1d(query_hashes, cmp_metag_hashes,
+                                          assume_unique=True))
+            query_n, match_n = len(query_hashes), len(cmp_metag_hashes)
+
+        # skip non-hits before doing any more work.
+        if n_common * cmp_scaled < threshold_bp:
+            continue
+        if min_containment and \
+           _containment(n_common, query_n, cmp_scaled) < min_containment:
+            continue
+
+        results_d = _containment_results(query_n, match_n, n_common,
+                                         ksize=ksize, scaled=cmp_scaled,
+                                         ani=ani)
+
+        # this is where we depart from PrefetchResult :)
+        if has_abundance:
+            if n_common:
+                abunds = shared_abunds[offsets[query_idx]:offsets[query_idx + 1]]
                 mean = np.mean(abunds)
                 median = np.median(abunds)
                 std = np.std(abunds)
-                overlap_sum_abunds = w_intersect_mh.sum_abundances
+                overlap_sum_abunds = int(abunds.sum())
                 f_sum_abunds = overlap_sum_abunds / total_sum_abunds
             else:
                 mean = 0
@@ -488,28 +3868,84 @@ def _search_metag(query_ss, metag_filename, *, ksize=None, scaled=None,
             f_sum_abunds = ""
 
         # calculate final results
-        results_d = dict(intersect_bp=result.intersect_bp,
-                         query_filename=query_ss.filename,
-                         query_name=query_ss.name,
-                         query_md5=query_ss.md5sum(),
-                         f_query=result.f_match_query,
-                         f_match=result.f_query_match,
+        results_d.update(query_filename=query.filename,
+                         query_name=query.name,
+                         query_md5=query.md5,
                          f_match_weighted=f_sum_abunds,
                          sum_weighted_found=overlap_sum_abunds,
-                         query_n_hashes=len(query_mh),
-                         match_n_hashes=len(flat_metag),
+                         query_n_hashes=len(query),
+                         match_n_hashes=match_n_hashes,
                          match_n_weighted_hashes=total_sum_abunds,
                          average_abund=mean,
                          median_abund=median,
-                         std_abund=std,
-                         jaccard=result.jaccard,
-                         genome_containment_ani=result.query_containment_ani,
-                         match_containment_ani=result.match_containment_ani,
-                         average_containment_ani=result.average_containment_ani,
-                         max_containment_ani=result.max_containment_ani,
-                         potential_false_negative=result.potential_false_negative,
-                         display_name=metag._display_name(screen_width - field_width)
-                         )
-
-        results_d.update(results_template)
-        yield results_d
+                         std_abund=std)
+        yield query_idx, results_d
+
+
+def _containment(n_common, n_hashes, scaled):
+    "Bias-corrected containment, as in MinHash.contained_by."
+    if not n_hashes:
+        return 0.0
+    total_denom = float(n_hashes * scaled)
+    bias_factor = 1.0 - (1.0 - 1.0 / scaled) ** total_denom
+    containment = n_common / (n_hashes * bias_factor)
+    if containment >= 1:
+        return 1.0
+    elif containment <= 0:
+        return 0.0
+    return containment
+
+
+@functools.lru_cache(maxsize=None)
+def _size_is_accurate(n_hashes, scaled):
+    "As in MinHash.size_is_accurate."
+    probability = set_size_exact_prob(n_hashes * scaled, scaled,
+                                      relative_error=0.20)
+    return probability >= 0.95
+
+
+def _containment_results(query_n, match_n, n_common, *, ksize, scaled,
+                         ani=True):
+    """
+    Calculate the unweighted containment, jaccard, and (if 'ani' is True)
+    ANI columns for a comparison with 'n_common' shared hashes.
+    """
+    f_query = _containment(n_common, query_n, scaled)
+    f_match = _containment(n_common, match_n, scaled)
+
+    union = query_n + match_n - n_common
+    jaccard = n_common / max(1, union)
+
+    results_d = dict(intersect_bp=n_common * scaled,
+                     f_query=f_query,
+                     f_match=f_match,
+                     jaccard=jaccard)
+    if not ani:
+        return results_d
+
+    size_is_inaccurate = not (_size_is_accurate(query_n, scaled) and
+                              _size_is_accurate(match_n, scaled))
+
+    potential_false_negative = False
+    anis = []
+    for containment, n_hashes in ((f_query, query_n), (f_match, match_n)):
+        ani_result = containment_to_distance(containment, ksize, scaled,
+                                             n_unique_kmers=n_hashes * scaled)
+        ani_result.size_is_inaccurate = size_is_inaccurate
+        if ani_result.p_exceeds_threshold:
+            potential_false_negative = True
+        anis.append(ani_result.ani)
+
+    query_ani, match_ani = anis
+    if query_ani is None or match_ani is None:
+        average_ani = max_ani = None
+    else:
+        average_ani = (query_ani + match_ani) / 2
+        max_ani = max(query_ani, match_ani)
+
+    results_d.update(genome_containment_ani=query_ani,
+                     match_containment_ani=match_ani,
+                     average_containment_ani=average_ani,
+                     max_containment_ani=max_ani,
+                     potential_false_negative=potential_false_negative)
+    return results_d
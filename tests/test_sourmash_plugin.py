@@ -10,6 +10,20 @@ import sourmash
 import sourmash_tst_utils as utils
 from sourmash_tst_utils import SourmashCommandFailed
 
+import sourmash_plugin_containment_search as plugin
+
+
+@pytest.fixture
+def search_files():
+    """
+    The two test genomes as queries, and the podar metagenome plus the two
+    genomes (as small metagenomes) to search them in: (queries, against).
+    """
+    queries = [ utils.get_test_data('0.sig.zip'),
+                utils.get_test_data('1.sig.zip') ]
+    against = [ utils.get_test_data('SRR606249.k31.sig.zip') ] + queries
+    return queries, against
+
 
 def test_run_sourmash(runtmp):
     with pytest.raises(SourmashCommandFailed):
@@ -357,3 +371,1504 @@ def test_manysearch_0_x_podar_scaled_change_against(runtmp):
 
     err = runtmp.last_result.err
     assert "Unable to run comparison for" in err
+
+
+def test_manysearch_loads_metagenome_once(runtmp, search_files, monkeypatch):
+    # each metagenome should be loaded once, not once per query
+    (query1, query2), (against, *_) = search_files
+
+    loaded = []
+    orig_load = sourmash.load_file_as_signatures
+    def load_and_count(filename, **kwargs):
+        loaded.append(filename)
+        return orig_load(filename, **kwargs)
+    monkeypatch.setattr(sourmash, 'load_file_as_signatures', load_and_count)
+
+    plugin.mg_many_search([query1, query2], [against], scaled=100000,
+                          output=runtmp.output('out.csv'))
+
+    assert loaded == [against]
+    with open(runtmp.output('out.csv'), newline='') as fp:
+        rows = list(csv.DictReader(fp))
+    assert len(rows) == 2
+    assert {row['query_name'][:10] for row in rows} == {'CP001472.1', 'CP001941.1'}
+
+
+def test_manysearch_cores_identical_output(runtmp, search_files):
+    # parallel output should be byte-identical to serial output
+    (query1, query2), against = search_files
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', *against, '-o', 'serial.csv')
+    serial_out = runtmp.last_result.out
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', *against, '-o', 'parallel.csv', '-c', '3')
+    parallel_out = runtmp.last_result.out
+
+    with open(runtmp.output('serial.csv'), 'rb') as fp:
+        serial_csv = fp.read()
+    with open(runtmp.output('parallel.csv'), 'rb') as fp:
+        parallel_csv = fp.read()
+
+    assert serial_csv == parallel_csv
+    assert serial_out == parallel_out
+
+
+def test_mgsearch_cores(runtmp):
+    query = utils.get_test_data('0.sig.zip')
+    against = utils.get_test_data('SRR606249.k31.sig.zip')
+    runtmp.sourmash('scripts', 'mgsearch', query, against, query, '-c', '2')
+
+    out = runtmp.last_result.out
+    assert "100.0%    54.2       3.1%     SRR606249" in out
+    assert "100.0%     N/A        N/A     CP001472.1" in out
+
+
+def test_manysearch_cores_scaled_change_against(runtmp):
+    # errors in worker processes are reported
+    query = utils.get_test_data('0.sig.zip')
+    against = utils.get_test_data('SRR606249.k31.sig.zip')
+
+    against_down = runtmp.output('new.sig.gz')
+    runtmp.sourmash('sig', 'downsample', '--scaled', '200000', against,
+                    '-o', against_down)
+
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'mgmanysearch', '--query', query,
+                        '--against', against, against_down, '-c', '2',
+                        fail_ok=True)
+
+    err = runtmp.last_result.err
+    assert "Unable to run comparison for" in err
+
+
+def test_batch_score_matches_prefetch_result():
+    # vectorized scores should be identical to PrefetchResult values
+    from sourmash.search import PrefetchResult
+
+    filenames = ['0.sig.zip', '1.sig.zip', 'SRR606249.k31.sig.zip']
+    sigs = []
+    for filename in filenames:
+        sigs.extend(sourmash.load_file_as_signatures(utils.get_test_data(filename)))
+
+    query_sigs = []
+    for ss in sigs:
+        ss = ss.to_mutable()
+        ss.minhash = ss.minhash.flatten()
+        query_sigs.append(ss)
+    query_index = plugin._QueryIndex([ plugin._PreparedQuery.from_signature(ss)
+                                       for ss in query_sigs ])
+
+    for metag in sigs:
+        prepared = plugin._PreparedMetagenome.from_signature(metag)
+        scores = plugin._batch_score(query_index, prepared)
+        for query_ss, (_, results_d) in zip(query_sigs, scores):
+            result = PrefetchResult(query_ss, metag, threshold_bp=0,
+                                    estimate_ani_ci=False)
+            assert results_d['intersect_bp'] == result.intersect_bp
+            assert results_d['f_query'] == result.f_match_query
+            assert results_d['f_match'] == result.f_query_match
+            assert results_d['jaccard'] == result.jaccard
+            assert results_d['genome_containment_ani'] == result.query_containment_ani
+            assert results_d['match_containment_ani'] == result.match_containment_ani
+            assert results_d['average_containment_ani'] == result.average_containment_ani
+            assert results_d['max_containment_ani'] == result.max_containment_ani
+            assert results_d['potential_false_negative'] == result.potential_false_negative
+            assert results_d['query_n_hashes'] == len(query_ss.minhash)
+
+            if metag.minhash.track_abundance:
+                w_mh = query_ss.minhash.intersection(metag.minhash.flatten())
+                w_mh = w_mh.inflate(metag.minhash)
+                assert results_d['sum_weighted_found'] == w_mh.sum_abundances
+                assert results_d['match_n_weighted_hashes'] == metag.minhash.sum_abundances
+
+
+def test_batch_score_filters_skip_queries():
+    # with a threshold, queries below it are never visited one by one
+    filenames = ['0.sig.zip', '1.sig.zip', 'SRR606249.k31.sig.zip']
+    sigs = []
+    for filename in filenames:
+        sigs.extend(sourmash.load_file_as_signatures(utils.get_test_data(filename)))
+    queries = [ plugin._PreparedQuery.from_signature(ss) for ss in sigs ]
+    metag = plugin._PreparedMetagenome.from_signature(sigs[0])
+
+    class Visited(list):
+        def __getitem__(self, i):
+            visited.append(i)
+            return list.__getitem__(self, i)
+
+    query_index = plugin._QueryIndex(queries)
+    expected = [ (query_idx, results_d['intersect_bp'])
+                 for query_idx, results_d in plugin._batch_score(query_index, metag)
+                 if results_d['intersect_bp'] >= 1000000 ]
+    assert 0 < len(expected) < len(queries)
+
+    for kwargs in (dict(threshold_bp=1000000),
+                   dict(threshold_bp=1000000, min_containment=0.01)):
+        visited = []
+        query_index.queries = Visited(queries)
+        scores = [ (query_idx, results_d['intersect_bp'])
+                   for query_idx, results_d in plugin._batch_score(query_index,
+                                                                   metag,
+                                                                   **kwargs) ]
+        assert scores == expected
+        assert visited == [ query_idx for query_idx, _ in expected ]
+
+
+def test_query_index_intersect():
+    # inverted index counts & abundances match pairwise intersections
+    import numpy as np
+
+    class Query:
+        def __init__(self, hashes):
+            self.hashes = np.array(sorted(set(hashes)), dtype=np.uint64)
+        def __len__(self):
+            return len(self.hashes)
+
+    queries = [Query([1, 5, 9, 20]), Query([5, 6, 7]), Query([]),
+               Query([100, 200]), Query([9, 20, 21])]
+    index = plugin._QueryIndex(queries)
+    assert len(index) == 5
+    assert list(index.hashes) == [1, 5, 6, 7, 9, 20, 21, 100, 200]
+
+    metag_hashes = np.array([1, 2, 5, 7, 9, 20, 50], dtype=np.uint64)
+    metag_abunds = np.array([10, 1, 3, 4, 5, 6, 7], dtype=np.uint64)
+    abund_d = dict(zip(metag_hashes.tolist(), metag_abunds.tolist()))
+
+    counts, abunds, offsets = index.intersect(metag_hashes, metag_abunds)
+    for i, q in enumerate(queries):
+        shared = np.intersect1d(q.hashes, metag_hashes)
+        assert counts[i] == len(shared)
+        assert abunds[offsets[i]:offsets[i+1]].tolist() == \
+            [ abund_d[h] for h in shared.tolist() ]
+
+    counts, abunds, offsets = index.intersect(metag_hashes)
+    assert counts.tolist() == [4, 2, 0, 0, 2]
+    assert abunds is None and offsets is None
+
+
+def test_manysearch_query_cache(runtmp, search_files):
+    # prepared queries are cached, and reused on the next run
+    (query1, query2), (against, *_) = search_files
+    cache_dir = runtmp.output('qcache')
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', against, '-o', 'out1.csv',
+                    '--query-cache', cache_dir)
+    entries = [ x for x in os.listdir(cache_dir) if x.endswith('.queries') ]
+    assert len(entries) == 2
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', against, '-o', 'out2.csv',
+                    '--query-cache', cache_dir,
+                    '--show-results')
+    out = runtmp.last_result.out
+    assert "CP001472.1 Aci...  100.0%    54.2       3.1%     SRR606249" in out
+    assert "CP001941.1 Aci...  100.0%    45.5       0.4%     SRR606249" in out
+
+    with open(runtmp.output('out1.csv'), 'rb') as fp:
+        out1 = fp.read()
+    with open(runtmp.output('out2.csv'), 'rb') as fp:
+        out2 = fp.read()
+    assert out1 == out2
+
+
+def test_manysearch_query_cache_hit_skips_load(runtmp, monkeypatch):
+    query = utils.get_test_data('0.sig.zip')
+    cache_dir = runtmp.output('qcache')
+
+    queries = plugin._load_queries(query, ksize=31, moltype='DNA',
+                                   scaled=None, cache_dir=cache_dir)
+
+    def fail_load(*args, **kwargs):
+        raise Exception("should not be called")
+    monkeypatch.setattr(sourmash, 'load_file_as_index', fail_load)
+
+    cached = plugin._load_queries(query, ksize=31, moltype='DNA',
+                                  scaled=None, cache_dir=cache_dir)
+    assert len(cached) == len(queries) == 1
+    assert list(cached[0].hashes) == list(queries[0].hashes)
+    assert cached[0].md5 == queries[0].md5
+    assert cached[0].name == queries[0].name
+    assert cached[0].scaled == queries[0].scaled
+
+    # a different scaled is a different cache entry
+    with pytest.raises(Exception, match="should not be called"):
+        plugin._load_queries(query, ksize=31, moltype='DNA',
+                             scaled=200000, cache_dir=cache_dir)
+
+
+def test_query_cache_keyed_on_contents(runtmp):
+    # a query file rewritten with the same size & mtime misses the cache
+    import shutil
+
+    query = runtmp.output('query.sig.zip')
+    shutil.copyfile(utils.get_test_data('0.sig.zip'), query)
+    cache_dir = runtmp.output('qcache')
+
+    path1 = plugin._query_cache_path(cache_dir, query, ksize=31,
+                                     moltype='DNA', scaled=None)
+    stat = os.stat(query)
+    with open(query, 'r+b') as fp:
+        data = fp.read()
+        fp.seek(0)
+        fp.write(bytes([data[0] ^ 0xff]) + data[1:])
+    os.utime(query, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.stat(query).st_size == stat.st_size
+
+    path2 = plugin._query_cache_path(cache_dir, query, ksize=31,
+                                     moltype='DNA', scaled=None)
+    assert path1 != path2
+
+
+def test_mgprepare_and_search(runtmp, search_files):
+    # searching .mgsketch files gives the same results as .sig files
+    (query1, query2), (against, *_) = search_files
+
+    runtmp.sourmash('scripts', 'mgprepare', against, query1,
+                    '--output-dir', 'prep')
+    prepared = runtmp.output('prep/SRR606249.k31.sig.zip.mgsketch')
+    prepared_flat = runtmp.output('prep/0.sig.zip.mgsketch')
+    assert os.path.exists(prepared)
+    assert os.path.exists(prepared_flat)
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', against, query1, '-o', 'sig.csv')
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', prepared, prepared_flat, '-o', 'prep.csv',
+                    '--show-results')
+    out = runtmp.last_result.out
+    assert "CP001472.1 Aci...  100.0%    54.2       3.1%     SRR606249" in out
+    assert "CP001941.1 Aci...  100.0%    45.5       0.4%     SRR606249" in out
+
+    with open(runtmp.output('sig.csv'), newline='') as fp:
+        sig_rows = list(csv.DictReader(fp))
+    with open(runtmp.output('prep.csv'), newline='') as fp:
+        prep_rows = list(csv.DictReader(fp))
+
+    assert len(sig_rows) == len(prep_rows) == 4
+    for sig_row, prep_row in zip(sig_rows, prep_rows):
+        assert prep_row['match_filename'].endswith('.mgsketch')
+        del sig_row['match_filename']
+        del prep_row['match_filename']
+        assert sig_row == prep_row
+
+
+def test_bloom_filter_no_false_negatives():
+    import numpy as np
+
+    rng = np.random.default_rng(42)
+    hashes = np.unique(rng.integers(0, 2**63, size=5000, dtype=np.uint64))
+    bloom = plugin._BloomFilter.build(hashes)
+
+    for h in hashes[:500]:
+        assert bloom.might_contain_any(np.array([h], dtype=np.uint64))
+    assert bloom.might_contain_any(hashes[-10:])
+    assert not bloom.might_contain_any(np.array([], dtype=np.uint64))
+
+
+def test_mgprepare_bloom_skip(runtmp):
+    # metagenomes ruled out by the Bloom filter are skipped, or reported
+    # with no overlap if --emit-skipped is given.
+    query1 = utils.get_test_data('0.sig.zip')
+    query2 = utils.get_test_data('1.sig.zip')
+
+    runtmp.sourmash('scripts', 'mgprepare', query1, '--output-dir', 'prep',
+                    '--bloom')
+    prepared = runtmp.output('prep/0.sig.zip.mgsketch')
+    assert os.path.exists(prepared + '.bloom')
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query2,
+                    '--against', prepared, '-o', 'skip.csv')
+    with open(runtmp.output('skip.csv'), newline='') as fp:
+        assert list(csv.DictReader(fp)) == []
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query2,
+                    '--against', prepared, '-o', 'emit.csv', '--emit-skipped')
+    os.unlink(prepared + '.bloom')
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query2,
+                    '--against', prepared, '-o', 'nobloom.csv')
+
+    with open(runtmp.output('emit.csv'), newline='') as fp:
+        emit_rows = list(csv.DictReader(fp))
+    with open(runtmp.output('nobloom.csv'), newline='') as fp:
+        nobloom_rows = list(csv.DictReader(fp))
+
+    assert len(emit_rows) == 1
+    assert emit_rows[0]['intersect_bp'] == '0'
+    assert emit_rows == nobloom_rows
+
+
+def test_mgprepare_bloom_overlap(runtmp):
+    # the Bloom filter does not change results for overlapping metagenomes
+    query1 = utils.get_test_data('0.sig.zip')
+    against = utils.get_test_data('SRR606249.k31.sig.zip')
+
+    runtmp.sourmash('scripts', 'mgprepare', against, '--output-dir', 'prep',
+                    '--bloom')
+    prepared = runtmp.output('prep/SRR606249.k31.sig.zip.mgsketch')
+
+    runtmp.sourmash('scripts', 'mgsearch', query1, prepared, '-o', 'a.csv')
+    os.unlink(prepared + '.bloom')
+    runtmp.sourmash('scripts', 'mgsearch', query1, prepared, '-o', 'b.csv')
+
+    with open(runtmp.output('a.csv'), newline='') as fp:
+        a_rows = list(csv.DictReader(fp))
+    with open(runtmp.output('b.csv'), newline='') as fp:
+        b_rows = list(csv.DictReader(fp))
+
+    assert len(a_rows) == 1
+    assert a_rows == b_rows
+
+
+def test_mgprepare_downsample_md5():
+    # downsampling a prepared metagenome matches sourmash downsampling
+    against = utils.get_test_data('SRR606249.k31.sig.zip')
+    ss = list(sourmash.load_file_as_signatures(against))[0]
+
+    metag = plugin._PreparedMetagenome.from_signature(ss)
+    assert metag.md5 == ss.md5sum()
+    assert metag.sum_abundances == ss.minhash.sum_abundances
+
+    down = metag.downsample(200000)
+    down_mh = ss.minhash.downsample(scaled=200000)
+    assert down.scaled == 200000
+    assert down.md5 == sourmash.SourmashSignature(down_mh).md5sum()
+    assert list(down.hashes) == sorted(down_mh.hashes)
+    assert down.sum_abundances == down_mh.sum_abundances
+
+    with pytest.raises(ValueError):
+        metag.downsample(1000)
+
+
+def test_hashes_md5():
+    # the vectorized md5 matches sourmash for all hash lengths & chunks
+    import numpy as np
+
+    hashes = [0, 1, 9, 10, 99, 12345, 10**8 - 1, 10**8, 10**16,
+              10**19 - 1, 10**19, 2**63, 2**64 - 1]
+    for moltype, ksize in (('DNA', 31), ('protein', 10)):
+        is_protein = moltype == 'protein'
+        mh = sourmash.MinHash(n=0, ksize=ksize, scaled=1,
+                              is_protein=is_protein)
+        mh.add_many(hashes)
+        expected = sourmash.SourmashSignature(mh).md5sum()
+
+        values = np.array(sorted(hashes), dtype=np.uint64)
+        for chunksize in (1, 5, 1 << 20):
+            md5 = plugin._hashes_md5(values, ksize=ksize, moltype=moltype,
+                                     chunksize=chunksize)
+            assert md5 == expected
+
+
+def test_prepared_metagenome_memoized():
+    # values derived from a metagenome are calculated once and reused
+    against = utils.get_test_data('SRR606249.k31.sig.zip')
+    ss = list(sourmash.load_file_as_signatures(against))[0]
+    metag = plugin._PreparedMetagenome.from_signature(ss)
+
+    down_hashes = metag.downsampled_hashes(100000)
+    assert metag.downsampled_hashes(100000) is down_hashes
+    assert metag.downsampled_hashes(metag.scaled) is metag.hashes
+    assert list(down_hashes) == sorted(ss.minhash.downsample(scaled=100000).hashes)
+
+    same = metag.downsample(100000)     # no hashes dropped
+    assert same._md5 == metag.md5
+
+    down = metag.downsample(200000)
+    assert down._md5 is None            # calculated on demand
+    assert down.md5 == sourmash.SourmashSignature(ss.minhash.downsample(scaled=200000)).md5sum()
+    assert down._md5 == down.md5
+
+
+def test_mgprepare_require_abundance(runtmp):
+    query = utils.get_test_data('1.sig.zip')
+    against = utils.get_test_data('0.sig.zip')
+
+    runtmp.sourmash('scripts', 'mgprepare', against, '--output-dir', 'prep')
+    prepared = runtmp.output('prep/0.sig.zip.mgsketch')
+
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'mgsearch', query, prepared,
+                        '--require-abundance', fail_ok=True)
+
+    assert "must have abundance information" in runtmp.last_result.err
+
+
+def test_mgprepare_bad_ksize(runtmp):
+    against = utils.get_test_data('0.sig.zip')
+
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'mgprepare', against, '-k', '21',
+                        '--output-dir', 'prep', fail_ok=True)
+
+    err = runtmp.last_result.err
+    assert "no sketches at ksize=21/moltype=DNA" in err
+    assert "ERROR: no metagenome sketches found." in err
+
+
+def test_mgprepare_same_basename(runtmp):
+    # files with the same basename would overwrite each other's output
+    import shutil
+
+    against = utils.get_test_data('0.sig.zip')
+    os.mkdir(runtmp.output('other'))
+    other = runtmp.output('other/0.sig.zip')
+    shutil.copyfile(against, other)
+
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'mgprepare', against, other,
+                        '--output-dir', 'prep', fail_ok=True)
+
+    assert "would both be written to" in runtmp.last_result.err
+    assert not os.path.exists(runtmp.output('prep'))
+
+
+def test_prefetch_order_and_budget():
+    # prefetching preserves order, and respects item & memory limits
+    import threading
+    import time
+
+    produced = []
+    def items():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    it = plugin._prefetch(items(), max_items=3, max_bytes=None)
+    assert next(it) == 0
+    time.sleep(0.1)
+    # one consumed, up to 3 buffered, and one waiting to be buffered
+    assert len(produced) <= 5
+    assert list(it) == list(range(1, 10))
+
+    produced.clear()
+    it = plugin._prefetch(items(), max_items=5, max_bytes=10,
+                          sizeof=lambda x: 6)
+    assert next(it) == 0
+    time.sleep(0.1)
+    # only one 6-byte item fits in the 10-byte budget
+    assert len(produced) <= 3
+    assert list(it) == list(range(1, 10))
+
+    # no prefetching
+    assert list(plugin._prefetch(iter(range(5)), max_items=0)) == list(range(5))
+
+
+def test_prefetch_exception():
+    def items():
+        yield 1
+        raise ValueError("load failed")
+
+    it = plugin._prefetch(items(), max_items=2)
+    assert next(it) == 1
+    with pytest.raises(ValueError, match="load failed"):
+        next(it)
+
+
+def test_manysearch_pathlist(runtmp, search_files):
+    # pathlists are expanded & streamed in order
+    (query1, query2), (against, *_) = search_files
+
+    pathlist = runtmp.output('pathlist.txt')
+    with open(pathlist, 'wt') as fp:
+        fp.write(f"{against}\n{query2}\n{query1}\n")
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', pathlist, '-o', 'out.csv',
+                    '--prefetch', '1', '--prefetch-mb', '0.001')
+
+    with open(runtmp.output('out.csv'), newline='') as fp:
+        rows = list(csv.DictReader(fp))
+    assert len(rows) == 6
+    assert [ row['match_name'][:10] for row in rows ] == \
+        ['SRR606249'] * 2 + ['CP001941.1'] * 2 + ['CP001472.1'] * 2
+    assert { row['match_filename'] for row in rows } == {pathlist}
+
+
+def test_manysearch_timings(runtmp, search_files):
+    # --timings-json records per-phase and per-metagenome timings
+    import json
+
+    (query1, query2), (against, *_) = search_files
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', against, '--timings',
+                    '--timings-json', 'timings.json',
+                    '--profile', 'search.prof')
+    assert 'load_metagenome' in runtmp.last_result.err
+    assert os.path.exists(runtmp.output('search.prof'))
+
+    with open(runtmp.output('timings.json')) as fp:
+        timings = json.load(fp)
+
+    phases = timings['phases']
+    for name in ('load_queries', 'index_queries', 'load_metagenome',
+                 'intersect', 'score', 'output'):
+        assert name in phases, name
+    assert phases['load_metagenome']['calls'] == 1
+    assert phases['output']['calls'] == 2
+    assert timings['total_wall'] > 0
+
+    assert len(timings['metagenomes']) == 1
+    metag = timings['metagenomes'][0]
+    assert metag['name'] == 'SRR606249'
+    assert metag['n_hashes'] == phases['load_metagenome']['n_hashes']
+
+
+def test_manysearch_columns(runtmp):
+    # --columns selects CSV columns, by profile or by name
+    query1 = utils.get_test_data('0.sig.zip')
+    against = utils.get_test_data('SRR606249.k31.sig.zip')
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1,
+                    '--against', against, '-o', 'detect.csv',
+                    '--columns', 'detection')
+    with open(runtmp.output('detect.csv'), newline='') as fp:
+        r = csv.DictReader(fp)
+        rows = list(r)
+        assert 'f_query' in r.fieldnames
+        assert 'genome_containment_ani' not in r.fieldnames
+        assert 'potential_false_negative' not in r.fieldnames
+    assert len(rows) == 1
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1,
+                    '--against', against, '-o', 'some.csv',
+                    '--columns', 'match_name,f_query,max_containment_ani')
+    with open(runtmp.output('some.csv'), newline='') as fp:
+        r = csv.DictReader(fp)
+        rows = list(r)
+        assert r.fieldnames == ['match_name', 'f_query', 'max_containment_ani']
+    assert rows[0]['match_name'] == 'SRR606249'
+    assert float(rows[0]['f_query']) == 1.0
+
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1,
+                        '--against', against, '-o', 'bad.csv',
+                        '--columns', 'f_query,no_such_column')
+    assert 'unknown column(s) no_such_column' in runtmp.last_result.err
+
+
+def test_manysearch_detection_skips_ani(monkeypatch):
+    # ANI is not estimated unless it is displayed or written out
+    def fail(*args, **kwargs):
+        raise AssertionError("ANI should not be calculated")
+    monkeypatch.setattr(plugin, 'containment_to_distance', fail)
+
+    query1 = utils.get_test_data('0.sig.zip')
+    against = utils.get_test_data('SRR606249.k31.sig.zip')
+
+    status = plugin.mg_many_search([query1], [against], scaled=100000)
+    assert not status
+
+    with pytest.raises(AssertionError):
+        plugin.mg_many_search([query1], [against], scaled=100000,
+                              output_ani=True)
+
+
+def test_manysearch_threshold_and_top_k(runtmp, search_files):
+    # --threshold-bp, --min-containment and --top-k drop rows
+    (query1, query2), (against, *_) = search_files
+
+    def search(*args):
+        runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1,
+                        query2, '--against', against, query1, query2,
+                        '-o', 'out.csv', *args)
+        with open(runtmp.output('out.csv'), newline='') as fp:
+            return [ (row['query_name'].split()[0], row['match_name'].split()[0],
+                      int(row['intersect_bp']))
+                     for row in csv.DictReader(fp) ]
+
+    assert len(search()) == 6
+
+    hits = [('CP001472.1', 'SRR606249', 4200000),
+            ('CP001941.1', 'SRR606249', 600000),
+            ('CP001472.1', 'CP001472.1', 4200000),
+            ('CP001941.1', 'CP001941.1', 600000)]
+    assert search('--threshold-bp', '1') == hits
+    assert search('--min-containment', '0.5') == hits
+    assert search('--threshold-bp', '1000000') == [hits[0], hits[2]]
+
+    # best metagenome per query; ties go to the first metagenome.
+    assert search('--top-k', '1') == hits[:2]
+    # best query per metagenome.
+    assert search('--top-k', '1', '--top-k-by', 'metagenome') == \
+        [hits[0], hits[2], hits[3]]
+
+    with pytest.raises(SourmashCommandFailed):
+        search('--top-k', '0')
+    assert '--top-k must be at least 1' in runtmp.last_result.err
+
+
+def test_mgsearch_top_k(runtmp):
+    # mgsearch --top-k reports the best metagenomes, in input order
+    query = utils.get_test_data('1.sig.zip')
+    against = [ utils.get_test_data(f) for f in
+                ('0.sig.zip', 'SRR606249.k31.sig.zip', '1.sig.zip') ]
+
+    runtmp.sourmash('scripts', 'mgsearch', query, *against, '-o', 'out.csv',
+                    '--top-k', '2')
+    with open(runtmp.output('out.csv'), newline='') as fp:
+        rows = list(csv.DictReader(fp))
+
+    assert [ row['match_name'] for row in rows ] == \
+        ['SRR606249', 'CP001941.1 Aciduliprofundum boonei T469, complete genome']
+
+
+def test_manysearch_csv_gz(runtmp, search_files):
+    # -o *.csv.gz writes compressed CSV identical to plain CSV
+    import gzip
+
+    (query1, query2), (against, *_) = search_files
+
+    for output in ('out.csv', 'out.csv.gz'):
+        runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1,
+                        query2, '--against', against, '-o', output)
+
+    with gzip.open(runtmp.output('out.csv.gz'), 'rt', newline='') as fp:
+        gz_text = fp.read()
+    with open(runtmp.output('out.csv'), newline='') as fp:
+        assert fp.read() == gz_text
+
+    # not compressed at the slowest level: the gzip XFL header byte is 2
+    # for level 9.
+    with open(runtmp.output('out.csv.gz'), 'rb') as fp:
+        assert fp.read(9)[8] == 0
+
+
+@pytest.mark.parametrize('ext', ['parquet', 'arrow'])
+def test_manysearch_arrow_output(runtmp, search_files, ext):
+    # -o *.parquet / *.arrow write typed columns matching the CSV output
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+
+    (query1, query2), (against, *_) = search_files
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', against, query1, '-o', 'out.csv')
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', against, query1, '-o', f'out.{ext}')
+
+    if ext == 'parquet':
+        table = pyarrow.parquet.read_table(runtmp.output('out.parquet'))
+    else:
+        table = pa.ipc.open_file(runtmp.output('out.arrow')).read_all()
+
+    with open(runtmp.output('out.csv'), newline='') as fp:
+        csv_rows = list(csv.DictReader(fp))
+
+    assert table.column_names == list(csv_rows[0].keys())
+    assert table.schema.field('intersect_bp').type == pa.int64()
+    assert table.schema.field('f_query').type == pa.float64()
+
+    assert len(csv_rows) == table.num_rows == 4
+    for csv_row, row in zip(csv_rows, table.to_pylist()):
+        for name, value in csv_row.items():
+            if value == '':
+                assert row[name] is None
+            elif isinstance(row[name], float):
+                assert row[name] == float(value)
+            else:
+                assert str(row[name]) == value
+
+
+def test_arrow_output_requires_pyarrow(monkeypatch, tmp_path):
+    import sys
+
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    with pytest.raises(ValueError, match='requires pyarrow'):
+        plugin._open_output(str(tmp_path / 'out.parquet'), plugin.COLUMNS)
+
+
+def test_manysearch_checkpoint_resume(runtmp, search_files, monkeypatch):
+    # an interrupted search resumes from its checkpoint, with no rows
+    # duplicated or lost.
+    import json
+
+    queries, against = search_files
+
+    full_csv = runtmp.output('full.csv')
+    out_csv = runtmp.output('out.csv')
+    checkpoint = runtmp.output('search.checkpoint')
+
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=full_csv)
+
+    # interrupt the search while writing the rows for the last metagenome
+    score_metag = plugin._score_metag
+    def interrupted(query_index, metag_filename, *args, **kwargs):
+        for item in score_metag(query_index, metag_filename, *args, **kwargs):
+            if metag_filename == against[-1]:
+                raise KeyboardInterrupt
+            yield item
+
+    monkeypatch.setattr(plugin, '_score_metag', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        plugin.mg_many_search(queries, against, scaled=100000,
+                              output=out_csv, checkpoint=checkpoint,
+                              prefetch=0)
+    monkeypatch.undo()
+
+    # simulate a partly written row and checkpoint record
+    with open(out_csv, 'a') as fp:
+        fp.write('4200000,partial')
+    with open(checkpoint, 'a') as fp:
+        fp.write('{"filename": "partial')
+
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=out_csv, checkpoint=checkpoint)
+
+    with open(full_csv) as fp1, open(out_csv) as fp2:
+        assert fp1.read() == fp2.read()
+
+    with open(checkpoint) as fp:
+        records = [ json.loads(line) for line in fp ]
+    assert [ r['filename'] for r in records[1:] ] == against
+
+    # a different search can't resume from this checkpoint
+    status = plugin.mg_many_search(queries[:1], against, scaled=100000,
+                                   output=out_csv, checkpoint=checkpoint)
+    assert status == -1
+
+
+@pytest.mark.parametrize('read_ahead', [1, 2])
+def test_manysearch_checkpoint_complete_files(runtmp, search_files,
+                                              monkeypatch, read_ahead):
+    # each file is recorded as soon as its rows are written, including
+    # files with no sketches to search.
+    import json
+
+    mh = sourmash.MinHash(n=0, ksize=21, scaled=1000)
+    mh.add_many(range(100))
+    k21 = runtmp.output('k21.sig.zip')
+    with sourmash.save_load.SaveSignaturesToLocation(k21) as save_sigs:
+        save_sigs.add(sourmash.SourmashSignature(mh, name='k21'))
+
+    queries, against = search_files
+    against.insert(1, k21)
+
+    full_csv = runtmp.output('full.csv')
+    out_csv = runtmp.output('out.csv')
+    checkpoint = runtmp.output('search.checkpoint')
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=full_csv)
+
+    # interrupt the search while scoring the last metagenome
+    score_metag = plugin._score_metag
+    def interrupted(query_index, metag_filename, *args, **kwargs):
+        if metag_filename == against[-1]:
+            raise KeyboardInterrupt
+        yield from score_metag(query_index, metag_filename, *args, **kwargs)
+
+    monkeypatch.setattr(plugin, '_score_metag', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        plugin.mg_many_search(queries, against, scaled=100000,
+                              output=out_csv, checkpoint=checkpoint,
+                              read_ahead=read_ahead)
+    monkeypatch.undo()
+
+    with open(checkpoint) as fp:
+        records = [ json.loads(line) for line in fp ]
+    assert [ r['filename'] for r in records[1:] ] == against[:3]
+    assert records[2]['md5s'] == []
+
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=out_csv, checkpoint=checkpoint,
+                                     read_ahead=read_ahead)
+    with open(full_csv) as fp1, open(out_csv) as fp2:
+        assert fp1.read() == fp2.read()
+
+
+def test_manysearch_checkpoint_then_previous(runtmp, search_files, monkeypatch):
+    # a checkpointed search records the pairs it searched with its filter
+    # settings; a resumed search records none, so --previous searches
+    # the pairs without rows again.
+    queries, against = search_files
+
+    full_csv = runtmp.output('full.csv')
+    out_csv = runtmp.output('out.csv')
+    checkpoint = runtmp.output('search.checkpoint')
+
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=full_csv, threshold_bp=1)
+
+    scored = []
+    score_metag = plugin._score_metag
+    def counting(query_index, metag_filename, *args, **kwargs):
+        scored.append(metag_filename)
+        for item in score_metag(query_index, metag_filename, *args, **kwargs):
+            if metag_filename == against[-1] and interrupt:
+                raise KeyboardInterrupt
+            yield item
+    monkeypatch.setattr(plugin, '_score_metag', counting)
+
+    def previous_search():
+        scored.clear()
+        again_csv = runtmp.output('again.csv')
+        assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                         output=again_csv, previous=out_csv,
+                                         threshold_bp=1, prefetch=0)
+        with open(full_csv) as fp1, open(again_csv) as fp2:
+            assert sorted(fp1) == sorted(fp2)
+        return list(scored)
+
+    # uninterrupted: --previous has nothing left to search
+    interrupt = False
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=out_csv, checkpoint=checkpoint,
+                                     threshold_bp=1, prefetch=0)
+    manifest = plugin._read_searched(out_csv + '.searched')
+    assert manifest['settings'] == dict(threshold_bp=1, min_containment=0.0,
+                                        top_k=None, top_k_by=None)
+    assert len(manifest['searched']) == 3
+    assert previous_search() == []
+
+    # interrupted & resumed: no manifest, so pairs without rows are
+    # searched again.
+    os.remove(out_csv)
+    os.remove(checkpoint)
+    interrupt = True
+    with pytest.raises(KeyboardInterrupt):
+        plugin.mg_many_search(queries, against, scaled=100000,
+                              output=out_csv, checkpoint=checkpoint,
+                              threshold_bp=1, prefetch=0)
+    interrupt = False
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=out_csv, checkpoint=checkpoint,
+                                     threshold_bp=1, prefetch=0)
+    assert not os.path.exists(out_csv + '.searched')
+    assert previous_search() != []
+
+
+def test_manysearch_previous(runtmp, search_files, monkeypatch):
+    # an incremental search only scores new (query, metagenome) pairs, and
+    # outputs the same rows as a full search.
+    queries, against = search_files
+
+    full_csv = runtmp.output('full.csv')
+    out_csv = runtmp.output('out.csv')
+
+    # with --threshold-bp, zero-overlap pairs leave no rows.
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=full_csv, threshold_bp=1)
+    assert not plugin.mg_many_search(queries, against[:2], scaled=100000,
+                                     output=out_csv, threshold_bp=1)
+    assert os.path.exists(out_csv + '.searched')
+    with open(out_csv) as fp:
+        previous_lines = fp.read().splitlines()[1:]
+
+    scored = []
+    score_metag = plugin._score_metag
+    def counting(query_index, metag_filename, *args, **kwargs):
+        scored.append(metag_filename)
+        yield from score_metag(query_index, metag_filename, *args, **kwargs)
+
+    # write the merged results over the previous results
+    monkeypatch.setattr(plugin, '_score_metag', counting)
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=out_csv, previous=out_csv,
+                                     threshold_bp=1, prefetch=0)
+    assert scored == [against[2]]
+
+    # new rows come first, followed by the earlier rows as written
+    with open(full_csv) as fp1, open(out_csv) as fp2:
+        full_lines = fp1.read().splitlines()
+        out_lines = fp2.read().splitlines()
+    assert out_lines[-len(previous_lines):] == previous_lines
+    assert out_lines[0] == full_lines[0]
+    assert sorted(out_lines[1:]) == sorted(full_lines[1:])
+
+    # nothing left to score, including filtered pairs
+    scored.clear()
+    again_csv = runtmp.output('again.csv')
+    assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                     output=again_csv, previous=out_csv,
+                                     threshold_bp=1, prefetch=0)
+    assert scored == []
+    with open(again_csv) as fp:
+        assert fp.read().splitlines() == out_lines
+
+    # rows for metagenomes no longer in the input are dropped
+    fewer_csv = runtmp.output('fewer.csv')
+    assert not plugin.mg_many_search(queries, against[:1], scaled=100000,
+                                     output=fewer_csv, previous=out_csv,
+                                     threshold_bp=1, prefetch=0)
+    assert scored == []
+    with open(fewer_csv) as fp:
+        rows = list(csv.DictReader(fp))
+    assert rows
+    assert { row['match_filename'] for row in rows } == { against[0] }
+
+
+def test_manysearch_display_and_progress(runtmp, search_files):
+    # results written to CSV are not displayed unless asked for; progress
+    # is reported on stderr.
+    (query1, query2), against = search_files
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', *against, '-o', 'out.csv', '--progress')
+    assert "SRR606249" not in runtmp.last_result.out
+    assert "searched 3 of 3 files" in runtmp.last_result.err
+    assert "pairs/s" in runtmp.last_result.err
+
+    with open(runtmp.output('out.csv'), newline='') as fp:
+        assert len(list(csv.DictReader(fp))) == 6
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', *against, '-q')
+    assert runtmp.last_result.out == ""
+    assert "searched" not in runtmp.last_result.err
+
+    runtmp.sourmash('scripts', 'mgsearch', query1, *against, '-o', 'one.csv',
+                    '--show-results')
+    assert "100.0%    54.2       3.1%     SRR606249" in runtmp.last_result.out
+
+
+def test_containment_searcher(runtmp, search_files):
+    # the Python API gives the same results as mgmanysearch, for signature
+    # and MinHash queries, with metagenomes held in memory.
+    (query1, query2), against = search_files
+
+    runtmp.sourmash('scripts', 'mgmanysearch', '--queries', query1, query2,
+                    '--against', *against, '-o', 'out.csv')
+    with open(runtmp.output('out.csv'), newline='') as fp:
+        cli_rows = list(csv.DictReader(fp))
+
+    searcher = plugin.ContainmentSearcher(against)
+    assert len(searcher) == 3
+
+    ss1 = list(sourmash.load_file_as_signatures(query1))[0]
+    ss2 = list(sourmash.load_file_as_signatures(query2))[0]
+    for queries in ([ss1, ss2], [ss1, ss2.minhash]):
+        results = searcher.search(queries)
+        assert len(results) == len(cli_rows) == 6
+        for result, row in zip(results, cli_rows):
+            assert result.match_name == row['match_name']
+            assert result.query_md5 == row['query_md5']
+            assert result.intersect_bp == int(row['intersect_bp'])
+            assert round(result.f_query, 6) == round(float(row['f_query']), 6)
+            if row['average_abund'] == '':
+                assert result.average_abund is None
+
+    results = searcher.search(ss1, threshold_bp=1, ani=False)
+    assert [ r.match_name for r in results ] == ['SRR606249', ss1.name]
+    assert results[0].genome_containment_ani is None
+
+    array = searcher.search_array([ss1, ss2], top_k=1)
+    assert len(array) == 2
+    assert list(array['f_query']) == [1.0, 1.0]
+    assert array.dtype['intersect_bp'].kind == 'i'
+
+    # the MinHash of a metagenome can be added directly
+    metag = list(sourmash.load_file_as_signatures(against[0]))[0]
+    searcher = plugin.ContainmentSearcher()
+    searcher.add(metag.minhash, filename='metag')
+    result, = searcher.search(ss1)
+    assert result.match_filename == 'metag'
+    assert result.f_query == 1.0
+
+    with pytest.raises(ValueError, match='ksize'):
+        plugin.ContainmentSearcher(ksize=21).add(metag)
+
+
+def test_metagenome_cache(runtmp):
+    # repeated searches load each metagenome once, within the memory
+    # budget; changed files are loaded again.
+    import shutil
+
+    query = list(sourmash.load_file_as_signatures(utils.get_test_data('0.sig.zip')))[0]
+    against = runtmp.output('metag.sig.zip')
+    shutil.copyfile(utils.get_test_data('SRR606249.k31.sig.zip'), against)
+    other = utils.get_test_data('1.sig.zip')
+
+    uncached = plugin.ContainmentSearcher([against, other], preload=False)
+    expected = uncached.search(query)
+
+    cache = plugin.MetagenomeCache(max_mb=1)
+    searcher = plugin.ContainmentSearcher([against, other], preload=False,
+                                          cache=cache)
+    assert searcher.search(query) == expected
+    assert searcher.search(query) == expected
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 2, 0)
+    assert stats['n_entries'] == 2
+    nbytes = cache.n_bytes
+
+    os.utime(against, ns=(0, 0))
+    assert searcher.search(query) == expected
+    assert cache.misses == 3
+
+    # a budget too small for both files evicts the least recently used
+    small = plugin.MetagenomeCache(max_mb=(nbytes - 1) / 1024 / 1024)
+    searcher = plugin.ContainmentSearcher([against, other], preload=False,
+                                          cache=small)
+    assert searcher.search(query) == expected
+    assert small.evictions == 1
+    assert len(small) == 1
+
+
+def test_manysearch_multiple_ksizes_and_scaled(runtmp, monkeypatch):
+    # searching several ksizes and scaled values at once gives the same
+    # rows as separate searches, reading each metagenome file once.
+    import random
+    from sourmash.minhash import _get_max_hash_for_scaled
+
+    rng = random.Random(1)
+    max_hash = _get_max_hash_for_scaled(1000)
+    query_sigs, metag_sigs = [], []
+    for ksize in (21, 31):
+        genome = [ rng.randrange(max_hash) for _ in range(500) ]
+        other = [ rng.randrange(max_hash) for _ in range(2000) ]
+
+        mh = sourmash.MinHash(n=0, ksize=ksize, scaled=1000)
+        mh.add_many(genome)
+        query_sigs.append(sourmash.SourmashSignature(mh, name=f'genome k={ksize}'))
+
+        mh = sourmash.MinHash(n=0, ksize=ksize, scaled=1000,
+                              track_abundance=True)
+        mh.set_abundances({ h: rng.randint(1, 10) for h in genome[:300] + other })
+        metag_sigs.append(sourmash.SourmashSignature(mh, name=f'metag k={ksize}'))
+
+    # a metagenome sketch at a ksize with no queries
+    mh = sourmash.MinHash(n=0, ksize=51, scaled=1000, track_abundance=True)
+    mh.set_abundances({ rng.randrange(max_hash): 1 for _ in range(2000) })
+    metag_sigs.append(sourmash.SourmashSignature(mh, name='metag k=51'))
+
+    queries = runtmp.output('queries.sig.zip')
+    against = runtmp.output('metag.sig.zip')
+    for filename, sigs in ((queries, query_sigs), (against, metag_sigs)):
+        with sourmash.save_load.SaveSignaturesToLocation(filename) as save_sigs:
+            for ss in sigs:
+                save_sigs.add(ss)
+
+    def read_rows(filename):
+        with open(filename, newline='') as fp:
+            return sorted(csv.DictReader(fp),
+                          key=lambda row: (int(row['ksize']), int(row['scaled'])))
+
+    expected = []
+    for ksize in (21, 31):
+        for scaled in (1000, 2000):
+            output = runtmp.output(f'k{ksize}.s{scaled}.csv')
+            assert not plugin.mg_many_search([queries], [against],
+                                             ksize=ksize, scaled=scaled,
+                                             output=output)
+            expected.extend(read_rows(output))
+    assert len(expected) == 4
+
+    loads = []
+    load_file_as_signatures = sourmash.load_file_as_signatures
+    def counting(filename, *args, **kwargs):
+        loads.append(filename)
+        return load_file_as_signatures(filename, *args, **kwargs)
+    monkeypatch.setattr(sourmash, 'load_file_as_signatures', counting)
+
+    # only sketches at the query ksizes are converted
+    converted = []
+    from_signature = plugin._PreparedMetagenome.from_signature
+    def converting(ss):
+        converted.append(ss.minhash.ksize)
+        return from_signature(ss)
+    monkeypatch.setattr(plugin._PreparedMetagenome, 'from_signature',
+                        staticmethod(converting))
+
+    output = runtmp.output('all.csv')
+    assert not plugin.mg_many_search([queries], [against], ksize=[21, 31],
+                                     scaled=[1000, 2000], output=output)
+    assert read_rows(output) == expected
+    assert loads.count(against) == 1
+    assert sorted(converted) == [21, 31]
+
+    runtmp.sourmash('scripts', 'mgsearch', queries, against, '-k', '21,31',
+                    '--scaled', '1000,2000', '-o', 'one.csv')
+    assert len(read_rows(runtmp.output('one.csv'))) == 4
+
+
+def test_query_groups_shared_memory():
+    # queries shared with worker processes are rebuilt as views of one
+    # shared memory block, and score identically.
+    queries = []
+    for filename in ('0.sig.zip', '1.sig.zip'):
+        queries.extend(plugin._load_queries(utils.get_test_data(filename),
+                                            ksize=31, moltype='DNA',
+                                            scaled=None))
+    metag, = plugin._load_metagenomes(utils.get_test_data('SRR606249.k31.sig.zip'))
+
+    coarse = plugin._load_queries(utils.get_test_data('0.sig.zip'), ksize=31,
+                                  moltype='DNA', scaled=200000)
+
+    groups = plugin._QueryGroups([(31, None, queries),
+                                  (31, 200000, coarse)])
+    shm, handle = groups.share()
+    try:
+        worker_shm, shared = plugin._QueryGroups.attach(handle)
+        assert len(shared) == 3
+        for query, shared_query in zip(groups.queries, shared.queries):
+            assert list(query.hashes) == list(shared_query.hashes)
+            assert shared_query.md5 == query.md5
+            assert shared_query.hashes.base is not None
+
+        expected = list(plugin._score_groups(groups, 'metag', metag))
+        rows = list(plugin._score_groups(shared, 'metag', metag))
+        assert [ idx for idx, _ in rows ] == [0, 1, 2]
+        assert rows == expected
+
+        del shared, shared_query, rows
+        worker_shm.close()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_mgdbsearch(runtmp):
+    # mgdbsearch reports the same rows as mgmanysearch for the genomes that
+    # overlap the metagenome.
+    metag = utils.get_test_data('SRR606249.k31.sig.zip')
+    dbs = [ utils.get_test_data('0.sig.zip'),
+            utils.get_test_data('1.sig.zip') ]
+
+    many_csv = runtmp.output('many.csv')
+    db_csv = runtmp.output('db.csv')
+    top_csv = runtmp.output('top.csv')
+
+    assert not plugin.mg_many_search(dbs, [metag], scaled=100000,
+                                     output=many_csv)
+    assert not plugin.mg_db_search(metag, dbs, scaled=100000, output=db_csv,
+                                   batch_size=1)
+    assert not plugin.mg_db_search(metag, dbs, scaled=100000, output=top_csv,
+                                   top_k=1)
+
+    def rows(filename):
+        with open(filename, newline='') as fp:
+            return { row['query_md5']: row for row in csv.DictReader(fp) }
+
+    many = rows(many_csv)
+    db = rows(db_csv)
+    assert len(db) == 2
+    assert db == many
+
+    top = rows(top_csv)
+    assert len(top) == 1
+    (row,) = top.values()
+    assert row == many[row['query_md5']]
+    assert float(row['f_query']) == max(float(r['f_query'])
+                                        for r in many.values())
+
+
+def test_mgdbsearch_mixed_scaled(runtmp):
+    # genomes with a coarser scaled than an abundance-weighted metagenome
+    # are compared at their own scaled.
+    import random
+    from sourmash import MinHash, SourmashSignature
+    from sourmash.save_load import SaveSignaturesToLocation
+
+    rng = random.Random(1)
+    max_hash = MinHash(n=0, ksize=31, scaled=100)._max_hash
+    hashes = rng.sample(range(max_hash), 20000)
+
+    metag_mh = MinHash(n=0, ksize=31, scaled=100, track_abundance=True)
+    metag_mh.set_abundances({ h: rng.randint(1, 5) for h in hashes })
+    fine_mh = MinHash(n=0, ksize=31, scaled=100)
+    fine_mh.add_many(hashes[:2000])
+    coarse_mh = MinHash(n=0, ksize=31, scaled=100)
+    coarse_mh.add_many(hashes[5000:9000] + rng.sample(range(max_hash), 2000))
+    coarse_mh = coarse_mh.downsample(scaled=1000)
+
+    metag = runtmp.output('metag.sig.zip')
+    db = runtmp.output('db.sig.zip')
+    with SaveSignaturesToLocation(metag) as save_sigs:
+        save_sigs.add(SourmashSignature(metag_mh, name='metag'))
+    with SaveSignaturesToLocation(db) as save_sigs:
+        save_sigs.add(SourmashSignature(fine_mh, name='fine'))
+        save_sigs.add(SourmashSignature(coarse_mh, name='coarse'))
+
+    out_csv = runtmp.output('out.csv')
+    assert not plugin.mg_db_search(metag, [db], output=out_csv)
+    with open(out_csv, newline='') as fp:
+        rows = { row['query_name']: row for row in csv.DictReader(fp) }
+
+    assert set(rows) == { 'fine', 'coarse' }
+    assert rows['fine']['scaled'] == '100'
+    assert rows['coarse']['scaled'] == '1000'
+    expected = coarse_mh.contained_by(metag_mh.flatten().downsample(scaled=1000))
+    assert float(rows['coarse']['f_query']) == pytest.approx(expected)
+    assert float(rows['coarse']['f_match_weighted']) > 0
+
+
+def test_mgdbsearch_scaled_too_fine(runtmp):
+    # a --scaled finer than the metagenome's is reported as an error
+    metag = utils.get_test_data('SRR606249.k31.sig.zip')
+    db = utils.get_test_data('0.sig.zip')
+
+    with pytest.raises(SourmashCommandFailed):
+        runtmp.sourmash('scripts', 'mgdbsearch', metag, db,
+                        '--scaled', '1000', fail_ok=True)
+
+    err = runtmp.last_result.err
+    assert "ERROR: cannot load metagenome" in err
+    assert "Traceback" not in err
+
+
+def test_prepared_metagenome_seed(runtmp):
+    # the MinHash seed is kept through downsampling, .mgsketch files and
+    # the flat MinHash used by mgdbsearch.
+    mh = sourmash.MinHash(n=0, ksize=31, scaled=100, seed=7)
+    mh.add_many(range(1, 10000, 7))
+    metag = plugin._PreparedMetagenome.from_signature(
+        sourmash.SourmashSignature(mh, name='seeded'))
+    assert metag.seed == 7
+    assert metag.downsample(1000).seed == 7
+
+    filename = runtmp.output('seeded.mgsketch')
+    plugin._write_mgsketch(filename, [metag])
+    (loaded,) = plugin._read_mgsketch(filename)
+    assert loaded.seed == 7
+
+    flat_mh = plugin._flat_minhash(loaded)
+    assert flat_mh.seed == 7
+    assert flat_mh == mh
+
+
+def test_manysearch_results_cache(runtmp, search_files, monkeypatch):
+    # cached results are output without scoring the pairs again, and match
+    # a search without the cache.
+    queries, against = search_files
+    cache = runtmp.output('results.sqlite')
+
+    def search(name, queries, **kwargs):
+        out_csv = runtmp.output(name)
+        assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                         output=out_csv, **kwargs)
+        with open(out_csv) as fp:
+            return fp.read()
+
+    full = search('full.csv', queries, threshold_bp=200000)
+    search('first.csv', queries[:1], results_cache=cache,
+           columns='detection')
+
+    scored = []
+    batch_score = plugin._batch_score
+    def counting(query_index, metag, *, skip_queries=None, **kwargs):
+        for query_idx, results_d in batch_score(query_index, metag,
+                                                 skip_queries=skip_queries,
+                                                 **kwargs):
+            scored.append(results_d['query_md5'])
+            yield query_idx, results_d
+    monkeypatch.setattr(plugin, '_batch_score', counting)
+
+    # cached results without ANI are scored again when ANI is needed.
+    assert search('second.csv', queries, results_cache=cache,
+                  threshold_bp=200000) == full
+    assert len(scored) == 6
+
+    scored.clear()
+    assert search('third.csv', queries, results_cache=cache,
+                  threshold_bp=200000) == full
+    assert scored == []
+
+
+def test_manysearch_results_cache_parallel(runtmp, search_files, monkeypatch):
+    # each worker process opens its own connection to the results cache,
+    # rather than using one inherited from the parent.
+    queries, against = search_files
+    cache = runtmp.output('results.sqlite')
+    pids_file = runtmp.output('pids')
+
+    open_cache = plugin._ResultsCache._open
+    def recording(self):
+        with open(pids_file, 'a') as fp:
+            fp.write(f"{os.getpid()}\n")
+        return open_cache(self)
+    monkeypatch.setattr(plugin._ResultsCache, '_open', recording)
+
+    def search(name, **kwargs):
+        out_csv = runtmp.output(name)
+        assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                         output=out_csv, **kwargs)
+        with open(out_csv) as fp:
+            return fp.read()
+
+    full = search('full.csv')
+    assert search('first.csv', results_cache=cache, cores=3) == full
+    with open(pids_file) as fp:
+        pids = set(fp.read().split())
+    assert str(os.getpid()) in pids
+    assert len(pids) > 1
+
+    with plugin._ResultsCache(cache)._connect() as conn:
+        (n_entries,) = conn.execute("SELECT COUNT(*) FROM results").fetchone()
+    assert n_entries == 6
+    assert search('second.csv', results_cache=cache, cores=3) == full
+
+
+def test_manysearch_metag_cache(runtmp, search_files, monkeypatch):
+    # downsampled metagenomes are saved as .mgsketch files and loaded
+    # from there by later runs, with identical output.
+    queries, against = search_files
+    against = against[:1]
+    cache_dir = runtmp.output('metags')
+
+    def search(name, **kwargs):
+        out_csv = runtmp.output(name)
+        assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                         output=out_csv, **kwargs)
+        with open(out_csv) as fp:
+            return fp.read()
+
+    full = search('full.csv')
+    assert search('first.csv', metag_cache=cache_dir) == full
+
+    (cache_file,) = os.listdir(cache_dir)
+    assert cache_file.endswith('.mgsketch')
+    (metag,) = plugin._read_mgsketch(os.path.join(cache_dir, cache_file))
+    assert metag.scaled == 100000
+
+    def fail(*args, **kwargs):
+        raise AssertionError('metagenome loaded with sourmash')
+    monkeypatch.setattr(plugin, '_load_sourmash_metagenomes', fail)
+    assert search('second.csv', metag_cache=cache_dir) == full
+
+
+def test_metag_cache_lazy(runtmp):
+    # on a cache miss, sketches are yielded as they are loaded; the cache
+    # file is only written once they have all been read, even if the
+    # caller stops early.
+    import numpy as np
+
+    against = utils.get_test_data('SRR606249.k31.sig.zip')
+    cache_dir = runtmp.output('metags')
+
+    metags = plugin._load_metag_cache(against, ksize=31, scaled=100000,
+                                      cache_dir=cache_dir)
+    metag = next(metags)
+    assert metag.scaled == 100000
+    assert os.listdir(cache_dir) != []
+    assert not [ f for f in os.listdir(cache_dir) if f.endswith('.mgsketch') ]
+
+    # stopping early still completes the cache file, with no temporary
+    # files left behind
+    metags.close()
+    (cache_file,) = os.listdir(cache_dir)
+    assert cache_file.endswith('.mgsketch')
+    (cached,) = plugin._load_metag_cache(against, ksize=31, scaled=100000,
+                                         cache_dir=cache_dir)
+    assert isinstance(cached.hashes, np.memmap)
+    assert cached.md5 == metag.md5
+    assert list(cached.hashes) == list(metag.hashes)
+
+
+def test_mgsearch_metag_cache(runtmp, monkeypatch):
+    # mgsearch only searches the first sketch in each file, but still
+    # writes the cache entry, and uses it on the next run.
+    query = utils.get_test_data('0.sig.zip')
+    against = [ utils.get_test_data('SRR606249.k31.sig.zip') ]
+    cache_dir = runtmp.output('metags')
+
+    def search(name, **kwargs):
+        out_csv = runtmp.output(name)
+        assert not plugin.mgsearch(query, against, scaled=100000,
+                                   output=out_csv, **kwargs)
+        with open(out_csv) as fp:
+            return fp.read()
+
+    full = search('full.csv', prefetch=0)
+    assert search('first.csv', metag_cache=cache_dir) == full
+    (cache_file,) = os.listdir(cache_dir)
+    assert cache_file.endswith('.mgsketch')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('metagenome loaded with sourmash')
+    monkeypatch.setattr(plugin, '_load_sourmash_metagenomes', fail)
+    assert search('second.csv', metag_cache=cache_dir) == full
+
+
+def test_read_ahead_order_and_concurrency():
+    # files are loaded concurrently, and their items yielded in order
+    import threading
+
+    lock = threading.Lock()
+    state = dict(running=0, max_running=0)
+    started = threading.Barrier(3, timeout=5)
+
+    def load(filename):
+        with lock:
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        if filename < 3:
+            started.wait()              # the first 3 loads overlap
+        with lock:
+            state['running'] -= 1
+        if filename == 7:
+            raise ValueError("load failed")
+        return [ (filename, i) for i in range(2) ]
+
+    it = plugin._read_ahead(range(10), load, max_files=3)
+    assert [ next(it) for _ in range(14) ] == \
+        [ (f, i) for f in range(7) for i in range(2) ]
+    assert state['max_running'] == 3
+    with pytest.raises(ValueError, match="load failed"):
+        next(it)
+
+
+def test_read_ahead_budget():
+    # items buffered ahead stay within the limits, counting files that
+    # are still being loaded.
+    import threading
+    import time
+
+    lock = threading.Lock()
+    state = dict(produced=0)
+
+    def load(filename):
+        for i in range(5):
+            with lock:
+                state['produced'] += 1
+            yield filename, i
+
+    it = plugin._read_ahead(range(4), load, max_files=3, max_items=2)
+    consumed = []
+    for item in it:
+        consumed.append(item)
+        time.sleep(0.01)                # let the loaders fill the buffer
+        with lock:
+            # the current file may buffer one more item, and each loader
+            # may hold one item it has not yet buffered.
+            assert state['produced'] - len(consumed) <= 2 + 1 + 3
+    assert consumed == [ (f, i) for f in range(4) for i in range(5) ]
+
+    # a byte budget applies in the same way
+    it = plugin._read_ahead(range(4), load, max_files=3, max_bytes=10,
+                            sizeof=lambda item: 5)
+    assert list(it) == consumed
+
+
+def test_manysearch_read_ahead(runtmp, search_files):
+    queries, against = search_files
+
+    outputs = []
+    for read_ahead in (1, 3):
+        out_csv = runtmp.output(f'out{read_ahead}.csv')
+        assert not plugin.mg_many_search(queries, against, scaled=100000,
+                                         output=out_csv,
+                                         read_ahead=read_ahead)
+        with open(out_csv) as fp:
+            outputs.append(fp.read())
+    assert outputs[0] == outputs[1]
+
+    # each file in a pathlist is read ahead on its own
+    pathlist = runtmp.output('pathlist.txt')
+    with open(pathlist, 'w') as fp:
+        fp.write('\n'.join(against[1:]) + '\n')
+    assert plugin._expand_pathlists([against[0], pathlist]) == against
+
+    outputs = []
+    for read_ahead in (1, 3):
+        out_csv = runtmp.output(f'pathlist{read_ahead}.csv')
+        assert not plugin.mg_many_search(queries, [against[0], pathlist],
+                                         scaled=100000, output=out_csv,
+                                         read_ahead=read_ahead,
+                                         prefetch_mb=0.001)
+        with open(out_csv) as fp:
+            outputs.append(fp.read())
+    assert outputs[0] == outputs[1]